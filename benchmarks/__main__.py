@@ -0,0 +1,83 @@
+from argparse import ArgumentParser
+import json
+import platform
+from resource import RUSAGE_SELF, getrusage
+from subprocess import DEVNULL, CalledProcessError, check_output
+import sys
+
+from .suite import BENCHMARKS
+
+
+def git_commit():
+    try:
+        return check_output(["git", "rev-parse", "--short", "HEAD"], stderr=DEVNULL, text=True).strip()
+    except (CalledProcessError, OSError):
+        return None
+
+
+def main():
+    parser = ArgumentParser(
+        prog="python -m benchmarks",
+        description="Benchmarks for fancyping's hot paths",
+    )
+    parser.add_argument(
+        'names',
+        metavar="BENCHMARK",
+        nargs='*',
+        help="benchmarks to run (defaults to all of: {})".format(", ".join(BENCHMARKS)),
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        help="show changes relative to results previously saved with --json",
+    )
+    parser.add_argument(
+        "--json",
+        metavar="FILE",
+        help="save results to FILE",
+    )
+    parser.add_argument(
+        "--quick",
+        action='store_true',
+        help="run shorter versions of the benchmarks",
+    )
+    pargs = parser.parse_args()
+    for name in pargs.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    baseline = {}
+    if pargs.compare:
+        with open(pargs.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    for name in pargs.names or BENCHMARKS:
+        print(f"{name}:", flush=True)
+        results[name] = BENCHMARKS[name](pargs.quick)
+        for metric, value in results[name].items():
+            line = f"  {metric:32} {value:14.2f}"
+            previous = baseline.get(name, {}).get(metric)
+            if previous:
+                line += f"  {(value / previous - 1) * 100:+7.1f}%"
+            print(line)
+
+    if pargs.json:
+        with open(pargs.json, 'w') as f:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "quick": pargs.quick,
+                    "max_rss_mb": getrusage(RUSAGE_SELF).ru_maxrss / 1000,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import curses
+from random import Random
+from threading import Lock
+from time import perf_counter_ns, sleep
+from types import SimpleNamespace
+
+# name -> function(Random) returning an RTT in ms or None for loss
+PATTERNS = {
+    "steady": lambda rng: rng.lognormvariate(3, 0.1),
+    "jittery": lambda rng: rng.lognormvariate(3, 0.8),
+    "lossy": lambda rng: None if rng.random() < 0.05 else rng.lognormvariate(3, 0.3),
+    # about one 50 ping outage every 2000 pings
+    "outages": None,
+}
+
+
+class RTTSource:
+    # Deterministic stream of RTTs following one of PATTERNS, safe to
+    # share between threads.
+    def __init__(self, pattern="steady", seed=0):
+        self.pattern = pattern
+        self._rng = Random(seed)
+        self._outage = 0
+        self._lock = Lock()
+
+    def __next__(self):
+        with self._lock:
+            rng = self._rng
+            if self.pattern != "outages":
+                return PATTERNS[self.pattern](rng)
+            if self._outage:
+                self._outage -= 1
+                return None
+            if rng.random() < 1 / 2000:
+                self._outage = 49
+                return None
+            return rng.lognormvariate(3, 0.3)
+
+    def __iter__(self):
+        return self
+
+
+class FakePing:
+    # Drop-in for icmplib.ping() as called by ThreadEngine. Sleeps for
+    # the RTT (or the timeout) so threads overlap like real ones do.
+    def __init__(self, source, sleep=True):
+        self.source = source
+        self.sleep = sleep
+        self.calls = 0
+
+    def __call__(self, address, count=1, timeout=2, privileged=True, payload_size=56, **kwargs):
+        self.calls += 1
+        rtt = next(self.source)
+        if self.sleep:
+            sleep(timeout if rtt is None else min(rtt / 1000, timeout))
+        return SimpleNamespace(
+            address=address,
+            is_alive=rtt is not None,
+            rtts=[] if rtt is None else [rtt],
+        )
+
+
+class TimedLock:
+    # Stands in for a Lock, recording how long it is held.
+    def __init__(self):
+        self._lock = Lock()
+        self._acquired = 0
+        # ns per hold
+        self.holds = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired = perf_counter_ns()
+        return acquired
+
+    def release(self):
+        self.holds.append(perf_counter_ns() - self._acquired)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def timed(function, durations):
+    # function, appending how long each call took (ns) to durations
+    def wrapper(*args, **kwargs):
+        started = perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(perf_counter_ns() - started)
+    return wrapper
+
+
+def fake_curses():
+    # what fancyping.ui needs from the curses module, minus the terminal
+    return SimpleNamespace(
+        error=curses.error,
+        beep=lambda: None,
+        color_pair=lambda number: number << 8,
+        curs_set=lambda visibility: None,
+        init_pair=lambda number, foreground, background: None,
+        resizeterm=lambda lines, columns: None,
+        use_default_colors=lambda: None,
+        **{name: getattr(curses, name) for name in dir(curses) if name.startswith("COLOR_")},
+    )
+
+
+class FakeWindow:
+    # Just enough of a curses window for fancyping.ui, drawing into a
+    # list of rows so the cost of writing characters isn't optimized
+    # away entirely. Keys are returned from `keys` in order.
+    def __init__(self, lines=40, columns=120, keys=()):
+        self.lines = lines
+        self.columns = columns
+        self.keys = list(keys)
+        self.writes = 0
+        self.clear()
+
+    def getmaxyx(self):
+        return self.lines, self.columns
+
+    def getkey(self):
+        if not self.keys:
+            raise curses.error("no input")
+        return self.keys.pop(0)
+
+    def nodelay(self, flag):
+        pass
+
+    def clear(self):
+        self.rows = [[" "] * self.columns for y in range(self.lines)]
+        self._cursor = (0, 0)
+
+    erase = clear
+
+    def refresh(self):
+        pass
+
+    def addstr(self, y, x, text, attr=0):
+        if not (0 <= y < self.lines and 0 <= x < self.columns):
+            raise curses.error("addstr() returned ERR")
+        row = self.rows[y]
+        text = text[:self.columns - x]
+        row[x:x + len(text)] = text
+        self.writes += 1
+
+    def move(self, y, x):
+        self._cursor = (y, x)
+
+    def delch(self):
+        y, x = self._cursor
+        row = self.rows[y]
+        del row[x]
+        row.append(" ")
+
+    def text(self):
+        return "\n".join("".join(row) for row in self.rows)
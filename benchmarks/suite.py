@@ -0,0 +1,226 @@
+from threading import Thread
+from time import monotonic, monotonic_ns, perf_counter, perf_counter_ns, sleep, time
+import tracemalloc
+from unittest import mock
+
+from fancyping import engines, ui
+from fancyping.cmdline import build_parser
+from fancyping.icmp import PingRecorder
+from fancyping.stats import percentile
+
+from .fakes import PATTERNS, FakePing, FakeWindow, RTTSource, TimedLock, fake_curses, timed
+
+# samples/s the recorder is driven at while rendering
+RENDER_RATES = (1000, 10000, 100000)
+# pings/s sent through ThreadEngine and the fake backend
+ENGINE_RATES = (1000, 10000)
+
+
+def summarize(prefix, durations_ns):
+    durations = sorted(d / 1000 for d in durations_ns)
+    if not durations:
+        return {}
+    return {
+        f"{prefix}_us_mean": sum(durations) / len(durations),
+        f"{prefix}_us_p50": percentile(durations, 50),
+        f"{prefix}_us_p99": percentile(durations, 99),
+        f"{prefix}_us_max": durations[-1],
+    }
+
+
+def feed(recorder, source, count=1):
+    for i in range(count):
+        probe, sent = recorder._probe_sent()
+        recorder._handle_reply(probe, sent, next(source))
+
+
+def filled_recorder(samples, pattern="lossy", interval=1.0, **kwargs):
+    # a recorder holding `samples` pings sent every `interval` seconds
+    # up to now, as if it had been running for that long
+    recorder = PingRecorder("bench", interval=interval, **kwargs)
+    source = RTTSource(pattern)
+    now_ns, now = monotonic_ns(), time()
+    for i in range(samples, 0, -1):
+        probe, sent = recorder._probe_sent()
+        sent = (now_ns - round(i * interval * 1000000000), now - i * interval)
+        recorder._handle_reply(probe, sent, next(source))
+    recorder.flush()
+    return recorder
+
+
+def ui_options(*args):
+    return build_parser().parse_args(list(args) + ["bench"])
+
+
+def bench_record(quick):
+    # throughput of recording results, from handing them over to the
+    # writer thread until they are in a snapshot
+    samples = 10000 if quick else 50000
+    results = {}
+    for pattern in PATTERNS:
+        recorder = PingRecorder("bench")
+        source = RTTSource(pattern)
+        started = perf_counter()
+        feed(recorder, source, samples)
+        recorder.flush()
+        elapsed = perf_counter() - started
+        results[f"{pattern}_samples_per_s"] = samples / elapsed
+        results[f"{pattern}_us_per_sample"] = elapsed / samples * 1000000
+    return results
+
+
+def bench_memory(quick):
+    # peak memory of a recorder with a full day of history at 1/s
+    samples = 20000 if quick else 86400
+    tracemalloc.start()
+    try:
+        recorder = filled_recorder(samples)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "samples": samples,
+        "peak_mb": peak / 1000000,
+        "retained_mb": current / 1000000,
+        "bytes_per_sample": current / len(recorder._results),
+    }
+
+
+def bench_stats(quick):
+    # cost of the queries the UI and report make on every frame
+    recorder = filled_recorder(10800 if quick else 86400)
+    repeat = 50 if quick else 200
+    results = {}
+    for timeframe, label in recorder.STATS_INTERVALS:
+        started = perf_counter_ns()
+        for i in range(repeat):
+            recorder.rtt_stats(timeframe)
+            recorder.packet_loss(timeframe)
+        results[f"{label}_us"] = (perf_counter_ns() - started) / repeat / 1000
+    # a timeframe without a window of its own
+    started = perf_counter_ns()
+    for i in range(repeat):
+        recorder.rtt_stats(45)
+        recorder.packet_loss(45)
+    results["unwindowed_45s_us"] = (perf_counter_ns() - started) / repeat / 1000
+    started = perf_counter_ns()
+    for i in range(repeat):
+        recorder.report_stats()
+    results["report_stats_us"] = (perf_counter_ns() - started) / repeat / 1000
+    return results
+
+
+def bench_histogram(quick):
+    source = RTTSource("outages")
+    rtts = [next(source) for i in range(20000 if quick else 100000)]
+    results = {}
+    for lines in (3, 10):
+        started = perf_counter_ns()
+        for rtt in rtts:
+            ui.histogram_column(rtt, lines, 300)
+        results[f"{lines}_lines_us_per_column"] = (perf_counter_ns() - started) / len(rtts) / 1000
+    return results
+
+
+class FrameTimer:
+    # Replaces ui.Wakeups: times each frame (from wakeup to the next
+    # wait) and quits the UI once `until` has passed.
+    def __init__(self, recorder, window, until):
+        self.recorder = recorder
+        self.window = window
+        self.until = until
+        self.frames = []
+        self._woken = perf_counter_ns()
+
+    def wait(self, timeout):
+        self.frames.append(perf_counter_ns() - self._woken)
+        if monotonic() >= self.until:
+            self.window.keys.append("q")
+            return
+        self.recorder.updated.wait(0.1 if timeout is None else min(timeout, 0.1))
+        self._woken = perf_counter_ns()
+
+
+def drive(recorder, rate, until, source):
+    # feed the recorder at `rate` samples/s from another thread
+    def run():
+        started = monotonic()
+        fed = 0
+        while True:
+            now = monotonic()
+            if now >= until:
+                break
+            due = int((now - started) * rate) - fed
+            feed(recorder, source, due)
+            fed += due
+            sleep(0.001)
+        state["fed"] = fed
+        state["elapsed"] = monotonic() - started
+
+    state = {}
+    thread = Thread(target=run)
+    thread.start()
+    return thread, state
+
+
+def bench_render(quick):
+    # per-frame cost of ui.main() on a fake window while the recorder
+    # is fed from another thread, competing for the GIL
+    duration = 1 if quick else 3
+    options = ui_options()
+    results = {}
+    for rate in RENDER_RATES:
+        recorder = PingRecorder("bench", interval=1 / rate)
+        recorder._probe_lock = lock = TimedLock()
+        publishes = []
+        recorder._publish = timed(recorder._publish, publishes)
+        window = FakeWindow()
+        until = monotonic() + duration
+        timer = FrameTimer(recorder, window, until)
+        thread, fed = drive(recorder, rate, until, RTTSource("lossy"))
+        with mock.patch.object(ui, "curses", fake_curses()):
+            ui.main(window, recorder, options, timer)
+        thread.join()
+        results[f"{rate}_fed_per_s"] = fed["fed"] / fed["elapsed"]
+        results[f"{rate}_frames_per_s"] = len(timer.frames) / duration
+        results.update(summarize(f"{rate}_frame", timer.frames))
+        results.update(summarize(f"{rate}_publish", publishes))
+        results.update(summarize(f"{rate}_probe_lock_hold", lock.holds))
+    return results
+
+
+def bench_engine(quick):
+    # ThreadEngine scheduling real threads against a fake icmplib.ping()
+    duration = 1 if quick else 3
+    results = {}
+    for rate in ENGINE_RATES:
+        recorder = PingRecorder(
+            "bench",
+            interval=0.001,
+            burst=rate // 1000,
+            timeout=0.1,
+            engine="thread",
+            hosts={"bench": ["192.0.2.1"]},
+        )
+        recorder._probe_lock = lock = TimedLock()
+        with mock.patch.object(engines, "ping", FakePing(RTTSource("lossy"))):
+            recorder.start()
+            sleep(duration)
+            recorder.stop()
+            while recorder._engine.in_flight:
+                sleep(0.01)
+        recorder.flush()
+        results[f"{rate}_probes_per_s"] = recorder.snapshot.counters.probes / duration
+        results[f"{rate}_missed_deadlines"] = recorder._engine.schedule.missed_deadlines
+        results.update(summarize(f"{rate}_probe_lock_hold", lock.holds))
+    return results
+
+
+BENCHMARKS = {
+    "record": bench_record,
+    "memory": bench_memory,
+    "stats": bench_stats,
+    "histogram": bench_histogram,
+    "render": bench_render,
+    "engine": bench_engine,
+}
@@ -0,0 +1,249 @@
+from collections import namedtuple
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .record import HEADER, RECORD, LogFormatError, read_header
+from .stats import PERCENTILES, Jitter, QuantileSketch, format_stats_table
+
+RangeStats = namedtuple(
+    'RangeStats',
+    ('count', 'lost', 'mean', 'median', 'min', 'max', 'percentiles'),
+)
+LossBurst = namedtuple('LossBurst', ('start', 'end', 'length'))
+
+if numpy is not None:
+    RECORD_DTYPE = numpy.dtype([
+        ('time', '<f8'),
+        ('rtt', '<f8'),
+        ('seq', '<u4'),
+        ('status', 'u1'),
+        ('padding', 'V3'),
+    ])
+
+
+class ProbeLogFile:
+    # Read-only view of a file written with --record. The file is mapped
+    # into memory, not read: with numpy, records are a structured array
+    # backed by the mapping and all statistics are vectorized. Without
+    # numpy, records are unpacked from the mapping on the fly and never
+    # all held in memory, so percentiles come from a QuantileSketch and
+    # are approximated to within 1%.
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < HEADER.size:
+            self._file.close()
+            raise LogFormatError(f"{path}: file too short for a header")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.target = read_header(self._mmap, path)
+        self.count = (size - HEADER.size) // RECORD.size
+        if numpy is not None:
+            self.records = numpy.frombuffer(
+                self._mmap,
+                dtype=RECORD_DTYPE,
+                count=self.count,
+                offset=HEADER.size,
+            )
+        else:
+            self.records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # views into the mapping have to go before it can be closed
+        self.records = None
+        self._mmap.close()
+        self._file.close()
+
+    def time(self, i):
+        return RECORD.unpack_from(self._mmap, HEADER.size + i * RECORD.size)[0]
+
+    def rtt(self, i):
+        return RECORD.unpack_from(self._mmap, HEADER.size + i * RECORD.size)[1]
+
+    @property
+    def first_time(self):
+        return self.time(0) if self.count else None
+
+    @property
+    def last_time(self):
+        return self.time(self.count - 1) if self.count else None
+
+    def index(self, timestamp, side='left'):
+        # first record at (side='left') or after (side='right') timestamp
+        if self.records is not None:
+            return int(numpy.searchsorted(self.records['time'], timestamp, side))
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            t = self.time(middle)
+            if t < timestamp or (side == 'right' and t == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range(self, start, end):
+        # record indices for start < time <= end
+        i = 0 if start is None else self.index(start, 'right')
+        j = self.count if end is None else self.index(end, 'right')
+        return i, max(i, j)
+
+    def rtts(self, i, j):
+        # RTTs of records i to j (NaN for lost pings), a view with numpy
+        if self.records is not None:
+            return self.records['rtt'][i:j]
+        return list(self._iter_rtts(i, j))
+
+    def _iter_rtts(self, i, j):
+        # a view of the mapping would keep it from being closed, so it's
+        # released once the generator is done (or dropped)
+        start = HEADER.size + i * RECORD.size
+        with memoryview(self._mmap)[start:start + (j - i) * RECORD.size] as view:
+            for record in RECORD.iter_unpack(view):
+                yield record[1]
+
+    def last_index(self, end, lost):
+        # index of the newest record before end that was lost (or not),
+        # scanning backwards in growing chunks so this stays cheap for
+        # recent events in a huge log
+        chunk = 4096
+        while end > 0:
+            start = max(0, end - chunk)
+            rtts = self.rtts(start, end)
+            if self.records is not None:
+                matches = numpy.flatnonzero(numpy.isnan(rtts) == lost)
+                if matches.size:
+                    return start + int(matches[-1])
+            else:
+                for k in range(len(rtts) - 1, -1, -1):
+                    if (rtts[k] != rtts[k]) == lost:
+                        return start + k
+            end = start
+            chunk *= 2
+        return None
+
+    def stats(self, start=None, end=None):
+        i, j = self._range(start, end)
+        if self.records is not None:
+            rtts = self.records['rtt'][i:j]
+            lost_mask = numpy.isnan(rtts)
+            lost = int(lost_mask.sum())
+            received = rtts[~lost_mask]
+            if not received.size:
+                return RangeStats(j - i, lost, None, None, None, None, {})
+            percentiles = dict(zip(
+                PERCENTILES,
+                (float(v) for v in numpy.percentile(received, PERCENTILES)),
+            ))
+            return RangeStats(
+                j - i,
+                lost,
+                float(received.mean()),
+                percentiles[50],
+                float(received.min()),
+                float(received.max()),
+                percentiles,
+            )
+        sketch = QuantileSketch()
+        lost = 0
+        total = 0.0
+        minimum = maximum = None
+        for rtt in self._iter_rtts(i, j):
+            if rtt != rtt:
+                lost += 1
+                continue
+            sketch.add(rtt)
+            total += rtt
+            if minimum is None or rtt < minimum:
+                minimum = rtt
+            if maximum is None or rtt > maximum:
+                maximum = rtt
+        if not sketch.count:
+            return RangeStats(j - i, lost, None, None, None, None, {})
+        percentiles = {p: sketch.quantile(p / 100) for p in PERCENTILES}
+        return RangeStats(
+            j - i,
+            lost,
+            total / sketch.count,
+            percentiles[50],
+            minimum,
+            maximum,
+            percentiles,
+        )
+
+    def loss_bursts(self, start=None, end=None, min_length=1):
+        # runs of consecutive lost pings
+        i, j = self._range(start, end)
+        if self.records is not None:
+            lost = numpy.isnan(self.records['rtt'][i:j]).astype(numpy.int8)
+            edges = numpy.diff(numpy.concatenate(([0], lost, [0])))
+            starts = numpy.flatnonzero(edges == 1)
+            ends = numpy.flatnonzero(edges == -1)
+            lengths = ends - starts
+            keep = lengths >= min_length
+            times = self.records['time']
+            return [
+                LossBurst(float(times[i + s]), float(times[i + e - 1]), int(n))
+                for s, e, n in zip(starts[keep], ends[keep], lengths[keep])
+            ]
+        bursts = []
+        burst_start = None
+        for k, rtt in enumerate(self._iter_rtts(i, j), start=i):
+            if rtt != rtt:
+                if burst_start is None:
+                    burst_start = k
+            elif burst_start is not None:
+                if k - burst_start >= min_length:
+                    bursts.append(LossBurst(self.time(burst_start), self.time(k - 1), k - burst_start))
+                burst_start = None
+        if burst_start is not None and j - burst_start >= min_length:
+            bursts.append(LossBurst(self.time(burst_start), self.time(j - 1), j - burst_start))
+        return bursts
+
+    def jitter(self, end):
+        # RFC 3550 jitter as of record end, older samples have decayed
+        # to nothing after a few hundred pings
+        jitter = Jitter()
+        for rtt in self.rtts(max(0, end - 512), end):
+            jitter.add(float(rtt))
+        return jitter.value
+
+    def stats_table(self, stats_intervals, end=None):
+        # (label, RangeStats) for each of stats_intervals ending at end
+        # (the last record by default) that is covered by the log
+        if not self.count:
+            return []
+        if end is None:
+            end = self.last_time
+        rows = []
+        for timeframe, label in stats_intervals:
+            if end - self.first_time < timeframe:
+                break
+            rows.append((label, self.stats(end - timeframe, end)))
+        return rows
+
+
+def rtt_stats(stats):
+    # RangeStats in the format of PingRecorder.rtt_stats()
+    if stats.mean is None:
+        return None
+    return (stats.mean, stats.median, stats.min, stats.max) + \
+        tuple(stats.percentiles[p] for p in PERCENTILES[1:])
+
+
+def format_range_stats_table(rows):
+    return format_stats_table(
+        (label, stats.lost / stats.count if stats.count else 1.0, rtt_stats(stats))
+        for label, stats in rows
+    )
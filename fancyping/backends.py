@@ -0,0 +1,470 @@
+from array import array
+from errno import ECONNREFUSED, EINPROGRESS
+from socket import (
+    AF_INET,
+    AF_INET6,
+    CMSG_SPACE,
+    IPPROTO_IP,
+    IPPROTO_IPV6,
+    MSG_ERRQUEUE,
+    SO_ERROR,
+    SO_LINGER,
+    SOCK_DGRAM,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    inet_ntop,
+    socket,
+)
+from struct import pack, unpack_from
+from time import monotonic_ns, time, time_ns
+
+from icmplib import (
+    ICMPLibError,
+    ICMPReply,
+    ICMPRequest,
+    ICMPSocketError,
+    ICMPv4Socket,
+    ICMPv6Socket,
+    TimeExceeded,
+)
+from icmplib.utils import unique_identifier
+
+# Probe backends send probes for AsyncEngines on the scheduler's event
+# loop. send(engine, address) must report back on every probe number it
+# gets from engine.recorder._probe_sent(), by calling _handle_reply()
+# or _handle_error(), and keep engine.in_flight up to date.
+
+PROTOCOLS = ("icmp", "tcp", "udp")
+DEFAULT_PORTS = {
+    "tcp": 80,
+    # RFC 862 echo
+    "udp": 7,
+}
+# from linux/in.h and linux/in6.h, missing from the socket module
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+SO_EE_ORIGIN_ICMP = 2
+SO_EE_ORIGIN_ICMP6 = 3
+# from asm-generic/socket.h, same as SCM_TIMESTAMPNS
+SO_TIMESTAMPNS = 35
+# from linux/in.h and linux/in6.h: kernel default, and DF set no matter
+# what the kernel thinks the path MTU is
+IP_MTU_DISCOVER = 10
+IPV6_MTU_DISCOVER = 23
+PMTUDISC_WANT = 1
+PMTUDISC_PROBE = 3
+
+
+class ICMPBackend:
+    # One long-lived ICMP socket used by any number of AsyncEngines.
+    # Replies are matched to requests by identifier and sequence number,
+    # sequence numbers being unique across all targets on the socket.
+    # Probes from recorders with a ttl measure the hop at that distance:
+    # time exceeded counts as a reply from whoever sent it. Probes from
+    # recorders with dont_fragment are sent with DF set.
+    SEQUENCES = 0x10000
+
+    def __init__(self, scheduler, family):
+        self.scheduler = scheduler
+        socket_class = ICMPv6Socket if family == 6 else ICMPv4Socket
+        self.sock = socket_class(privileged=scheduler.privileged)
+        self.sock.blocking = False
+        try:
+            # see _received_ns()
+            self.sock.sock.setsockopt(SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        except OSError:
+            pass
+        self.family = family
+        # set once ICMP errors are queued for us, see _receive_errors()
+        self.recverr = False
+        # whether the socket is currently set to send with DF
+        self.dont_fragment = False
+        self.id = unique_identifier()
+        self.sequence = 0
+        # sequence -> (engine, probe, (monotonic_ns, time), timeout handle)
+        self.pending = {}
+        # The last request sent with each sequence number, kept after it
+        # completed to tell late and duplicate replies from stray ones.
+        # Fixed size arrays indexed by sequence, so lookups are O(1) and
+        # memory doesn't grow with the packet rate.
+        self.engines = [None] * self.SEQUENCES
+        self.sent_ns = array('q', bytes(8 * self.SEQUENCES))
+        self.answered = bytearray(self.SEQUENCES)
+        scheduler.loop.add_reader(self.sock.sock, self._receive)
+
+    def close(self):
+        # probes still waiting won't get a reply anymore
+        for sequence in list(self.pending):
+            self.pending[sequence][3].cancel()
+            self._timeout(sequence)
+        self.scheduler.loop.remove_reader(self.sock.sock)
+        self.sock.close()
+
+    def _next_sequence(self):
+        # Sequence numbers wrap around once pings/s * timeout exceeds
+        # SEQUENCES, skip those still waiting for a reply. Only as many
+        # as are pending can be in the way.
+        for i in range(len(self.pending) + 1):
+            sequence = (self.sequence + i) % self.SEQUENCES
+            if sequence not in self.pending:
+                return sequence
+        raise ICMPLibError("all ICMP sequence numbers are in use, lower the rate or timeout")
+
+    def send(self, engine, address):
+        recorder = engine.recorder
+        try:
+            sequence = self._next_sequence()
+        except ICMPLibError as exc:
+            recorder._handle_error(exc)
+            return
+        request = ICMPRequest(
+            address,
+            self.id,
+            sequence,
+            payload_size=recorder.payload_size,
+            ttl=recorder.ttl or 64,
+        )
+        self.sequence = (sequence + 1) % self.SEQUENCES
+        if (recorder.ttl is not None or recorder.dont_fragment) and not self.recverr:
+            # time exceeded and fragmentation needed
+            self._enable_recverr()
+        if recorder.dont_fragment != self.dont_fragment:
+            self._set_dont_fragment(recorder.dont_fragment)
+        probe, sent = recorder._probe_sent()
+        try:
+            try:
+                self.sock.send(request)
+            except ICMPSocketError:
+                if not self.recverr:
+                    raise
+                # an ICMP error for an earlier probe fails the next send
+                # once, it's already waiting for _receive_errors()
+                self.sock.send(request)
+        except Exception as exc:
+            recorder._handle_error(exc, probe)
+            return
+        # send() may have replaced the identifier (see _receive())
+        self.id = request.id
+        engine.in_flight += 1
+        self.engines[sequence] = engine
+        self.sent_ns[sequence] = sent[0]
+        self.answered[sequence] = False
+        self.pending[sequence] = (
+            engine,
+            probe,
+            sent,
+            self.scheduler.loop.call_later(recorder.timeout, self._timeout, sequence),
+        )
+
+    def _timeout(self, sequence):
+        engine, probe, sent, handle = self.pending.pop(sequence)
+        engine.in_flight -= 1
+        engine.recorder._handle_reply(probe, sent, None)
+
+    def _enable_recverr(self):
+        # Raw sockets see time exceeded and other ICMP errors like any
+        # other packet, unprivileged ones only get them on the socket's
+        # error queue, and only if asked to.
+        if self.sock.sock.type != SOCK_DGRAM:
+            return
+        if self.family == 6:
+            self.sock.sock.setsockopt(IPPROTO_IPV6, IPV6_RECVERR, 1)
+        else:
+            self.sock.sock.setsockopt(IPPROTO_IP, IP_RECVERR, 1)
+        self.recverr = True
+
+    def _received_ns(self, ancdata):
+        # When the kernel got the packet, on the monotonic clock. Replies
+        # may wait in the socket while we're busy sending (a whole path
+        # at once, or lots of targets), that shouldn't count as RTT.
+        now_ns = monotonic_ns()
+        for level, cmsg_type, data in ancdata:
+            if level == SOL_SOCKET and cmsg_type == SO_TIMESTAMPNS and len(data) >= 16:
+                # struct timespec on the wall clock
+                seconds, nanoseconds = unpack_from("@ll", data)
+                return now_ns - max(0, time_ns() - seconds * 1000000000 - nanoseconds)
+        return now_ns
+
+    def _set_dont_fragment(self, dont_fragment):
+        value = PMTUDISC_PROBE if dont_fragment else PMTUDISC_WANT
+        if self.family == 6:
+            self.sock.sock.setsockopt(IPPROTO_IPV6, IPV6_MTU_DISCOVER, value)
+        else:
+            self.sock.sock.setsockopt(IPPROTO_IP, IP_MTU_DISCOVER, value)
+        self.dont_fragment = dont_fragment
+
+    def _receive(self):
+        while True:
+            try:
+                packet, ancdata, flags, source = self.sock.sock.recvmsg(65535, CMSG_SPACE(16))
+                received_ns = self._received_ns(ancdata)
+            except OSError:
+                # includes BlockingIOError once drained
+                break
+            # _parse_reply deals with the IP header being present or not
+            # depending on socket type and platform
+            reply = self.sock._parse_reply(packet, source[0], time())
+            if reply is None or reply.type == self.sock._ICMP_ECHO_REQUEST:
+                # on raw sockets we see our own requests to localhost
+                continue
+            self._reply(reply, received_ns)
+        if self.recverr:
+            self._receive_errors()
+
+    def _receive_errors(self):
+        # Each message on the error queue is the start of the request
+        # that caused it, and a sock_extended_err followed by the address
+        # of whoever sent the ICMP error.
+        while True:
+            try:
+                packet, ancdata, flags, address = self.sock.sock.recvmsg(
+                    65535,
+                    CMSG_SPACE(16) + CMSG_SPACE(64),
+                    MSG_ERRQUEUE,
+                )
+                received_ns = self._received_ns(ancdata)
+            except OSError:
+                return
+            for level, cmsg_type, data in ancdata:
+                if level not in (IPPROTO_IP, IPPROTO_IPV6) or len(data) < 24 or len(packet) < 8:
+                    continue
+                # skipping ee_errno
+                origin, icmp_type, code = unpack_from("=4xBBB", data)
+                if origin not in (SO_EE_ORIGIN_ICMP, SO_EE_ORIGIN_ICMP6):
+                    # local errors, the probe will time out
+                    continue
+                offender = data[16:]
+                if self.family == 6:
+                    source = inet_ntop(AF_INET6, offender[8:24])
+                else:
+                    source = inet_ntop(AF_INET, offender[4:8])
+                id, sequence = unpack_from("!2H", packet, 4)
+                self._reply(
+                    ICMPReply(source, self.family, id, sequence, icmp_type, code, len(packet), time()),
+                    received_ns,
+                )
+
+    def _reply(self, reply, received_ns):
+        # the kernel may have replaced our identifier in send(),
+        # which icmplib then updated on the request
+        if reply.id != self.id:
+            return
+        sequence = reply.sequence
+        engine = self.engines[sequence]
+        if engine is None:
+            return
+        recorder = engine.recorder
+        try:
+            reply.raise_for_status()
+        except TimeExceeded:
+            answered = recorder.ttl is not None
+        except ICMPLibError:
+            answered = False
+        else:
+            answered = True
+        if self.answered[sequence]:
+            recorder._handle_duplicate()
+            return
+        self.answered[sequence] = True
+        try:
+            engine, probe, sent, handle = self.pending.pop(sequence)
+        except KeyError:
+            # timed out already
+            if answered:
+                recorder._handle_late((received_ns - self.sent_ns[sequence]) / 1000000)
+            return
+        handle.cancel()
+        engine.in_flight -= 1
+        if answered:
+            recorder._handle_reply(probe, sent, (received_ns - sent[0]) / 1000000, reply.source)
+        else:
+            # like icmplib.ping(), count error replies as lost
+            recorder._handle_reply(probe, sent, None)
+
+
+class TCPBackend:
+    # Measures how long it takes to open a TCP connection, i.e. from SYN
+    # to SYN/ACK. A RST counts as a reply too: the host is there, just
+    # not listening on the port. Connections are reset right away.
+    def __init__(self, scheduler, family):
+        self.scheduler = scheduler
+        self.family = AF_INET6 if family == 6 else AF_INET
+        # socket -> (engine, probe, (monotonic_ns, time), timeout handle)
+        self.pending = {}
+
+    def close(self):
+        # probes still waiting won't get a reply anymore
+        for sock in list(self.pending):
+            self.pending[sock][3].cancel()
+            self._timeout(sock)
+
+    def send(self, engine, address):
+        recorder = engine.recorder
+        try:
+            sock = socket(self.family, SOCK_STREAM)
+        except OSError as exc:
+            recorder._handle_error(exc)
+            return
+        sock.setblocking(False)
+        # close() sends a RST instead of leaving sockets in TIME_WAIT
+        sock.setsockopt(SOL_SOCKET, SO_LINGER, pack("ii", 1, 0))
+        probe, sent = recorder._probe_sent()
+        try:
+            error = sock.connect_ex((address, recorder.port))
+        except OSError as exc:
+            sock.close()
+            recorder._handle_error(exc, probe)
+            return
+        engine.in_flight += 1
+        self.pending[sock] = (
+            engine,
+            probe,
+            sent,
+            self.scheduler.loop.call_later(recorder.timeout, self._timeout, sock),
+        )
+        if error == EINPROGRESS:
+            self.scheduler.loop.add_writer(sock, self._connected, sock)
+        else:
+            # localhost may not need to wait
+            self._connected(sock, error)
+
+    def _finish(self, sock):
+        engine, probe, sent, handle = self.pending.pop(sock)
+        self.scheduler.loop.remove_writer(sock)
+        sock.close()
+        engine.in_flight -= 1
+        return engine, probe, sent, handle
+
+    def _timeout(self, sock):
+        engine, probe, sent, handle = self._finish(sock)
+        engine.recorder._handle_reply(probe, sent, None)
+
+    def _connected(self, sock, error=None):
+        received_ns = monotonic_ns()
+        if error is None:
+            error = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        engine, probe, sent, handle = self._finish(sock)
+        handle.cancel()
+        if error in (0, ECONNREFUSED):
+            engine.recorder._handle_reply(probe, sent, (received_ns - sent[0]) / 1000000)
+        else:
+            # like ICMP error replies, count unreachable and such as lost
+            engine.recorder._handle_reply(probe, sent, None)
+
+
+class UDPBackend:
+    # Sends datagrams to an echo service and waits for them to come
+    # back, matched by a sequence number at the start of the payload.
+    # Each target gets a connected socket so ICMP port unreachable is
+    # reported to us, which counts as a reply like a RST does for TCP.
+    SEQUENCES = 0x100000000
+
+    def __init__(self, scheduler, family):
+        self.scheduler = scheduler
+        self.family = AF_INET6 if family == 6 else AF_INET
+        self.sequence = 0
+        # engine -> (socket, address)
+        self.sockets = {}
+        # engine -> {sequence: (probe, (monotonic_ns, time), timeout handle)}
+        # in the order they were sent
+        self.pending = {}
+
+    def close(self):
+        for engine in list(self.sockets):
+            self._close(engine)
+
+    def _close(self, engine):
+        sock, address = self.sockets.pop(engine)
+        # probes still waiting won't get a reply anymore
+        for probe, sent, handle in self.pending.pop(engine).values():
+            handle.cancel()
+            engine.in_flight -= 1
+            engine.recorder._handle_reply(probe, sent, None)
+        self.scheduler.loop.remove_reader(sock)
+        sock.close()
+
+    def _socket(self, engine, address):
+        try:
+            sock, connected = self.sockets[engine]
+        except KeyError:
+            pass
+        else:
+            if connected == address:
+                return sock
+            self._close(engine)
+        sock = socket(self.family, SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect((address, engine.recorder.port))
+        except OSError:
+            sock.close()
+            raise
+        self.sockets[engine] = (sock, address)
+        self.pending[engine] = {}
+        self.scheduler.loop.add_reader(sock, self._receive, engine)
+        return sock
+
+    def send(self, engine, address):
+        recorder = engine.recorder
+        try:
+            sock = self._socket(engine, address)
+        except OSError as exc:
+            recorder._handle_error(exc)
+            return
+        sequence = self.sequence
+        self.sequence = (sequence + 1) % self.SEQUENCES
+        payload = pack("!I", sequence).ljust(recorder.payload_size, b"\0")
+        probe, sent = recorder._probe_sent()
+        try:
+            sock.send(payload)
+        except OSError as exc:
+            recorder._handle_error(exc, probe)
+            return
+        engine.in_flight += 1
+        self.pending[engine][sequence] = (
+            probe,
+            sent,
+            self.scheduler.loop.call_later(recorder.timeout, self._timeout, engine, sequence),
+        )
+
+    def _timeout(self, engine, sequence):
+        probe, sent, handle = self.pending[engine].pop(sequence)
+        engine.in_flight -= 1
+        engine.recorder._handle_reply(probe, sent, None)
+
+    def _receive(self, engine):
+        sock = self.sockets[engine][0]
+        pending = self.pending[engine]
+        while True:
+            try:
+                payload = sock.recv(65535)
+                received_ns = monotonic_ns()
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                # ICMP errors don't say which datagram caused them,
+                # blame the oldest one still waiting
+                if not pending:
+                    continue
+                received_ns = monotonic_ns()
+                probe, sent, handle = pending.pop(next(iter(pending)))
+                rtt = (received_ns - sent[0]) / 1000000 if exc.errno == ECONNREFUSED else None
+            else:
+                if len(payload) < 4:
+                    continue
+                try:
+                    probe, sent, handle = pending.pop(unpack_from("!I", payload)[0])
+                except KeyError:
+                    # timed out already or not ours
+                    continue
+                rtt = (received_ns - sent[0]) / 1000000
+            handle.cancel()
+            engine.in_flight -= 1
+            engine.recorder._handle_reply(probe, sent, rtt)
+
+
+BACKENDS = {
+    "icmp": ICMPBackend,
+    "tcp": TCPBackend,
+    "udp": UDPBackend,
+}
@@ -1,22 +1,42 @@
-from argparse import ArgumentParser, RawTextHelpFormatter
-from os import environ, getcwd
+from argparse import ArgumentParser, ArgumentTypeError, RawTextHelpFormatter
+from atexit import register
+from os import cpu_count, environ, getcwd
+from signal import SIGTERM, signal
 from sys import argv, exit
 
 from . import VERSION_STRING
-from .icmp import PingRecorder
-from .ui import run_ui
+from .backends import PROTOCOLS
+from .engines import ENGINES, MISSED_POLICIES, ProbeScheduler, RateLimit
+from .icmp import PingRecorder, UpdateEvent
+from .metrics import MetricsExporter, listen_address
+from .path import MAX_HOPS, Path
+from .profiling import PROFILE
+from .record import LogFormatError
+from .reports import REPORT_FORMATS
+from .resolver import read_hosts
+from .sweep import Sweep, parse_sizes
+from .ui import run_grid_ui, run_ui
 
 
 HOTKEY_HELP = """
 HOTKEYS
 
  +/-  change stats interval
+  P   show/hide what fancyping measures about itself
   Q   quit
-  R   write report to current directory (timestamps at response)
+  R   write report to current directory (timestamps at send)
   X   reset stats
+ </>  step back/forward by the stats interval (--replay only)
 """
 
 
+def sweep_sizes(value):
+    try:
+        return parse_sizes(value)
+    except ValueError as exc:
+        raise ArgumentTypeError(str(exc))
+
+
 def build_parser():
     parser = ArgumentParser(
         prog="fancyping",
@@ -25,8 +45,9 @@ def build_parser():
         formatter_class=RawTextHelpFormatter,
     )
     parser.add_argument(
-        'target',
+        'targets',
         metavar="TARGET",
+        nargs='*',
         type=str,
     )
     parser.add_argument(
@@ -43,6 +64,15 @@ def build_parser():
         dest='anim_down',
         help="enable animation while TARGET is down",
     )
+    parser.add_argument(
+        "-b",
+        "--burst",
+        default=1,
+        dest='burst',
+        help="send this many pings back to back every interval (defaults to 1)",
+        metavar="INT",
+        type=int,
+    )
     parser.add_argument(
         "-c",
         "--count",
@@ -52,6 +82,17 @@ def build_parser():
         metavar="INT",
         type=int,
     )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=sorted(ENGINES),
+        default="thread",
+        dest='engine',
+        metavar="ENGINE",
+        help="how to send pings (defaults to thread):\n"
+             "  thread  one thread and socket per ping\n"
+             "  async   a single thread and socket for all pings",
+    )
     parser.add_argument(
         "-f",
         "--color-up",
@@ -125,6 +166,16 @@ def build_parser():
         metavar="INT",
         type=int,
     )
+    parser.add_argument(
+        "-T",
+        "--targets-file",
+        dest='targets_file',
+        help="read additional targets from FILE, one per line\n"
+             "(multiple targets are shown as a grid and always use\n"
+             "the async engine)",
+        metavar="FILE",
+        type=str,
+    )
     parser.add_argument(
         "-t",
         "--timeout",
@@ -134,6 +185,155 @@ def build_parser():
         metavar="FLOAT",
         type=float,
     )
+    parser.add_argument(
+        "--adaptive",
+        dest='adaptive',
+        help="ping as often as every FLOAT seconds while pings are lost or\n"
+             "RTTs change, backing off to -i while things are stable",
+        metavar="FLOAT",
+        type=float,
+    )
+    parser.add_argument(
+        "--df",
+        action='store_true',
+        dest='dont_fragment',
+        help="set don't fragment on pings, so ones too large for the\n"
+             "path fail instead of being fragmented (icmp only)",
+    )
+    parser.add_argument(
+        "--headless",
+        action='store_true',
+        dest='headless',
+        help="don't show any UI, just ping until done (see -c) or\n"
+             "interrupted and print stats",
+    )
+    parser.add_argument(
+        "--hosts-file",
+        dest='hosts_file',
+        help="look up target names in FILE (in /etc/hosts format)\n"
+             "before asking DNS",
+        metavar="FILE",
+        type=str,
+    )
+    parser.add_argument(
+        "--listen",
+        dest='listen',
+        help="serve Prometheus metrics on http://[HOST]:PORT/metrics\n"
+             "(e.g. :9374 for all interfaces)",
+        metavar="[HOST]:PORT",
+        type=listen_address,
+    )
+    parser.add_argument(
+        "--max-hops",
+        default=MAX_HOPS,
+        dest='max_hops',
+        help=f"probe up to this many hops with --path (defaults to {MAX_HOPS})",
+        metavar="INT",
+        type=int,
+    )
+    parser.add_argument(
+        "--max-rate",
+        dest='max_rate',
+        help="never send more than FLOAT pings per second (all targets\n"
+             "combined), skipping pings over the limit",
+        metavar="FLOAT",
+        type=float,
+    )
+    parser.add_argument(
+        "--missed",
+        choices=MISSED_POLICIES,
+        default="catchup",
+        dest='missed',
+        help="what to do when pings could not be sent on time (defaults to catchup):\n"
+             "  catchup  send the missed pings right away\n"
+             "  skip     send one ping and continue with the next regular slot",
+        metavar="POLICY",
+    )
+    parser.add_argument(
+        "--path",
+        action='store_true',
+        dest='path',
+        help="also probe every hop on the way to TARGET, like mtr\n"
+             "(single TARGET and icmp only)",
+    )
+    parser.add_argument(
+        "--port",
+        dest='port',
+        help="port for tcp and udp probes (defaults to 80 for tcp,\n"
+             "7 for udp)",
+        metavar="INT",
+        type=int,
+    )
+    parser.add_argument(
+        "--profile-out",
+        dest='profile_out',
+        help="write what fancyping measured about itself (scheduler lag,\n"
+             "frame times, ...) to FILE as JSON on exit (with --workers,\n"
+             "each worker process also writes FILE.WORKER)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=PROTOCOLS,
+        default="icmp",
+        dest='protocol',
+        help="how to probe TARGET (defaults to icmp):\n"
+             "  icmp  echo requests\n"
+             "  tcp   time to connect (or be refused)\n"
+             "  udp   datagrams sent to an echo service\n"
+             "(tcp and udp always use the async engine)",
+        metavar="PROTOCOL",
+    )
+    parser.add_argument(
+        "--re-resolve",
+        dest='re_resolve',
+        help="look up target addresses again every FLOAT seconds\n"
+             "(defaults to only once at start)",
+        metavar="FLOAT",
+        type=float,
+    )
+    parser.add_argument(
+        "--record",
+        dest='record',
+        help="append every ping to FILE in a compact binary format\n"
+             "(with multiple targets, to FILE.TARGET for each)",
+        metavar="FILE",
+        type=str,
+    )
+    parser.add_argument(
+        "--replay",
+        dest='replay',
+        help="show a FILE written with --record instead of pinging\n"
+             "(no TARGET needed)",
+        metavar="FILE",
+        type=str,
+    )
+    parser.add_argument(
+        "--report-format",
+        choices=REPORT_FORMATS,
+        default="text",
+        dest='report_format',
+        help="file format for reports written with R (text, csv or jsonl,\n"
+             "defaults to text)",
+        metavar="FORMAT",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        dest='workers',
+        help="spread multiple targets over INT processes, each with its\n"
+             "own sockets (defaults to 1, 0 for one per CPU core)",
+        metavar="INT",
+        type=int,
+    )
+    parser.add_argument(
+        "--sweep",
+        dest='sweep',
+        help="also ping with each of these payload sizes (comma separated),\n"
+             "showing loss per size (single TARGET and icmp only)",
+        metavar="SIZES",
+        type=sweep_sizes,
+    )
     parser.add_argument(
         "--version",
         action='version',
@@ -148,19 +348,217 @@ def main(*args, **kwargs):
 
     parser = build_parser()
     pargs = parser.parse_args(args)
+    if pargs.profile_out:
+        # however we end up exiting
+        register(PROFILE.write, pargs.profile_out)
+
+    if pargs.replay:
+        main_replay(pargs)
+        return
+
+    targets = list(pargs.targets)
+    if pargs.targets_file:
+        try:
+            with open(pargs.targets_file) as f:
+                for line in f:
+                    line = line.split("#", 1)[0].strip()
+                    if line:
+                        targets.append(line)
+        except OSError as exc:
+            exit(f"fancyping: {exc}")
+    if not targets:
+        parser.error("no TARGET given")
+    if pargs.burst < 1:
+        parser.error("--burst must be at least 1")
+    if pargs.port is not None and pargs.protocol == "icmp":
+        parser.error("--port needs --protocol tcp or udp")
+    for option, given in (("--path", pargs.path), ("--sweep", pargs.sweep)):
+        if given and (len(targets) > 1 or pargs.protocol != "icmp"):
+            parser.error(f"{option} needs a single TARGET and --protocol icmp")
+    if pargs.dont_fragment and pargs.protocol != "icmp":
+        parser.error("--df needs --protocol icmp")
+    if not 0 < pargs.max_hops < 256:
+        parser.error("--max-hops must be between 1 and 255")
+    if pargs.workers < 0:
+        parser.error("--workers must not be negative")
+    pargs.workers = min(pargs.workers or cpu_count() or 1, len(targets))
+    pargs.hosts = None
+    if pargs.hosts_file:
+        try:
+            pargs.hosts = read_hosts(pargs.hosts_file)
+        except OSError as exc:
+            exit(f"fancyping: {exc}")
+    pargs.rate_limit = None if pargs.max_rate is None else RateLimit(pargs.max_rate, pargs.burst)
+    if len(targets) > 1:
+        main_multi(targets, pargs)
+        return
 
     ping_recorder = PingRecorder(
-        pargs.target,
+        targets[0],
         count=pargs.count,
         interval=pargs.interval,
         payload_size=pargs.payload_size,
         timeout=pargs.timeout,
+        engine=pargs.engine,
+        missed=pargs.missed,
+        record=pargs.record,
+        burst=pargs.burst,
+        adaptive=pargs.adaptive,
+        rate_limit=pargs.rate_limit,
+        protocol=pargs.protocol,
+        port=pargs.port,
+        resolve_interval=pargs.re_resolve,
+        hosts=pargs.hosts,
+        dont_fragment=pargs.dont_fragment,
+        loss_tolerance=pargs.loss_tolerance,
     )
+    # shown next to the box and reported along with it
+    panels = []
+    if pargs.path:
+        panels.append(Path(ping_recorder, pargs.max_hops))
+    if pargs.sweep:
+        panels.append(Sweep(ping_recorder, pargs.sweep, pargs.dont_fragment))
+    ping_recorder.panels = panels
+    exporter = start_exporter([ping_recorder], pargs)
     ping_recorder.start()
+    for panel in panels:
+        panel.start()
     try:
-        run_ui(ping_recorder, pargs)
+        if pargs.headless:
+            run_headless([ping_recorder])
+        else:
+            run_ui(ping_recorder, pargs, panels)
     except KeyboardInterrupt:
         pass
     finally:
         ping_recorder.stop()
+        for panel in panels:
+            panel.stop()
+        if exporter is not None:
+            exporter.stop()
     print(ping_recorder.report_stats())
+    for panel in panels:
+        print("\n" + panel.report())
+
+
+def start_exporter(ping_recorders, pargs):
+    if pargs.listen is None:
+        return None
+    try:
+        exporter = MetricsExporter(ping_recorders, pargs.listen, pargs.loss_tolerance)
+    except OSError as exc:
+        # recorders may already have started writing logs
+        for ping_recorder in ping_recorders:
+            ping_recorder.stop()
+        exit(f"fancyping: can't listen on {pargs.listen[0]}:{pargs.listen[1]}: {exc}")
+    exporter.start()
+    return exporter
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_headless(ping_recorders):
+    # shut down cleanly when running as a service
+    signal(SIGTERM, interrupt)
+    for ping_recorder in ping_recorders:
+        # with a timeout, so signals delivered to other threads are
+        # still handled in this one
+        while not ping_recorder.stopped.wait(1):
+            pass
+
+
+def main_replay(pargs):
+    # imported here so numpy (if installed) is only loaded for replays
+    from .replay import LogReplay
+
+    try:
+        log_replay = LogReplay(pargs.replay)
+    except (OSError, LogFormatError) as exc:
+        exit(f"fancyping: {exc}")
+    if not pargs.headless:
+        try:
+            run_ui(log_replay, pargs)
+        except KeyboardInterrupt:
+            pass
+    print(log_replay.report_stats())
+
+
+def multi_recorders(targets, pargs, scheduler):
+    # one UpdateEvent for all, see grid_main()
+    updated = UpdateEvent()
+    return [
+        PingRecorder(
+            target,
+            count=pargs.count,
+            interval=pargs.interval,
+            payload_size=pargs.payload_size,
+            timeout=pargs.timeout,
+            scheduler=scheduler,
+            missed=pargs.missed,
+            record=None if pargs.record is None else f"{pargs.record}.{target}",
+            burst=pargs.burst,
+            adaptive=pargs.adaptive,
+            rate_limit=pargs.rate_limit,
+            protocol=pargs.protocol,
+            port=pargs.port,
+            resolve_interval=pargs.re_resolve,
+            hosts=pargs.hosts,
+            dont_fragment=pargs.dont_fragment,
+            loss_tolerance=pargs.loss_tolerance,
+            updated=updated,
+        )
+        for target in targets
+    ]
+
+
+def main_multi(targets, pargs):
+    if pargs.workers > 1:
+        main_sharded(targets, pargs)
+        return
+    scheduler = ProbeScheduler()
+    ping_recorders = multi_recorders(targets, pargs, scheduler)
+    exporter = start_exporter(ping_recorders, pargs)
+    for ping_recorder in ping_recorders:
+        ping_recorder.start()
+    scheduler.start()
+    try:
+        if pargs.headless:
+            run_headless(ping_recorders)
+        else:
+            run_grid_ui(ping_recorders, pargs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for ping_recorder in ping_recorders:
+            ping_recorder.stop()
+        scheduler.stop()
+        if exporter is not None:
+            exporter.stop()
+    for ping_recorder in ping_recorders:
+        print(ping_recorder.target)
+        print(ping_recorder.report_stats() + "\n")
+
+
+def main_sharded(targets, pargs):
+    # imported here so multiprocessing is only loaded when needed
+    from .shards import ShardPool
+
+    pool = ShardPool(targets, pargs.workers, pargs)
+    pool.start()
+    exporter = start_exporter(pool.recorders, pargs)
+    try:
+        if pargs.headless:
+            run_headless(pool.recorders)
+        else:
+            run_grid_ui(pool.recorders, pargs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        if exporter is not None:
+            exporter.stop()
+    for ping_recorder in pool.recorders:
+        print(ping_recorder.target)
+        print(ping_recorder.report_stats() + "\n")
@@ -0,0 +1,305 @@
+import asyncio
+from threading import Lock, Thread
+from time import monotonic, monotonic_ns
+
+from icmplib import is_ipv6_address, ping
+
+from .backends import BACKENDS
+from .profiling import PROFILE
+
+MISSED_POLICIES = ("catchup", "skip")
+# never send more than this many pings at once when catching up
+CATCHUP_LIMIT = 1000
+
+
+class AdaptiveInterval:
+    # Probes every min_interval as soon as a ping is lost or an RTT falls
+    # outside the usual range, then doubles the interval back up to
+    # max_interval after every stable_after unremarkable replies. The
+    # usual range is SRTT ± max(G, 4 * RTTVAR) as in RFC 6298.
+    GRANULARITY = 1.0  # ms
+
+    def __init__(self, min_interval, max_interval, stable_after=10):
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.stable_after = stable_after
+        self.interval = max_interval
+        self._srtt = None
+        self._rttvar = None
+        self._stable = 0
+
+    def update(self, rtt):
+        if rtt is None:
+            changed = True
+        elif self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
+            changed = False
+        else:
+            changed = abs(rtt - self._srtt) > max(self.GRANULARITY, 4 * self._rttvar)
+            self._rttvar += (abs(self._srtt - rtt) - self._rttvar) / 4
+            self._srtt += (rtt - self._srtt) / 8
+        if changed:
+            self.interval = self.min_interval
+            self._stable = 0
+        else:
+            self._stable += 1
+            if self._stable >= self.stable_after:
+                self.interval = min(self.interval * 2, self.max_interval)
+                self._stable = 0
+
+
+class RateLimit:
+    # Token bucket capping the total rate of pings across all engines
+    # sharing it. Pings over the limit are skipped, not delayed.
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def take(self, count):
+        # number of pings (up to count) that may be sent now
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            allowed = min(count, int(self._tokens))
+            self._tokens -= allowed
+            return allowed
+
+
+class Schedule:
+    # Absolute send deadlines on the monotonic clock, so time spent
+    # sending doesn't accumulate and the rate stays at 1/interval. With
+    # a policy, each deadline is the last one plus whatever the interval
+    # is by then.
+    def __init__(
+        self,
+        interval,
+        missed="catchup",
+        start_ns=None,
+        burst=1,
+        policy=None,
+        rate_limit=None,
+    ):
+        self.interval = interval
+        self.missed = missed
+        self.burst = burst
+        self.policy = policy
+        self.rate_limit = rate_limit
+        if start_ns is None:
+            start_ns = monotonic_ns()
+        # the deadline pings were last sent for
+        self.last_ns = start_ns - self.interval_ns
+        # deadlines that had already passed when the next one was due
+        self.missed_deadlines = 0
+        # pings not sent because of rate_limit
+        self.throttled = 0
+
+    @property
+    def interval_ns(self):
+        interval = self.interval if self.policy is None else self.policy.interval
+        return max(1, round(interval * 1000000000))
+
+    def due(self):
+        # number of pings to send now
+        now = monotonic_ns()
+        interval_ns = self.interval_ns
+        next_ns = self.last_ns + interval_ns
+        if now < next_ns:
+            return 0
+        PROFILE.schedule_lag.add((now - next_ns) / 1000)
+        slots = (now - next_ns) // interval_ns + 1
+        self.last_ns = next_ns + (slots - 1) * interval_ns
+        self.missed_deadlines += slots - 1
+        if self.missed == "skip":
+            slots = 1
+        count = min(slots * self.burst, CATCHUP_LIMIT)
+        if self.rate_limit is not None:
+            allowed = self.rate_limit.take(count)
+            self.throttled += count - allowed
+            count = allowed
+        return count
+
+    def wait(self):
+        # seconds until the next deadline
+        return max(0, self.last_ns + self.interval_ns - monotonic_ns()) / 1000000000
+
+
+class ThreadEngine:
+    # one short-lived thread and socket per ping
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.in_flight = 0
+        self._in_flight_lock = Lock()
+        # set once started
+        self.schedule = None
+
+    def start(self):
+        self.schedule = self.recorder.make_schedule()
+        Thread(target=self._schedule_pings).start()
+
+    def stop(self):
+        pass
+
+    def _schedule_pings(self):
+        schedule = self.schedule
+        while not self.recorder.stopped.wait(schedule.wait()):
+            count = schedule.due()
+            if self.recorder.address is None:
+                # not resolved (yet), the resolver reports why
+                continue
+            for i in range(count):
+                self._schedule_ping()
+
+    def _schedule_ping(self):
+        Thread(target=self._ping).start()
+
+    def _ping(self):
+        recorder = self.recorder
+        with self._in_flight_lock:
+            self.in_flight += 1
+        PROFILE.in_flight.add(self.in_flight)
+        probe, sent = recorder._probe_sent()
+        try:
+            result = ping(
+                recorder.address,
+                count=1,
+                timeout=recorder.timeout,
+                privileged=recorder.privileged,
+                payload_size=recorder.payload_size,
+            )
+        except Exception as exc:
+            recorder._handle_error(exc, probe)
+        else:
+            recorder._handle_reply(
+                probe,
+                sent,
+                result.rtts[0] if result.is_alive else None,
+                result.address if result.is_alive else None,
+            )
+        finally:
+            with self._in_flight_lock:
+                self.in_flight -= 1
+
+
+class ProbeScheduler:
+    # A single event loop thread sending pings for any number of
+    # AsyncEngines, spreading their send times evenly over the interval
+    # unless told to send them all at once.
+    TARGETS_PER_SOCKET = 256
+
+    def __init__(self, privileged=False, spread=True):
+        self.privileged = privileged
+        self.spread = spread
+        self.loop = None
+        self._engines = []
+        self._backends = {}
+
+    def add(self, engine):
+        engine.socket_slot = len(self._engines) // self.TARGETS_PER_SOCKET
+        self._engines.append(engine)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(engine._begin, 0)
+
+    def backend(self, protocol, family, slot):
+        try:
+            return self._backends[protocol, family, slot]
+        except KeyError:
+            backend = BACKENDS[protocol](self, family)
+            self._backends[protocol, family, slot] = backend
+            return backend
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        for i, engine in enumerate(self._engines):
+            self.loop.call_soon(
+                engine._begin,
+                i * engine.recorder.interval / len(self._engines) if self.spread else 0,
+            )
+        Thread(target=self._run).start()
+
+    def stop(self):
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            for backend in self._backends.values():
+                backend.close()
+            self._backends.clear()
+            self.loop.close()
+
+
+class AsyncEngine:
+    # Pings one target through a ProbeScheduler. Unless a shared
+    # scheduler is given, the engine gets one of its own.
+    def __init__(self, recorder, scheduler=None):
+        self.recorder = recorder
+        self._private = scheduler is None
+        if scheduler is None:
+            scheduler = ProbeScheduler(privileged=recorder.privileged)
+        self.scheduler = scheduler
+        # only touched from the scheduler's thread
+        self.in_flight = 0
+        # set once started
+        self.schedule = None
+        self._timer = None
+        scheduler.add(self)
+
+    def start(self):
+        if self._private:
+            self.scheduler.start()
+
+    def stop(self):
+        if self._private:
+            self.scheduler.stop()
+        elif self.scheduler.loop is not None and not self.scheduler.loop.is_closed():
+            self.scheduler.loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _begin(self, offset):
+        self.schedule = self.recorder.make_schedule(
+            start_ns=monotonic_ns() + round(offset * 1000000000),
+        )
+        self._timer = self.scheduler.loop.call_later(offset, self._tick)
+
+    def _tick(self):
+        if self.recorder.stopped.is_set():
+            if self._private:
+                self.scheduler.loop.stop()
+            return
+        for i in range(self.schedule.due()):
+            self._send()
+        self._timer = self.scheduler.loop.call_later(self.schedule.wait(), self._tick)
+
+    def _send(self):
+        address = self.recorder.address
+        if address is None:
+            # not resolved (yet), the resolver reports why
+            return
+        try:
+            self.scheduler.backend(
+                self.recorder.protocol,
+                6 if is_ipv6_address(address) else 4,
+                self.socket_slot,
+            ).send(self, address)
+        except Exception as exc:
+            self.recorder._handle_error(exc)
+        else:
+            PROFILE.in_flight.add(self.in_flight)
+
+
+ENGINES = {
+    "thread": ThreadEngine,
+    "async": AsyncEngine,
+}
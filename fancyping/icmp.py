@@ -1,17 +1,100 @@
+from collections import namedtuple
 from datetime import datetime
-from statistics import mean, median
-from threading import Thread, Event, Lock
+from math import isnan, nan
+import os
+from queue import Empty, Full, Queue
+from statistics import mean
+import sys
+from threading import Event, Lock, Thread
+from time import monotonic, monotonic_ns, perf_counter_ns, time
+from traceback import format_exc
 
-from icmplib import ping
+from .backends import DEFAULT_PORTS
+from .engines import ENGINES, AdaptiveInterval, AsyncEngine, Schedule
+from .metrics import ProbeCounters
+from .profiling import PROFILE
+from .record import STATUS_REPLY, STATUS_TIMEOUT, ProbeLog
+from .reports import ReportWriter
+from .resolver import Resolver
+from .ringbuffer import RingBuffer
+from .stats import (
+    PERCENTILES,
+    Jitter,
+    OutageIndex,
+    RolledWindow,
+    Rollup,
+    WindowStats,
+    format_outages,
+    format_stats_table,
+    percentile,
+)
 
 
-class Scheduler(Thread):
-    def __init__(self, recorder):
-        self.recorder = recorder
+class UpdateEvent(Event):
+    # An Event that the UI can also wait for with select(). The pipe is
+    # only created once somebody asks for it.
+    def __init__(self):
+        super().__init__()
+        self._read_fd = None
+        self._write_fd = None
 
-    def run(self):
-        while not self.recorder.stopped.wait(self.recorder.interval):
-            self.recorder._schedule_ping()
+    def fileno(self):
+        if self._read_fd is None:
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(read_fd, False)
+            os.set_blocking(write_fd, False)
+            self._read_fd, self._write_fd = read_fd, write_fd
+        return self._read_fd
+
+    def close(self):
+        if self._read_fd is not None:
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+            self._read_fd = self._write_fd = None
+
+    def set(self):
+        if not self.is_set():
+            super().set()
+            if self._write_fd is not None:
+                try:
+                    os.write(self._write_fd, b"\0")
+                except OSError:
+                    # full (the UI is already going to wake up) or closed
+                    pass
+
+    def clear(self):
+        # drain before clearing so a concurrent set() can't leave the
+        # flag set with nothing left in the pipe to wake us up
+        if self._read_fd is not None:
+            try:
+                while os.read(self._read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        super().clear()
+
+
+# What readers get to see of a PingRecorder, published by its writer
+# thread. results and datetimes are the ring buffers themselves, valid
+# up to position end. stats maps timeframes to (covered, packet loss,
+# rtt stats).
+Snapshot = namedtuple('Snapshot', (
+    'generation',
+    'results',
+    'datetimes',
+    'end',
+    'count',
+    'lost_streak',
+    'last_rtt',
+    'error',
+    'last_resp',
+    'last_pl',
+    'jitter',
+    'counters',
+    'stats',
+    'responder',
+    'outages',
+))
 
 
 class PingRecorder:
@@ -29,7 +112,37 @@ class PingRecorder:
         (60 * 60 * 6, "6h"),
         (60 * 60 * 12, "12h"),
         (60 * 60 * 24, "24h"),
+        (60 * 60 * 24 * 7, "7d"),
+        (60 * 60 * 24 * 30, "30d"),
     ]
+    # (bucket width, number of buckets kept) for stats intervals that
+    # need more samples than history keeps around
+    ROLLUPS = [
+        (10, 6 * 360),  # 6h
+        (60, 48 * 60),  # 48h
+        (60 * 60, 32 * 24),  # 32d
+    ]
+    # windows of up to this many samples keep them all in heaps for an
+    # exact median (about 100 bytes each), longer ones use the sketch
+    EXACT_MEDIAN_SAMPLES = 60 * 60
+    # keep rolled up windows from lagging behind by more than 1/60th
+    ROLLUP_MIN_BUCKETS = 60
+    # the writer thread publishes a snapshot after at most this many
+    # updates, and after this many seconds without any
+    MAX_BATCH = 1000
+    PUBLISH_INTERVAL = 1.0
+    # probe threads block instead of queueing more updates than this,
+    # about a second's worth of work for the writer
+    MAX_QUEUE = 10000
+    # give up on a probe engines never reported back on once later ones
+    # have been held back for longer than the timeout plus this
+    REORDER_GRACE = 5.0
+    # stop computing stats for timeframes nobody asked for in this long
+    WATCH_TIMEOUT = 60
+    # outages are counted for this timeframe in snapshots
+    OUTAGE_TIMEFRAME = 60 * 60 * 24
+    # time taking _probe_lock for one in this many pings, see PROFILE
+    PROFILE_EVERY = 16
 
     def __init__(
         self,
@@ -39,6 +152,23 @@ class PingRecorder:
         payload_size=56,
         timeout=2.0,
         history=60 * 60 * 24,
+        engine="thread",
+        privileged=False,
+        scheduler=None,
+        missed="catchup",
+        record=None,
+        burst=1,
+        adaptive=None,
+        rate_limit=None,
+        protocol="icmp",
+        port=None,
+        resolve_interval=None,
+        hosts=None,
+        ttl=None,
+        resolver=None,
+        dont_fragment=False,
+        loss_tolerance=1,
+        updated=None,
     ):
         self.target = target
         self.count = count
@@ -46,160 +176,563 @@ class PingRecorder:
         self.payload_size = payload_size
         self.timeout = timeout
         self.history = history
+        self.privileged = privileged
+        # what to do about send deadlines missed by the scheduler
+        self.missed = missed
+        # pings sent back to back every interval
+        self.burst = burst
+        # probe down to every `adaptive` seconds while things change
+        self.interval_policy = None if adaptive is None else AdaptiveInterval(adaptive, interval)
+        # RateLimit shared with other recorders
+        self.rate_limit = rate_limit
+        # backend used to probe the target (see backends.PROTOCOLS)
+        self.protocol = protocol
+        self.port = DEFAULT_PORTS.get(protocol) if port is None else port
+        # probe the hop this many hops away instead of target itself
+        # (icmp and the async engine only)
+        self.ttl = ttl
+        # send with DF set (same)
+        self.dont_fragment = dont_fragment
+        # consecutive lost pings that make an outage, see stats.OutageIndex
+        self.loss_tolerance = loss_tolerance
+        # shared with another recorder for the same target, see path.Path
+        self._resolver = resolver or Resolver(self, resolve_interval, hosts)
+
+        if scheduler is not None:
+            # shared between multiple recorders
+            self._engine = AsyncEngine(self, scheduler)
+        elif protocol != "icmp" or ttl is not None or dont_fragment:
+            # only the async engine has backends other than icmplib.ping()
+            self._engine = AsyncEngine(self)
+        else:
+            self._engine = ENGINES[engine](self)
 
-        self.updated = Event()
-        self._lock = Lock()
+        # set when a snapshot has news for the UI, may be shared by all
+        # recorders in the grid so it only has to wait for one
+        self.updated = UpdateEvent() if updated is None else updated
+        self._report_writer = ReportWriter(self)
+        # path.Path and sweep.Sweep for this target, added to text reports
+        self.panels = []
+        # append-only log of every ping, survives reset()
+        self._log = None if record is None else ProbeLog(record, target)
+        self._log_seq = 0
+        # for metrics, not affected by reset()
+        self.counters = ProbeCounters()
+        # probes are numbered as they are sent and their results held
+        # back until all earlier ones are done, so they are recorded in
+        # send order no matter the order they complete in
+        self._probe_lock = Lock()
+        self._probes_sent = 0
+        self._next_commit = 0
+        self._completed = {}
+        # monotonic time since results are held back for the probe
+        # numbered _next_commit, None while none are
+        self._held_since = None
         self.stopped = Event()
+        # bumped on reset() so the UI knows to throw away what it has drawn
+        self._generation = 0
+        # timeframe -> monotonic deadline, see _stats()
+        self._watched = {}
 
-        self.reset()
+        # Everything below is only touched by the writer thread, which
+        # takes (function, args) off the queue and calls them. Other
+        # threads read self.snapshot, published after every batch.
+        self._queue = Queue(self.MAX_QUEUE)
+        # the async engine reports from the event loop shared by all
+        # recorders, which must never block on a full queue: results that
+        # don't fit are dropped and counted instead (see _put())
+        self._block = not isinstance(self._engine, AsyncEngine)
+        self._dropped = 0
+        # what readers were last told about, see _publish()
+        self._published = None
+        self._reset()
+        self._publish()
+        self._writer = Thread(target=self._write_loop, name="fancyping-recorder", daemon=True)
+        self._writer.start()
 
     def is_alive(self, loss_tolerance=1):
-        i = 0
-        with self._lock:
-            if not self._results:
-                return None
-            while i < loss_tolerance:
-                try:
-                    result = self._results[i]
-                except IndexError:
-                    continue
-                else:
-                    if result is not None:
-                        return True
-                finally:
-                    i += 1
-        return False
+        snapshot = self.snapshot
+        if not snapshot.count:
+            return None
+        return snapshot.lost_streak < min(loss_tolerance, snapshot.count)
 
     @property
     def last_rtt(self):
-        try:
-            return self._results[0]
-        except IndexError:
-            return None
+        return self.snapshot.last_rtt
+
+    @property
+    def error(self):
+        return self.snapshot.error
+
+    @property
+    def last_resp(self):
+        return self.snapshot.last_resp
+
+    @property
+    def last_pl(self):
+        return self.snapshot.last_pl
+
+    @property
+    def generation(self):
+        return self.snapshot.generation
+
+    @property
+    def end(self):
+        # number of pings ever recorded, see recent_rtts()
+        return self.snapshot.end
+
+    @property
+    def jitter(self):
+        # RFC 3550 interarrival jitter in ms, None until two replies
+        return self.snapshot.jitter
+
+    @property
+    def outages(self):
+        # stats.Outages, recent being within OUTAGE_TIMEFRAME
+        return self.snapshot.outages
+
+    @property
+    def responder(self):
+        # address the last reply came from, a router for probes with ttl
+        return self.snapshot.responder
+
+    def now(self):
+        return datetime.utcnow()
+
+    def recent_rtts(self, n):
+        # newest first, None for lost pings
+        snapshot = self.snapshot
+        start, (rtts,) = self._read((snapshot.results,), snapshot.end - n, snapshot.end)
+        return [None if isnan(rtt) else rtt for rtt in reversed(rtts)]
 
     def reset(self):
-        with self._lock:
-            self._datetimes = []
-            self._results = []
-            self.error = None
-            self.last_resp = None
-            self.last_pl = None
-        self.updated.set()
+        self._put((self._reset, ()), block=True)
+
+    def flush(self):
+        # wait until everything reported so far is in self.snapshot
+        done = Event()
+        self._put((None, done), block=True)
+        while not done.wait(self.PUBLISH_INTERVAL):
+            self._check_writer()
+
+    def _window(self, timeframe, rollups):
+        # keep raw samples for timeframes that fit in history even at
+        # the highest rate we might ping at
+        interval = self.interval
+        if self.interval_policy is not None:
+            interval = min(interval, self.interval_policy.min_interval)
+        samples = timeframe / interval * self.burst
+        exact_median = samples <= self.EXACT_MEDIAN_SAMPLES
+        if samples <= self.history:
+            return WindowStats(self._results, self._monotonic, timeframe, exact_median)
+        # the coarsest rollup that has enough buckets of a width that
+        # divides timeframe evenly
+        for rollup in reversed(rollups):
+            buckets, remainder = divmod(timeframe, rollup.width)
+            if not remainder and self.ROLLUP_MIN_BUCKETS <= buckets <= rollup.capacity:
+                return RolledWindow(rollup, buckets)
+        # best effort over as much history as we have
+        return WindowStats(self._results, self._monotonic, timeframe, exact_median)
+
+    def make_schedule(self, start_ns=None):
+        return Schedule(
+            self.interval,
+            self.missed,
+            start_ns=start_ns,
+            burst=self.burst,
+            policy=self.interval_policy,
+            rate_limit=self.rate_limit,
+        )
 
     def stop(self):
+        self._halt()
+        if self._log is not None:
+            # after whatever is still queued
+            self._put((self._log.close, ()), block=True)
+
+    def _halt(self):
         self.stopped.set()
+        # so the UI notices
+        self.updated.set()
+        self._engine.stop()
 
     def start(self):
         self.time_started = datetime.utcnow()
         self.stopped.clear()
-        Thread(target=self._schedule_pings).start()
+        self._resolver.start()
+        self._engine.start()
 
-    def _schedule_pings(self):
-        self._schedule_ping()
-        while not self.stopped.wait(self.interval):
-            self._schedule_ping()
+    @property
+    def address(self):
+        # what target resolved to, None until it did
+        return self._resolver.address
 
-    def _schedule_ping(self):
-        Thread(target=self._ping).start()
+    # called by engines from their own threads
 
-    def _ping(self):
-        try:
-            result = ping(
-                self.target,
-                count=1,
-                timeout=self.timeout,
-                privileged=False,
-                payload_size=self.payload_size,
-            )
-        except Exception as exc:
-            with self._lock:
-                self.error = str(exc)
-                self.last_pl = datetime.utcnow()
-        else:
-            now = datetime.utcnow()
-            with self._lock:
-                if result.is_alive:
-                    self._datetimes.insert(0, now)
-                    self._results.insert(0, result.rtts[0])
-                    self.error = None
-                    self.last_resp = now
+    def _probe_sent(self):
+        # number and (monotonic_ns, time) of a probe about to be sent,
+        # engines must report back on every number they got
+        # this is hot enough to only time the lock now and then
+        timed = not self._probes_sent % self.PROFILE_EVERY
+        if timed:
+            waiting = perf_counter_ns()
+        with self._probe_lock:
+            if timed:
+                acquired = perf_counter_ns()
+            probe = self._probes_sent
+            self._probes_sent += 1
+            sent = (monotonic_ns(), time())
+        if timed:
+            PROFILE.lock_hold.add((perf_counter_ns() - acquired) / 1000)
+            PROFILE.lock_wait.add((acquired - waiting) / 1000)
+        return probe, sent
+
+    def _handle_error(self, exc, probe=None):
+        # probe is None if the error happened before it was numbered
+        self._put((self._apply_error, (str(exc), probe)))
+
+    def _handle_reply(self, probe, sent, rtt, responder=None):
+        # sent is (monotonic_ns, time) at send, rtt is None for lost pings
+        self._put((self._apply_reply, (probe, sent, rtt, responder)))
+
+    def _handle_resolve_error(self, exc):
+        self._put((self._apply_resolve_error, (str(exc),)))
+
+    def _handle_late(self, rtt):
+        # a reply to a probe that already timed out
+        self._put((self._apply_late, (rtt,)))
+
+    def _handle_duplicate(self):
+        self._put((self._apply_duplicate, ()))
+
+    def _put(self, item, block=None):
+        if not (self._block if block is None else block):
+            try:
+                self._queue.put_nowait(item)
+            except Full:
+                # a lost result is skipped later, see _skip_missing()
+                self._dropped += 1
+            return
+        while True:
+            try:
+                self._queue.put(item, timeout=self.PUBLISH_INTERVAL)
+                return
+            except Full:
+                self._check_writer()
+
+    def _check_writer(self):
+        # rather than waiting forever for it
+        if not self._writer.is_alive():
+            raise RuntimeError(f"recorder for {self.target} is no longer running")
+
+    # writer thread
+
+    def _write_loop(self):
+        queue = self._queue
+        while True:
+            try:
+                # publish now and then even without news, so time-based
+                # windows keep moving
+                batch = [queue.get(timeout=self.PUBLISH_INTERVAL)]
+            except Empty:
+                batch = []
+            try:
+                while len(batch) < self.MAX_BATCH:
+                    batch.append(queue.get_nowait())
+            except Empty:
+                pass
+            waiting = []
+            for function, args in batch:
+                if function is None:
+                    waiting.append(args)
                 else:
-                    self._datetimes.insert(0, now)
-                    self._results.insert(0, None)
-                    self.error = "TIMEOUT"
-                    self.last_pl = now
-                if len(self._results) > self.history:
-                    self._datetimes.pop()
-                    self._results.pop()
-                if self.count and len(self._results) > self.count:
-                    self.stopped.set()
-        finally:
+                    self._guarded(function, *args)
+            if (
+                self._held_since is not None and
+                monotonic() - self._held_since > self.timeout + self.REORDER_GRACE
+            ):
+                self._guarded(self._skip_missing)
+            self._guarded(self._publish)
+            for done in waiting:
+                done.set()
+            if self.count and self._results.appended > self.count and not self.stopped.is_set():
+                # stop() would wait for us if the queue is full
+                self._halt()
+                if self._log is not None:
+                    self._log.close()
+
+    def _guarded(self, function, *args):
+        # a bug must not silently end the writer thread, after which
+        # the target would just look frozen
+        try:
+            function(*args)
+        except Exception:
+            traceback = format_exc()
+            sys.stderr.write(traceback)
+            self._error = "internal error: " + traceback.strip().splitlines()[-1]
+
+    def _reset(self):
+        # send timestamps on the wall clock (epoch) and the monotonic
+        # clock (seconds) and RTTs (NaN for loss)
+        self._datetimes = RingBuffer(self.history)
+        self._monotonic = RingBuffer(self.history)
+        self._results = RingBuffer(self.history)
+        # incrementally updated stats for each of STATS_INTERVALS
+        self._windows = {}
+        # Pings are recorded up to a timeout after they were sent, or
+        # held back for up to a timeout behind one that never came back
+        # until that is given up on, see _skip_missing()
+        delay = 2 * self.timeout + self.REORDER_GRACE
+        rollups = [Rollup(width, capacity, delay) for width, capacity in self.ROLLUPS]
+        for timeframe, label in self.STATS_INTERVALS:
+            self._windows[timeframe] = self._window(timeframe, rollups)
+        # only feed rollups that are actually used
+        self._rollups = [rollup for rollup in rollups if rollup.windows]
+        self._sample_windows = [
+            window for window in self._windows.values()
+            if isinstance(window, WindowStats)
+        ]
+        self._jitter = Jitter()
+        self._outages = OutageIndex(self.loss_tolerance)
+        self._lost_streak = 0
+        self._error = None
+        self._last_resp = None
+        self._last_pl = None
+        self._responder = None
+        self._generation += 1
+
+    def _publish(self):
+        now = monotonic()
+        started = perf_counter_ns()
+        stats = {}
+        for timeframe, deadline in list(self._watched.items()):
+            if deadline < now:
+                self._watched.pop(timeframe, None)
+            else:
+                stats[timeframe] = self._stats(timeframe, now)
+        if stats:
+            PROFILE.stats.add((perf_counter_ns() - started) / 1000)
+        results = self._results
+        self.counters.dropped = self._dropped
+        if self._log is not None:
+            self.counters.log_dropped = self._log.dropped
+        self.snapshot = Snapshot(
+            generation=self._generation,
+            results=results,
+            datetimes=self._datetimes,
+            end=results.appended,
+            count=len(results),
+            lost_streak=self._lost_streak,
+            last_rtt=results[0] if results and results[0] == results[0] else None,
+            error=self._error,
+            last_resp=self._last_resp,
+            last_pl=self._last_pl,
+            jitter=self._jitter.value,
+            counters=self.counters.copy(),
+            stats=stats,
+            responder=self._responder,
+            outages=self._outages.summary(now, self.OUTAGE_TIMEFRAME),
+        )
+        # Snapshots are published now and then without news too, which
+        # shouldn't wake up the UI. It reads stats as it draws anyway.
+        published = (self._generation, results.appended, self._error)
+        if published != self._published:
+            self._published = published
             self.updated.set()
 
+    def _stats(self, timeframe, now):
+        # (covered, packet loss, rtt stats) as of now
+        window = self._windows.get(timeframe)
+        if window is not None:
+            window.expire(now)
+            return window.covered, window.packet_loss, window.rtt_stats
+        # timeframes without a window of their own
+        times = self._monotonic
+        start = times.bisect(now - timeframe)
+        values = self._results.range(start, self._results.appended)
+        covered = bool(times) and times.at(times.appended - len(times)) <= now - timeframe
+        if not values:
+            return covered, 1.0, None
+        packet_loss = sum(1 for v in values if v != v) / len(values)
+        values = sorted(v for v in values if v == v)  # not NaN
+        if not values:
+            return covered, packet_loss, None
+        return covered, packet_loss, \
+            (mean(values), percentile(values, 50), values[0], values[-1]) + \
+            tuple(percentile(values, p) for p in PERCENTILES[1:])
+
+    def _apply_error(self, error, probe):
+        self.counters.errors += 1
+        self._error = error
+        self._last_pl = datetime.utcnow()
+        if probe is not None:
+            self._complete(probe, None)
+
+    def _apply_reply(self, probe, sent, rtt, responder):
+        if rtt is not None:
+            self._complete(probe, (sent, rtt))
+            self._error = None
+            if responder is not None:
+                self._responder = responder
+            self._last_resp = datetime.utcfromtimestamp(sent[1])
+        else:
+            self._complete(probe, (sent, nan))
+            self._error = "TIMEOUT"
+            self._last_pl = datetime.utcfromtimestamp(sent[1])
+        if self.interval_policy is not None:
+            self.interval_policy.update(rtt)
+
+    def _apply_resolve_error(self, error):
+        # not a lost or unsent ping, lookups happen on their own
+        self.counters.resolve_errors += 1
+        self._error = error
+
+    def _apply_late(self, rtt):
+        self.counters.late += 1
+        self.counters.late_rtt_sum += rtt
+
+    def _apply_duplicate(self):
+        self.counters.duplicates += 1
+
+    def _complete(self, probe, result):
+        # result is (sent, rtt) or None for probes that weren't sent
+        if probe < self._next_commit:
+            # given up on already, see _skip_missing()
+            return
+        self._completed[probe] = result
+        self._commit()
+
+    def _commit(self):
+        next_commit = self._next_commit
+        while self._next_commit in self._completed:
+            result = self._completed.pop(self._next_commit)
+            self._next_commit += 1
+            if result is not None:
+                self._record(*result)
+        if not self._completed:
+            self._held_since = None
+        elif self._held_since is None or self._next_commit != next_commit:
+            self._held_since = monotonic()
+
+    def _skip_missing(self):
+        # Probes before the first one held back should have been reported
+        # by now, so whatever sent them lost track of them. Count them as
+        # errors rather than holding back everything after them forever.
+        first = min(self._completed)
+        self.counters.errors += first - self._next_commit
+        self._error = f"no result for {first - self._next_commit} probes"
+        self._next_commit = first
+        self._commit()
+
+    def _record(self, sent, rtt):
+        timestamp = sent[0] / 1000000000
+        # windows need to see the value before it's in the buffer
+        for window in self._sample_windows:
+            window.add(rtt, timestamp)
+        self._jitter.add(rtt)
+        self._outages.add(rtt, timestamp, sent[1])
+        self.counters.add(sent[1], rtt)
+        for rollup in self._rollups:
+            rollup.add(timestamp, rtt)
+        if self._log is not None:
+            self._log.append(
+                sent[1],
+                rtt,
+                self._log_seq,
+                STATUS_TIMEOUT if rtt != rtt else STATUS_REPLY,
+            )
+            self._log_seq += 1
+        self._lost_streak = self._lost_streak + 1 if rtt != rtt else 0
+        self._monotonic.append(timestamp)
+        self._datetimes.append(sent[1])
+        self._results.append(rtt)
+
+    # readers
+
+    def _read(self, buffers, start, end):
+        # Copies of positions [start, end) of buffers the writer may be
+        # appending to, and where they actually start: positions
+        # overwritten before or while copying are left out. Positions
+        # only ever get overwritten once, so checking after the copy
+        # is enough. The writer appends to one buffer after the other,
+        # whichever is furthest ahead overwrites a row first.
+        capacity = buffers[0].capacity
+        while True:
+            start = max(start, max(buffer.appended for buffer in buffers) - capacity, 0)
+            if start >= end:
+                return end, [buffer.range(end, end) for buffer in buffers]
+            try:
+                copies = [buffer.range(start, end) for buffer in buffers]
+            except IndexError:
+                continue
+            overwritten = max(buffer.appended for buffer in buffers) - capacity - start
+            if overwritten > 0:
+                return start + overwritten, [copy[overwritten:] for copy in copies]
+            return start, copies
+
+    def _stats_of(self, timeframe):
+        # The writer only computes stats for timeframes somebody asked
+        # for in the last WATCH_TIMEOUT seconds. The first time around
+        # we wait for it to do so.
+        self._watched[timeframe] = monotonic() + self.WATCH_TIMEOUT
+        try:
+            return self.snapshot.stats[timeframe]
+        except KeyError:
+            self.flush()
+            return self.snapshot.stats[timeframe]
+
     def packet_loss(self, timeframe):
-        results = self._results[:int(timeframe / self.interval)]
-        if not results:
-            return 1.0
-        return results.count(None) / len(results)
+        return self._stats_of(timeframe)[1]
 
     def rtt_stats(self, timeframe):
-        values = list(filter(
-            lambda v: v is not None,
-            self._results[:int(timeframe / self.interval)],
-        ))
-        if not values:
-            return None
-        return mean(values), median(values), min(values), max(values)
+        return self._stats_of(timeframe)[2]
 
     def report_stats(self):
-        lines = [
-            "TIME  " +
-            "AVG".rjust(9) +
-            "MED".rjust(9) +
-            "MIN".rjust(9) +
-            "MAX".rjust(9) +
-            "P/L".rjust(7)
-        ]
+        # include everything reported so far, reports are written after
+        # stopping or on demand
+        deadline = monotonic() + self.WATCH_TIMEOUT
         for timeframe, label in self.STATS_INTERVALS:
-            if len(self._results) < int(timeframe / self.interval):
+            self._watched[timeframe] = deadline
+        self.flush()
+        snapshot = self.snapshot
+        rows = []
+        for timeframe, label in self.STATS_INTERVALS:
+            covered, packet_loss, rtt_stats = snapshot.stats[timeframe]
+            if not covered:
                 break
-            pl = self.packet_loss(timeframe)
-            stats = self.rtt_stats(timeframe)
-            if stats:
-                lines.append(
-                    f"{label.rjust(4)}  "
-                    f"{stats[0]:9.2f}"
-                    f"{stats[1]:9.2f}"
-                    f"{stats[2]:9.2f}"
-                    f"{stats[3]:9.2f}"
-                    f"{pl * 100:6.1f}%"
-                )
-            else:
-                lines.append(
-                    f"{label.rjust(4)}  "
-                    f"{' ':<9}"
-                    f"{' ':<9}"
-                    f"{' ':<9}"
-                    f"{' ':<9}"
-                    f"{pl * 100:6.1f}%"
-                )
-        return "\n".join(lines)
-
-    def report_write_full(self):
-        Thread(target=self._report_write_full).start()
-
-    def _report_write_full(self):
-        reptime = datetime.utcnow()
-        filename = f"fancyping_report_{self.target}_{reptime.strftime('%Y%m%dT%H%M%SZ')}.txt"
-        with open(filename, 'w') as f:
-            f.write(f"TARGET: {self.target}\n")
-            f.write(f"UNTIL:  {reptime.strftime('%Y-%m-%dT%H:%M:%SZ')}\n\n")
-            f.write(f"FROM:   {self.time_started.strftime('%Y-%m-%dT%H:%M:%SZ')}\n")
-            f.write(f"SIZE:   {self.payload_size} B\n")
-            f.write(self.report_stats() + "\n\n")
-            for rtt, time in zip(self._results.copy(), self._datetimes.copy()):
-                if rtt is None:
-                    rtt_text = "TIMEOUT"
-                else:
-                    rtt_text = f"{rtt:9.2f}ms"
-                f.write(f"{time.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}  {rtt_text}\n")
+            rows.append((label, packet_loss, rtt_stats))
+        table = format_stats_table(rows)
+        footer = []
+        if snapshot.jitter is not None:
+            footer.append(f"JITTER {snapshot.jitter:.2f}ms")
+        late, duplicates = snapshot.counters.late, snapshot.counters.duplicates
+        if late or duplicates:
+            footer.append(f"LATE {late}  DUPLICATE {duplicates}")
+        if snapshot.counters.log_dropped:
+            footer.append(f"NOT RECORDED {snapshot.counters.log_dropped} (disk too slow)")
+        if snapshot.outages.since is not None:
+            footer.extend(format_outages(
+                snapshot.outages,
+                dict(self.STATS_INTERVALS)[self.OUTAGE_TIMEFRAME],
+            ))
+        if footer:
+            table += "\n\n" + "\n".join(footer)
+        return table
+
+    def history_chunks(self, chunk_size):
+        # Yields (timestamps, rtts) arrays of up to chunk_size pings,
+        # newest chunk first and oldest ping first within each chunk.
+        # Only one chunk is copied at a time, pings overwritten while
+        # iterating are skipped.
+        snapshot = self.snapshot
+        buffers = (snapshot.datetimes, snapshot.results)
+        end = snapshot.end
+        while True:
+            start, chunk = self._read(buffers, end - chunk_size, end)
+            if start >= end:
+                return
+            yield tuple(chunk)
+            end = start
+
+    def report_write_full(self, report_format="text"):
+        return self._report_writer.write(report_format)
@@ -0,0 +1,178 @@
+from argparse import ArgumentTypeError
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socket import AF_INET6
+from threading import Thread
+
+# upper bounds of RTT histogram buckets in ms, plus +Inf
+RTT_BUCKETS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# (name, help, type) in the order they are exported
+METRICS = (
+    ("fancyping_up", "Whether the target is considered up.", "gauge"),
+    ("fancyping_probes_total", "Pings that got a reply or timed out.", "counter"),
+    ("fancyping_probes_lost_total", "Pings that timed out or got an error reply.", "counter"),
+    ("fancyping_probe_errors_total", "Pings that could not be sent.", "counter"),
+    ("fancyping_resolve_errors_total", "Failed lookups of the target's address.", "counter"),
+    ("fancyping_late_rtt_seconds", "Round trip time of replies that came in after the timeout.", "summary"),
+    ("fancyping_duplicate_replies_total", "Replies to pings that already got one.", "counter"),
+    ("fancyping_results_dropped_total", "Results not recorded because the recorder fell behind.", "counter"),
+    ("fancyping_log_records_dropped_total", "Records not written to the --record file because the disk fell behind.", "counter"),
+    ("fancyping_rtt_seconds", "Round trip time of replies.", "histogram"),
+    ("fancyping_jitter_seconds", "RFC 3550 interarrival jitter.", "gauge"),
+    ("fancyping_last_reply_timestamp_seconds", "Send time of the last ping that got a reply.", "gauge"),
+    ("fancyping_last_loss_timestamp_seconds", "Send time of the last lost ping.", "gauge"),
+    ("fancyping_probes_in_flight", "Pings sent and waiting for a reply.", "gauge"),
+    ("fancyping_interval_seconds", "Current time between pings.", "gauge"),
+    ("fancyping_missed_deadlines_total", "Send deadlines the scheduler was late for.", "counter"),
+    ("fancyping_probes_throttled_total", "Pings not sent because of the rate limit.", "counter"),
+)
+
+
+class ProbeCounters:
+    # Cumulative counters since start, updated with every ping so
+    # scrapes only have to format them. Unlike the stats windows they
+    # are never reset, Prometheus counters must not go backwards.
+    def __init__(self):
+        self.probes = 0
+        self.lost = 0
+        self.errors = 0
+        self.resolve_errors = 0
+        # replies after the ping was counted as lost (async engine only)
+        self.late = 0
+        self.late_rtt_sum = 0.0
+        self.duplicates = 0
+        # results that didn't fit into PingRecorder's queue
+        self.dropped = 0
+        # records ProbeLog couldn't buffer (with --record)
+        self.log_dropped = 0
+        self.rtt_sum = 0.0
+        # per bucket, not cumulative (that's done when rendering)
+        self.rtt_buckets = [0] * (len(RTT_BUCKETS) + 1)
+        # epoch timestamps at send
+        self.last_reply = None
+        self.last_loss = None
+
+    def add(self, timestamp, rtt):
+        self.probes += 1
+        if rtt != rtt:
+            self.lost += 1
+            self.last_loss = timestamp
+            return
+        self.rtt_sum += rtt
+        self.rtt_buckets[bisect_left(RTT_BUCKETS, rtt)] += 1
+        self.last_reply = timestamp
+
+    def copy(self):
+        counters = ProbeCounters()
+        counters.__dict__.update(self.__dict__)
+        counters.rtt_buckets = list(self.rtt_buckets)
+        return counters
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render_metrics(ping_recorders, loss_tolerance=1):
+    # Prometheus text exposition format
+    samples = {}
+    for ping_recorder in ping_recorders:
+        snapshot = ping_recorder.snapshot
+        counters = snapshot.counters
+        engine = ping_recorder._engine
+        labels = f'target="{escape_label(ping_recorder.target)}"'
+        alive = ping_recorder.is_alive(loss_tolerance)
+
+        def sample(name, value, extra_labels=""):
+            samples.setdefault(name, []).append(
+                f"{name}{{{labels}{extra_labels}}} {value:.17g}"
+            )
+
+        sample("fancyping_up", 1 if alive else 0)
+        sample("fancyping_probes_total", counters.probes)
+        sample("fancyping_probes_lost_total", counters.lost)
+        sample("fancyping_probe_errors_total", counters.errors)
+        sample("fancyping_resolve_errors_total", counters.resolve_errors)
+        sample("fancyping_late_rtt_seconds_sum", counters.late_rtt_sum / 1000)
+        sample("fancyping_late_rtt_seconds_count", counters.late)
+        sample("fancyping_duplicate_replies_total", counters.duplicates)
+        sample("fancyping_results_dropped_total", counters.dropped)
+        sample("fancyping_log_records_dropped_total", counters.log_dropped)
+        cumulative = 0
+        for bound, count in zip(RTT_BUCKETS + (None,), counters.rtt_buckets):
+            cumulative += count
+            le = "+Inf" if bound is None else f"{bound / 1000:g}"
+            sample("fancyping_rtt_seconds_bucket", cumulative, f',le="{le}"')
+        sample("fancyping_rtt_seconds_sum", counters.rtt_sum / 1000)
+        sample("fancyping_rtt_seconds_count", cumulative)
+        if snapshot.jitter is not None:
+            sample("fancyping_jitter_seconds", snapshot.jitter / 1000)
+        if counters.last_reply is not None:
+            sample("fancyping_last_reply_timestamp_seconds", counters.last_reply)
+        if counters.last_loss is not None:
+            sample("fancyping_last_loss_timestamp_seconds", counters.last_loss)
+        sample("fancyping_probes_in_flight", engine.in_flight)
+        schedule = engine.schedule
+        if schedule is not None:
+            sample("fancyping_interval_seconds", schedule.interval_ns / 1000000000)
+            sample("fancyping_missed_deadlines_total", schedule.missed_deadlines)
+            sample("fancyping_probes_throttled_total", schedule.throttled)
+
+    lines = []
+    for name, help_text, metric_type in METRICS:
+        suffixes = {
+            "histogram": ("_bucket", "_sum", "_count"),
+            "summary": ("_sum", "_count"),
+        }.get(metric_type, ("",))
+        if name + suffixes[0] not in samples:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for suffix in suffixes:
+            lines.extend(samples[name + suffix])
+    return "\n".join(lines) + "\n"
+
+
+def listen_address(value):
+    # "[HOST]:PORT" for argparse, an empty HOST means all interfaces
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ArgumentTypeError(f"expected [HOST]:PORT, got {value!r}")
+    return host.strip("[]"), int(port)
+
+
+class MetricsExporter:
+    # Serves /metrics for the given recorders from a background thread.
+    def __init__(self, ping_recorders, address, loss_tolerance=1):
+        ping_recorders = list(ping_recorders)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_metrics(ping_recorders, loss_tolerance).encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # don't write to stderr (and across the UI) on every scrape
+                pass
+
+        class Server(ThreadingHTTPServer):
+            address_family = AF_INET6 if ":" in address[0] else ThreadingHTTPServer.address_family
+            daemon_threads = True
+
+        self.server = Server(address, Handler)
+        self._thread = Thread(target=self.server.serve_forever, name="fancyping-metrics")
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
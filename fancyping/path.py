@@ -0,0 +1,95 @@
+from .engines import ProbeScheduler
+from .icmp import PingRecorder
+
+MAX_HOPS = 30
+# hop recorders keep less raw history than the target's, longer stats
+# intervals come from rollups
+HOP_HISTORY = 60 * 60
+
+
+class Path:
+    # A PingRecorder for each hop on the way to the target of
+    # ping_recorder, probing it with TTL-limited pings. All hops share
+    # a scheduler that sends their probes at the same time, so the whole
+    # path is refreshed every interval no matter how long it is.
+    def __init__(self, ping_recorder, max_hops=MAX_HOPS):
+        self.ping_recorder = ping_recorder
+        self.scheduler = ProbeScheduler(privileged=ping_recorder.privileged, spread=False)
+        self.hops = [
+            PingRecorder(
+                ping_recorder.target,
+                interval=ping_recorder.interval,
+                payload_size=ping_recorder.payload_size,
+                timeout=ping_recorder.timeout,
+                history=HOP_HISTORY,
+                privileged=ping_recorder.privileged,
+                scheduler=self.scheduler,
+                ttl=ttl,
+                resolver=ping_recorder._resolver,
+                # hops count towards --max-rate too
+                rate_limit=ping_recorder.rate_limit,
+                dont_fragment=ping_recorder.dont_fragment,
+            )
+            for ttl in range(1, max_hops + 1)
+        ]
+
+    def start(self):
+        for hop in self.hops:
+            hop.start()
+        self.scheduler.start()
+
+    def stop(self):
+        for hop in self.hops:
+            hop.stop()
+        self.scheduler.stop()
+
+    def reset(self):
+        for hop in self.hops:
+            hop.reset()
+
+    def visible_hops(self):
+        # Hops up to the first one the target itself answered for, the
+        # ones after that only ever reach the target too. Without an
+        # answer from the target, up to the last hop anybody answered
+        # for and one more.
+        address = self.ping_recorder.address
+        last = 0
+        for i, hop in enumerate(self.hops):
+            responder = hop.responder
+            if responder is not None:
+                if responder == address:
+                    return self.hops[:i + 1]
+                last = i + 1
+        return self.hops[:last + 1]
+
+    def table(self, timeframe):
+        # lines of text, one per hop
+        hops = self.visible_hops()
+        width = max([len(hop.responder or "") for hop in hops] + [4])
+        lines = [
+            " #  " + "HOST".ljust(width) +
+            "P/L".rjust(7) +
+            "LAST".rjust(9) +
+            "AVG".rjust(9) +
+            "MIN".rjust(9) +
+            "MAX".rjust(9)
+        ]
+        for hop in hops:
+            line = f"{hop.ttl:2d}  {hop.responder or '???':<{width}}{hop.packet_loss(timeframe) * 100:6.1f}%"
+            last_rtt, rtt_stats = hop.last_rtt, hop.rtt_stats(timeframe)
+            line += " " * 9 if last_rtt is None else f"{last_rtt:9.2f}"
+            if rtt_stats:
+                line += f"{rtt_stats[0]:9.2f}{rtt_stats[2]:9.2f}{rtt_stats[3]:9.2f}"
+            lines.append(line.rstrip())
+        return lines
+
+    def report(self):
+        # the hop table for the shortest stats interval that covers the
+        # whole run, or the longest there is
+        for timeframe, label in self.ping_recorder.STATS_INTERVALS:
+            covered = self.ping_recorder._stats_of(timeframe)[0]
+            if not covered:
+                break
+        for hop in self.hops:
+            hop.flush()
+        return f"PATH ({label})\n" + "\n".join(self.table(timeframe))
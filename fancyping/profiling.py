@@ -0,0 +1,135 @@
+import json
+from time import monotonic
+
+
+class Histogram:
+    # Counts of values in power of two buckets, bucket i holding values
+    # below 2 ** i (and at least half that), so adding is O(1) and never
+    # allocates. Updated from several threads without a lock: a count
+    # lost now and then is fine for what these are for.
+    BUCKETS = 32
+
+    def __init__(self, name, unit):
+        self.name = name
+        self.unit = unit
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[min(int(value).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # upper bound of the bucket the percentile falls in, None if empty
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** i, self.max)
+        return None
+
+
+class Profile:
+    # What fancyping measures about itself, see PROFILE. Durations are
+    # in µs.
+    def __init__(self):
+        self.started = monotonic()
+        # how late the scheduler sent pings for a deadline
+        self.schedule_lag = Histogram("schedule lag", "us")
+        # pings of a target waiting for a reply, sampled at each send
+        self.in_flight = Histogram("in flight", "probes")
+        # PingRecorder._probe_lock, taken for every ping sent (but only
+        # timed for some)
+        self.lock_wait = Histogram("lock wait", "us")
+        self.lock_hold = Histogram("lock hold", "us")
+        # from being woken up until waiting again, in either UI
+        self.frame = Histogram("frame", "us")
+        # stats for the watched timeframes, computed with every snapshot
+        self.stats = Histogram("stats", "us")
+        # writing each chunk of a report, and the rows in them
+        self.report_chunk = Histogram("report chunk", "us")
+        self.report_rows = 0
+
+    @property
+    def histograms(self):
+        return (
+            self.schedule_lag,
+            self.in_flight,
+            self.lock_wait,
+            self.lock_hold,
+            self.frame,
+            self.stats,
+            self.report_chunk,
+        )
+
+    @property
+    def report_rows_per_s(self):
+        if not self.report_chunk.sum:
+            return None
+        return self.report_rows / self.report_chunk.sum * 1000000
+
+    def lines(self):
+        # a table for the UI overlay
+        lines = [
+            "PROFILE".ljust(19) +
+            "COUNT".rjust(10) +
+            "MEAN".rjust(10) +
+            "P50".rjust(10) +
+            "P99".rjust(10) +
+            "MAX".rjust(10)
+        ]
+        for histogram in self.histograms:
+            line = f"{histogram.name:<12}{histogram.unit:>7}{histogram.count:10d}"
+            if histogram.count:
+                line += (
+                    f"{histogram.sum / histogram.count:10.1f}"
+                    f"{histogram.percentile(50):10.0f}"
+                    f"{histogram.percentile(99):10.0f}"
+                    f"{histogram.max:10.1f}"
+                )
+            lines.append(line)
+        if self.report_rows_per_s is not None:
+            lines.append(f"report rows/s {self.report_rows_per_s:12.0f}")
+        return lines
+
+    def write(self, path):
+        # for --profile-out
+        with open(path, 'w') as f:
+            json.dump(
+                {
+                    "uptime_s": monotonic() - self.started,
+                    "histograms": {
+                        histogram.name: {
+                            "unit": histogram.unit,
+                            "count": histogram.count,
+                            "sum": histogram.sum,
+                            "max": histogram.max,
+                            "p50": histogram.percentile(50),
+                            "p90": histogram.percentile(90),
+                            "p99": histogram.percentile(99),
+                            # [upper bound, count] of non-empty buckets
+                            "buckets": [
+                                [2 ** i, count]
+                                for i, count in enumerate(histogram.buckets) if count
+                            ],
+                        }
+                        for histogram in self.histograms
+                    },
+                    "report_rows": self.report_rows,
+                    "report_rows_per_s": self.report_rows_per_s,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+# One for the whole process, shared by every recorder, engine and UI
+# in it. Worker processes (see shards.py) have their own.
+PROFILE = Profile()
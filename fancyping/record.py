@@ -0,0 +1,103 @@
+from os import fsync
+from struct import Struct
+from threading import Condition, Thread
+from time import monotonic
+
+# File layout: one HEADER followed by any number of RECORDs, all
+# little-endian and fixed width so files can be appended to blindly and
+# read back with mmap.
+MAGIC = b"FANCYPNG"
+VERSION = 1
+HEADER = Struct("<8sHH52s")  # magic, version, record size, target
+RECORD = Struct("<ddIB3x")  # send time (epoch), rtt in ms (NaN if lost), seq, status
+
+STATUS_REPLY = 0
+STATUS_TIMEOUT = 1
+
+
+class LogFormatError(Exception):
+    pass
+
+
+def read_header(data, path=""):
+    if len(data) < HEADER.size:
+        raise LogFormatError(f"{path}: file too short for a header")
+    magic, version, record_size, target = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise LogFormatError(f"{path}: not a fancyping log")
+    if version != VERSION or record_size != RECORD.size:
+        raise LogFormatError(f"{path}: unsupported log version {version}")
+    return target.rstrip(b"\0").decode('utf-8', 'replace')
+
+
+class ProbeLog:
+    # Appends a record for every ping to a file. append() only packs the
+    # record into memory, a background thread writes them out every
+    # flush_interval seconds and fsyncs at most every fsync_interval.
+    # If the disk can't keep up, records beyond max_buffer bytes are
+    # dropped (and counted) rather than growing memory or blocking.
+    def __init__(
+        self,
+        path,
+        target,
+        flush_interval=1.0,
+        fsync_interval=10.0,
+        max_buffer=16 * 1024 * 1024,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_buffer = max_buffer
+        self.dropped = 0
+
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, target.encode('utf-8')[:52]))
+        else:
+            with open(path, 'rb') as f:
+                read_header(f.read(HEADER.size), path)
+            # a crash may have left a partial record at the end
+            self._file.truncate(
+                HEADER.size +
+                (self._file.tell() - HEADER.size) // RECORD.size * RECORD.size
+            )
+        self._buffer = bytearray()
+        self._closed = False
+        self._condition = Condition()
+        self._thread = Thread(target=self._flush_loop, name="fancyping-record")
+        self._thread.start()
+
+    def append(self, timestamp, rtt, seq, status):
+        with self._condition:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return
+            self._buffer += RECORD.pack(timestamp, rtt, seq & 0xffffffff, status)
+
+    def close(self):
+        # doesn't wait for the final write, the (non-daemon) flusher
+        # thread keeps the process alive until it's done
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _flush_loop(self):
+        last_fsync = monotonic()
+        unsynced = False
+        while True:
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(self.flush_interval)
+                closed = self._closed
+                data, self._buffer = self._buffer, bytearray()
+            if data:
+                self._file.write(data)
+                self._file.flush()
+                unsynced = True
+            if unsynced and (closed or monotonic() - last_fsync >= self.fsync_interval):
+                fsync(self._file.fileno())
+                last_fsync = monotonic()
+                unsynced = False
+            if closed:
+                self._file.close()
+                return
@@ -0,0 +1,112 @@
+from datetime import datetime
+from math import isnan
+from threading import Event
+
+from .analyze import ProbeLogFile, format_range_stats_table, rtt_stats
+from .icmp import PingRecorder, UpdateEvent
+
+
+class LogReplay:
+    # Stands in for a PingRecorder in the UI, showing the state of a
+    # recorded log at a cursor that can be moved with seek(). All stats
+    # are computed from the memory-mapped log for the time range ending
+    # at the cursor, nothing is loaded into memory.
+    STATS_INTERVALS = PingRecorder.STATS_INTERVALS
+
+    def __init__(self, path):
+        self.log = ProbeLogFile(path)
+        self.error = None
+        self.generation = 0
+        self.last_pl = None
+        self.last_resp = None
+        # not indexed for replays
+        self.outages = None
+        self.stopped = Event()
+        self.updated = UpdateEvent()
+        self._end = 0
+        self.cursor = self.log.last_time or 0.0
+        self.seek(0)
+
+    @property
+    def target(self):
+        return f"{self.log.target} @ {self.now().strftime('%Y-%m-%dT%H:%M:%SZ')}"
+
+    def now(self):
+        return datetime.utcfromtimestamp(self.cursor)
+
+    def seek(self, seconds):
+        if not self.log.count:
+            return
+        self.cursor = min(
+            max(self.cursor + seconds, self.log.first_time),
+            self.log.last_time,
+        )
+        # number of records up to and including the cursor
+        self._end = self.log.index(self.cursor, 'right')
+        lost = self.log.last_index(self._end, True)
+        received = self.log.last_index(self._end, False)
+        self.last_pl = None if lost is None else datetime.utcfromtimestamp(self.log.time(lost))
+        self.last_resp = None if received is None else datetime.utcfromtimestamp(self.log.time(received))
+        self.error = "TIMEOUT" if lost is not None and lost == self._end - 1 else None
+        self.generation += 1
+        self.updated.set()
+
+    def is_alive(self, loss_tolerance=1):
+        if not self._end:
+            return None
+        for rtt in self.log.rtts(max(0, self._end - loss_tolerance), self._end):
+            if not isnan(rtt):
+                return True
+        return False
+
+    @property
+    def end(self):
+        return self._end
+
+    @property
+    def last_rtt(self):
+        if not self._end:
+            return None
+        rtt = self.log.rtt(self._end - 1)
+        return None if isnan(rtt) else rtt
+
+    def recent_rtts(self, n):
+        # newest first, None for lost pings
+        return [
+            None if isnan(rtt) else float(rtt)
+            for rtt in reversed(self.log.rtts(max(0, self._end - n), self._end))
+        ]
+
+    def packet_loss(self, timeframe):
+        stats = self.log.stats(self.cursor - timeframe, self.cursor)
+        if not stats.count:
+            return 1.0
+        return stats.lost / stats.count
+
+    def rtt_stats(self, timeframe):
+        return rtt_stats(self.log.stats(self.cursor - timeframe, self.cursor))
+
+    @property
+    def jitter(self):
+        return self.log.jitter(self._end)
+
+    def report_stats(self):
+        table = format_range_stats_table(
+            self.log.stats_table(self.STATS_INTERVALS, self.cursor)
+        )
+        if self.jitter is not None:
+            table += f"\n\nJITTER {self.jitter:.2f}ms"
+        return table
+
+    def report_write_full(self, report_format="text"):
+        # the log already is the full report
+        return False
+
+    def reset(self):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.stopped.set()
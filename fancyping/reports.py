@@ -0,0 +1,121 @@
+from datetime import datetime
+from math import isnan
+from threading import Lock, Thread
+from time import perf_counter_ns
+
+from .profiling import PROFILE
+
+REPORT_FORMATS = ("text", "csv", "jsonl")
+REPORT_EXTENSIONS = {
+    "text": "txt",
+    "csv": "csv",
+    "jsonl": "jsonl",
+}
+# rows read from the recorder (and written) at once
+CHUNK_SIZE = 4096
+
+
+class TimeFormatter:
+    # strftime() is slow, so only call it once per second and append
+    # the microseconds ourselves
+    def __init__(self):
+        self._second = None
+        self._prefix = ""
+
+    def __call__(self, timestamp):
+        second = int(timestamp)
+        if second != self._second:
+            self._second = second
+            self._prefix = datetime.utcfromtimestamp(second).strftime('%Y-%m-%dT%H:%M:%S')
+        return f"{self._prefix}.{int((timestamp - second) * 1000000):06d}Z"
+
+
+def text_header(ping_recorder, reptime):
+    return (
+        f"TARGET: {ping_recorder.target}\n"
+        f"UNTIL:  {reptime.strftime('%Y-%m-%dT%H:%M:%SZ')}\n\n"
+        f"FROM:   {ping_recorder.time_started.strftime('%Y-%m-%dT%H:%M:%SZ')}\n"
+        f"PROBE:  {ping_recorder.protocol}{'' if ping_recorder.port is None else f' port {ping_recorder.port}'}\n"
+        f"SIZE:   {ping_recorder.payload_size} B\n"
+        f"{ping_recorder.report_stats()}\n\n" +
+        "".join(f"{panel.report()}\n\n" for panel in ping_recorder.panels)
+    )
+
+
+def text_rows(timestamps, rtts, format_time):
+    return "".join(
+        f"{format_time(timestamp)}  TIMEOUT\n" if isnan(rtt) else
+        f"{format_time(timestamp)}  {rtt:9.2f}ms\n"
+        for timestamp, rtt in zip(timestamps, rtts)
+    )
+
+
+def csv_rows(timestamps, rtts, format_time):
+    return "".join(
+        f"{format_time(timestamp)},\n" if isnan(rtt) else
+        f"{format_time(timestamp)},{rtt:.3f}\n"
+        for timestamp, rtt in zip(timestamps, rtts)
+    )
+
+
+def jsonl_rows(timestamps, rtts, format_time):
+    return "".join(
+        f'{{"time": "{format_time(timestamp)}", "rtt_ms": null}}\n' if isnan(rtt) else
+        f'{{"time": "{format_time(timestamp)}", "rtt_ms": {rtt:.3f}}}\n'
+        for timestamp, rtt in zip(timestamps, rtts)
+    )
+
+
+ROW_WRITERS = {
+    "text": text_rows,
+    "csv": csv_rows,
+    "jsonl": jsonl_rows,
+}
+
+
+def write_report(ping_recorder, f, report_format="text", reptime=None):
+    if reptime is None:
+        reptime = datetime.utcnow()
+    if report_format == "text":
+        f.write(text_header(ping_recorder, reptime))
+    elif report_format == "csv":
+        f.write("time,rtt_ms\n")
+    rows = ROW_WRITERS[report_format]
+    format_time = TimeFormatter()
+    # newest first, like the UI
+    for timestamps, rtts in ping_recorder.history_chunks(CHUNK_SIZE):
+        started = perf_counter_ns()
+        f.write(rows(reversed(timestamps), reversed(rtts), format_time))
+        PROFILE.report_chunk.add((perf_counter_ns() - started) / 1000)
+        PROFILE.report_rows += len(rtts)
+
+
+class ReportWriter:
+    # Writes reports on a background thread, one at a time. Requests
+    # made while a report is being written are ignored.
+    def __init__(self, ping_recorder):
+        self.ping_recorder = ping_recorder
+        self._lock = Lock()
+
+    def write(self, report_format="text"):
+        if not self._lock.acquire(blocking=False):
+            return False
+        Thread(
+            target=self._write,
+            args=(report_format,),
+            name="fancyping-report",
+        ).start()
+        return True
+
+    def _write(self, report_format):
+        try:
+            reptime = datetime.utcnow()
+            filename = (
+                f"fancyping_report_{self.ping_recorder.target}_"
+                f"{reptime.strftime('%Y%m%dT%H%M%SZ')}."
+                f"{REPORT_EXTENSIONS[report_format]}"
+            )
+            with open(filename, 'w', buffering=1024 * 1024) as f:
+                write_report(self.ping_recorder, f, report_format, reptime)
+        finally:
+            self._lock.release()
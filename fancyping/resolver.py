@@ -0,0 +1,61 @@
+from threading import Thread
+
+from icmplib import is_hostname, resolve
+
+# seconds between attempts while a name doesn't resolve at all
+RETRY_INTERVAL = 5
+
+
+def read_hosts(path):
+    # name -> addresses from a file in /etc/hosts format
+    hosts = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            for name in fields[1:]:
+                hosts.setdefault(name.lower(), []).append(fields[0])
+    return hosts
+
+
+class Resolver:
+    # Looks up the address of a recorder's target in the background,
+    # once when started and then every `interval` seconds if given, so
+    # sending pings never waits for DNS. The address stays pinned until
+    # a lookup returns a different one, failed lookups keep the old one.
+    # Names in `hosts` (see read_hosts()) are never sent to DNS.
+    def __init__(self, recorder, interval=None, hosts=None):
+        self.recorder = recorder
+        self.interval = interval
+        self.hosts = hosts or {}
+        # None until the first successful lookup
+        self.address = None if is_hostname(recorder.target) else recorder.target
+        self._thread = None
+
+    def start(self):
+        # may be called by every recorder sharing us
+        if is_hostname(self.recorder.target) and self._thread is None:
+            # a lookup stuck in getaddrinfo() shouldn't keep us from exiting
+            self._thread = Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def lookup(self):
+        name = self.recorder.target
+        try:
+            return self.hosts[name.lower()][0]
+        except KeyError:
+            return resolve(name)[0]
+
+    def _run(self):
+        while True:
+            try:
+                self.address = self.lookup()
+            except Exception as exc:
+                self.recorder._handle_resolve_error(exc)
+            if self.address is None:
+                wait = RETRY_INTERVAL
+            elif self.interval is None:
+                return
+            else:
+                wait = self.interval
+            if self.recorder.stopped.wait(wait):
+                return
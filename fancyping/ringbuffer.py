@@ -0,0 +1,57 @@
+from array import array
+from math import nan
+
+
+class RingBuffer:
+    # Fixed-size array of floats. Index 0 is the most recently appended
+    # value, like the lists PingRecorder used to insert into at the front.
+    def __init__(self, capacity, typecode='d', fill=nan):
+        self.capacity = capacity
+        self._data = array(typecode, [fill]) * capacity
+        # total number of values ever appended, never wraps
+        self.appended = 0
+
+    def __len__(self):
+        return min(self.appended, self.capacity)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        return self._data[(self.appended - 1 - index) % self.capacity]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def at(self, position):
+        # access by absolute position (0 being the first value ever
+        # appended) as long as it hasn't been overwritten yet
+        if position < self.appended - self.capacity or position >= self.appended:
+            raise IndexError(position)
+        return self._data[position % self.capacity]
+
+    def range(self, start, end):
+        # copy of the values at absolute positions [start, end), oldest
+        # first
+        if start < self.appended - self.capacity or end > self.appended:
+            raise IndexError((start, end))
+        first = start % self.capacity
+        if end - start <= self.capacity - first:
+            return self._data[first:first + end - start]
+        return self._data[first:] + self._data[:end % self.capacity]
+
+    def bisect(self, value):
+        # like bisect.bisect_right() for sorted contents: absolute
+        # position of the first value greater than value
+        low, high = self.appended - len(self), self.appended
+        while low < high:
+            middle = (low + high) // 2
+            if self._data[middle % self.capacity] <= value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def append(self, value):
+        self._data[self.appended % self.capacity] = value
+        self.appended += 1
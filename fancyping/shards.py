@@ -0,0 +1,498 @@
+from array import array
+from datetime import datetime
+from math import inf, isnan, nan
+from multiprocessing import get_context
+from os import getppid
+from signal import SIG_IGN, SIGINT, SIGTERM, signal
+from threading import Event, Thread
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+from .engines import ProbeScheduler, RateLimit
+from .icmp import PingRecorder, UpdateEvent
+from .metrics import RTT_BUCKETS, ProbeCounters
+from .profiling import PROFILE
+from .stats import Outages, format_outages, format_stats_table
+
+EPOCH = datetime(1970, 1, 1)
+# how often workers copy their recorders into the table and the parent
+# looks for changes
+PUBLISH_INTERVAL = 0.2
+POLL_INTERVAL = 0.1
+# a row that stays mid-write for this long is given up on, its worker
+# probably died
+READ_TIMEOUT = 0.1
+# bytes of each target's error message that are shared, the rest is cut
+ERROR_SIZE = 120
+COUNTERS = (
+    'probes',
+    'lost',
+    'errors',
+    'resolve_errors',
+    'late',
+    'late_rtt_sum',
+    'duplicates',
+    'dropped',
+    'log_dropped',
+    'rtt_sum',
+    'last_reply',
+    'last_loss',
+)
+FIELDS = (
+    # even while nobody is writing, see ShardTable.read()
+    'seq',
+    'stopped',
+    'generation',
+    'end',
+    'count',
+    'lost_streak',
+    'last_rtt',
+    'last_resp',
+    'last_pl',
+    'jitter',
+    'in_flight',
+    'interval',
+    'missed_deadlines',
+    'throttled',
+) + COUNTERS + tuple(f"outages_{name}" for name in Outages._fields)
+# after FIELDS: one per RTT bucket, then (covered, packet loss, 7 rtt
+# stats) for each of PingRecorder.STATS_INTERVALS, NaN until computed
+BUCKETS_AT = len(FIELDS)
+STATS_AT = BUCKETS_AT + len(RTT_BUCKETS) + 1
+STATS_SIZE = 9
+ROW_SIZE = STATS_AT + STATS_SIZE * len(PingRecorder.STATS_INTERVALS)
+F = SimpleNamespace(**{name: i for i, name in enumerate(FIELDS)})
+# memoryviews over the shared arrays, set up again in each process
+VIEWS = ('values', 'errors', 'requests', 'watched')
+TIMEFRAMES = {timeframe: i for i, (timeframe, label) in enumerate(PingRecorder.STATS_INTERVALS)}
+
+
+def to_float(value):
+    if value is None:
+        return nan
+    if isinstance(value, datetime):
+        return (value - EPOCH).total_seconds()
+    return float(value)
+
+
+def to_datetime(value):
+    return None if isnan(value) else datetime.utcfromtimestamp(value)
+
+
+class ShardTable:
+    # Fixed-size rows of floats in shared memory, one per target, that
+    # worker processes write and the parent reads without pickling
+    # anything. Each row is guarded by a sequence number that is odd
+    # while its writer is busy with it (a seqlock), readers retry
+    # instead of waiting. Also shared: per-target reset/report requests
+    # from the parent and when each timeframe was last asked for.
+    def __init__(self, size, context):
+        self.size = size
+        self._values = context.RawArray('d', size * ROW_SIZE)
+        self._errors = context.RawArray('B', size * ERROR_SIZE)
+        self._requests = context.RawArray('q', size * 2)
+        self._watched = context.RawArray('d', len(TIMEFRAMES))
+        self._views()
+
+    def __getstate__(self):
+        # memoryviews can't be sent to workers, the arrays can
+        return {name: value for name, value in self.__dict__.items() if name not in VIEWS}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._views()
+
+    def _views(self):
+        self.values = memoryview(self._values).cast('B').cast('d')
+        self.errors = memoryview(self._errors).cast('B')
+        self.requests = memoryview(self._requests).cast('B').cast('q')
+        self.watched = memoryview(self._watched).cast('B').cast('d')
+
+    def write(self, index, values, error):
+        base = index * ROW_SIZE
+        seq = self.values[base]
+        self.values[base] = seq + 1
+        self.values[base + 1:base + ROW_SIZE] = values
+        error = (error or "").encode('utf-8')[:ERROR_SIZE]
+        self.errors[index * ERROR_SIZE:(index + 1) * ERROR_SIZE] = error.ljust(ERROR_SIZE, b"\0")
+        self.values[base] = seq + 2
+
+    def read(self, index):
+        # (values, error) of a row as it was between two writes, None
+        # if it stays mid-write
+        base = index * ROW_SIZE
+        deadline = None
+        while True:
+            seq = self.values[base]
+            if seq % 2:
+                if deadline is None:
+                    deadline = monotonic() + READ_TIMEOUT
+                elif monotonic() > deadline:
+                    return None
+                sleep(0)
+                continue
+            values = self.values[base:base + ROW_SIZE].tolist()
+            error = bytes(self.errors[index * ERROR_SIZE:(index + 1) * ERROR_SIZE])
+            if self.values[base] == seq:
+                return values, error.rstrip(b"\0").decode('utf-8', errors='ignore') or None
+
+    def seq(self, index):
+        return self.values[index * ROW_SIZE]
+
+    def watch(self, timeframe):
+        self.watched[TIMEFRAMES[timeframe]] = monotonic() + PingRecorder.WATCH_TIMEOUT
+
+    def watched_timeframes(self):
+        now = monotonic()
+        return [
+            timeframe for timeframe, i in TIMEFRAMES.items()
+            if self.watched[i] >= now
+        ]
+
+
+def row(ping_recorder, timeframes):
+    # what goes into the table for ping_recorder, minus the sequence number
+    snapshot = ping_recorder.snapshot
+    counters = snapshot.counters
+    engine = ping_recorder._engine
+    schedule = engine.schedule
+    values = [nan] * ROW_SIZE
+    values[F.stopped] = float(ping_recorder.stopped.is_set())
+    values[F.generation] = snapshot.generation
+    values[F.end] = snapshot.end
+    values[F.count] = snapshot.count
+    values[F.lost_streak] = snapshot.lost_streak
+    values[F.last_rtt] = to_float(snapshot.last_rtt)
+    values[F.last_resp] = to_float(snapshot.last_resp)
+    values[F.last_pl] = to_float(snapshot.last_pl)
+    values[F.jitter] = to_float(snapshot.jitter)
+    values[F.in_flight] = engine.in_flight
+    if schedule is not None:
+        values[F.interval] = schedule.interval_ns / 1000000000
+        values[F.missed_deadlines] = schedule.missed_deadlines
+        values[F.throttled] = schedule.throttled
+    for name in COUNTERS:
+        values[getattr(F, name)] = to_float(getattr(counters, name))
+    for name, value in zip(Outages._fields, snapshot.outages):
+        values[getattr(F, f"outages_{name}")] = to_float(value)
+    values[BUCKETS_AT:STATS_AT] = counters.rtt_buckets
+    for timeframe in timeframes:
+        covered, packet_loss, rtt_stats = ping_recorder._stats_of(timeframe)
+        at = STATS_AT + TIMEFRAMES[timeframe] * STATS_SIZE
+        values[at] = covered
+        values[at + 1] = packet_loss
+        if rtt_stats is not None:
+            values[at + 2:at + STATS_SIZE] = rtt_stats
+    return array('d', values[1:]), snapshot.error
+
+
+def run_worker(table, offset, targets, pargs, stop, worker):
+    # Runs in each worker process: pings targets like a multi-target
+    # fancyping would and copies their state into rows offset and up of
+    # table until stop is set (a shared flag), the parent goes away or
+    # all are done.
+    from .cmdline import multi_recorders
+
+    # signals are for the parent, it stops us through `stop`
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, SIG_IGN)
+    # each worker gets its share of --max-rate
+    if pargs.max_rate is not None:
+        pargs.rate_limit = RateLimit(pargs.max_rate / pargs.workers, pargs.burst)
+    scheduler = ProbeScheduler()
+    ping_recorders = multi_recorders(targets, pargs, scheduler)
+    for ping_recorder in ping_recorders:
+        ping_recorder.start()
+    scheduler.start()
+    requests = [(0, 0)] * len(ping_recorders)
+    written = [None] * len(ping_recorders)
+    # we get a new parent once ours is gone (multiprocessing's
+    # parent_process() needs Python 3.8)
+    parent = getppid()
+    while (
+        not sleep(PUBLISH_INTERVAL)
+        and not stop.value
+        and getppid() == parent
+        and not all(r.stopped.is_set() for r in ping_recorders)
+    ):
+        timeframes = table.watched_timeframes()
+        for i, ping_recorder in enumerate(ping_recorders):
+            index = offset + i
+            resets, reports = table.requests[index * 2:index * 2 + 2]
+            if resets != requests[i][0]:
+                ping_recorder.reset()
+            if reports != requests[i][1]:
+                ping_recorder.report_write_full(pargs.report_format)
+            requests[i] = (resets, reports)
+            # nothing new to copy unless the recorder published since
+            snapshot = ping_recorder.snapshot
+            if written[i] is not None and written[i][0] is snapshot and written[i][1] == timeframes:
+                continue
+            table.write(index, *row(ping_recorder, timeframes))
+            written[i] = (snapshot, timeframes)
+    for ping_recorder in ping_recorders:
+        ping_recorder.stop()
+    scheduler.stop()
+    # everything the final report needs
+    for i, ping_recorder in enumerate(ping_recorders):
+        ping_recorder.flush()
+        table.write(offset + i, *row(ping_recorder, list(TIMEFRAMES)))
+    if pargs.profile_out:
+        # atexit doesn't run in worker processes
+        PROFILE.write(f"{pargs.profile_out}.{worker}")
+
+
+class ShardedRecorder:
+    # Stands in for a PingRecorder running in a worker process, reading
+    # its state from the row the worker keeps up to date. Good for the
+    # grid UI, the metrics exporter and final reports, not for the
+    # single target UI (no history is shared).
+    STATS_INTERVALS = PingRecorder.STATS_INTERVALS
+    OUTAGE_TIMEFRAME = PingRecorder.OUTAGE_TIMEFRAME
+
+    def __init__(self, target, table, index, worker, updated=None):
+        self.target = target
+        # index of the worker process pinging target
+        self.worker = worker
+        self.stopped = Event()
+        # see PingRecorder.updated
+        self.updated = UpdateEvent() if updated is None else updated
+        self._table = table
+        self._index = index
+        self._seq = None
+        self._values = [nan] * ROW_SIZE
+        self._error = None
+
+    def refresh(self, worker_alive=True):
+        # called by ShardPool every POLL_INTERVAL
+        seq = self._table.seq(self._index)
+        if seq != self._seq:
+            previous = (self._values[F.generation], self._values[F.end], self._error)
+            row = self._table.read(self._index)
+            if row is not None:
+                self._values, self._error = row
+                self._seq = self._values[0]
+                # like PingRecorder._publish(), only wake up the UI for news
+                if self._values[F.stopped] == 1 and not self.stopped.is_set():
+                    self.stopped.set()
+                    self.updated.set()
+                if (self._values[F.generation], self._values[F.end], self._error) != previous:
+                    self.updated.set()
+        if not worker_alive and not self.stopped.is_set():
+            self._down()
+
+    def _down(self):
+        # the worker died without writing a final row, nothing more is
+        # coming from it
+        values = list(self._values)
+        if isnan(values[F.count]) or not values[F.count]:
+            values[F.count] = 1
+        values[F.lost_streak] = inf
+        self._values = values
+        self._error = "worker process died"
+        self.stopped.set()
+        self.updated.set()
+
+    def is_alive(self, loss_tolerance=1):
+        count = self._values[F.count]
+        if not count or isnan(count):
+            return None
+        return self._values[F.lost_streak] < min(loss_tolerance, count)
+
+    @property
+    def last_rtt(self):
+        value = self._values[F.last_rtt]
+        return None if isnan(value) else value
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def last_resp(self):
+        return to_datetime(self._values[F.last_resp])
+
+    @property
+    def last_pl(self):
+        return to_datetime(self._values[F.last_pl])
+
+    @property
+    def generation(self):
+        return int(self._values[F.generation])
+
+    @property
+    def jitter(self):
+        value = self._values[F.jitter]
+        return None if isnan(value) else value
+
+    @property
+    def outages(self):
+        count, recent, longest, downtime, bursts, down, streak, since = (
+            self._values[getattr(F, f"outages_{name}")] for name in Outages._fields
+        )
+        if isnan(count):
+            return None
+        return Outages(
+            int(count),
+            int(recent),
+            longest,
+            downtime,
+            int(bursts),
+            bool(down),
+            int(streak),
+            None if isnan(since) else since,
+        )
+
+    def now(self):
+        return datetime.utcnow()
+
+    @property
+    def snapshot(self):
+        # the parts of a Snapshot that render_metrics() uses
+        counters = ProbeCounters()
+        for name in COUNTERS:
+            value = self._values[getattr(F, name)]
+            if name in ('last_reply', 'last_loss'):
+                setattr(counters, name, None if isnan(value) else value)
+            else:
+                setattr(counters, name, 0 if isnan(value) else value)
+        counters.rtt_buckets = [int(count) for count in self._values[BUCKETS_AT:STATS_AT]]
+        return SimpleNamespace(counters=counters, jitter=self.jitter)
+
+    @property
+    def _engine(self):
+        # same here, for the engine and its schedule
+        values = self._values
+        schedule = None
+        if not isnan(values[F.interval]):
+            schedule = SimpleNamespace(
+                interval_ns=values[F.interval] * 1000000000,
+                missed_deadlines=values[F.missed_deadlines],
+                throttled=values[F.throttled],
+            )
+        return SimpleNamespace(in_flight=values[F.in_flight], schedule=schedule)
+
+    def _stats_of(self, timeframe):
+        # Like PingRecorder._stats_of(), the first time around we wait
+        # for a worker to pick up the timeframe, but only so long.
+        self._table.watch(timeframe)
+        at = STATS_AT + TIMEFRAMES[timeframe] * STATS_SIZE
+        deadline = monotonic() + PUBLISH_INTERVAL * 5
+        while isnan(self._values[at]) and monotonic() < deadline and not self.stopped.is_set():
+            sleep(POLL_INTERVAL)
+            self.refresh()
+        values = self._values[at:at + STATS_SIZE]
+        if isnan(values[0]):
+            return False, 1.0, None
+        return bool(values[0]), values[1], None if isnan(values[2]) else tuple(values[2:])
+
+    def packet_loss(self, timeframe):
+        return self._stats_of(timeframe)[1]
+
+    def rtt_stats(self, timeframe):
+        return self._stats_of(timeframe)[2]
+
+    def report_stats(self):
+        # only complete once the worker has stopped, see ShardPool.stop()
+        rows = []
+        for timeframe, label in self.STATS_INTERVALS:
+            covered, packet_loss, rtt_stats = self._stats_of(timeframe)
+            if not covered:
+                break
+            rows.append((label, packet_loss, rtt_stats))
+        table = format_stats_table(rows)
+        footer = []
+        if self.jitter is not None:
+            footer.append(f"JITTER {self.jitter:.2f}ms")
+        late, duplicates = int(self._values[F.late]), int(self._values[F.duplicates])
+        if late or duplicates:
+            footer.append(f"LATE {late}  DUPLICATE {duplicates}")
+        log_dropped = int(self._values[F.log_dropped])
+        if log_dropped:
+            footer.append(f"NOT RECORDED {log_dropped} (disk too slow)")
+        outages = self.outages
+        if outages is not None and outages.since is not None:
+            footer.extend(format_outages(
+                outages,
+                dict(self.STATS_INTERVALS)[self.OUTAGE_TIMEFRAME],
+            ))
+        if footer:
+            table += "\n\n" + "\n".join(footer)
+        return table
+
+    def _request(self, offset):
+        self._table.requests[self._index * 2 + offset] += 1
+
+    def report_write_full(self, report_format="text"):
+        # written by the worker, with the format it was started with
+        self._request(1)
+        return True
+
+    def reset(self):
+        self._request(0)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class ShardPool:
+    # Splits targets into contiguous slices, one per worker process,
+    # and keeps a ShardedRecorder for each target up to date.
+    def __init__(self, targets, workers, pargs):
+        context = get_context('spawn')
+        self.table = ShardTable(len(targets), context)
+        self.recorders = []
+        # shared by all recorders, see grid_main()
+        updated = UpdateEvent()
+        # not an Event: setting one waits for everybody waiting on it to
+        # wake up, which a killed worker never does
+        self._stop = context.RawValue('b', 0)
+        self._stopped = Event()
+        # rebuilt by each worker, see run_worker()
+        pargs.rate_limit = None
+        self._processes = []
+        per_worker, remainder = divmod(len(targets), workers)
+        offset = 0
+        for worker in range(workers):
+            size = per_worker + (worker < remainder)
+            self.recorders.extend(
+                ShardedRecorder(target, self.table, offset + i, worker, updated)
+                for i, target in enumerate(targets[offset:offset + size])
+            )
+            self._processes.append(context.Process(
+                target=run_worker,
+                args=(self.table, offset, targets[offset:offset + size], pargs, self._stop, worker),
+                name=f"fancyping-worker-{worker}",
+                daemon=True,
+            ))
+            offset += size
+        self._thread = Thread(target=self._poll, name="fancyping-shards", daemon=True)
+
+    def start(self):
+        for process in self._processes:
+            process.start()
+        self._thread.start()
+
+    def _poll(self):
+        while not self._stopped.wait(POLL_INTERVAL):
+            self.refresh()
+
+    def refresh(self):
+        alive = [process.is_alive() for process in self._processes]
+        for recorder in self.recorders:
+            recorder.refresh(alive[recorder.worker])
+
+    def stop(self):
+        # waits for the workers' final rows, so reports are complete
+        self._stop.value = 1
+        for process in self._processes:
+            process.join()
+        self._stopped.set()
+        self._thread.join()
+        self.refresh()
+        for recorder in self.recorders:
+            recorder.stopped.set()
+
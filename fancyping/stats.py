@@ -0,0 +1,612 @@
+from array import array
+from bisect import bisect_left
+from collections import deque, namedtuple
+from datetime import datetime
+from heapq import heappop, heappush, heapify
+from math import ceil, log, nan
+
+from .ringbuffer import RingBuffer
+
+# median and tail latency percentiles shown in stats tables
+PERCENTILES = (50, 90, 99, 99.9)
+# finished outages OutageIndex can count within a timeframe
+OUTAGE_HISTORY = 1024
+
+
+def percentile(sorted_values, p):
+    # linear interpolation, same as numpy.percentile()
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class SlidingMedian:
+    # Two heaps split at the median, with lazy deletion. Elements are
+    # (value, index) tuples so equal RTTs remain distinguishable when
+    # they leave the window.
+    def __init__(self):
+        self._low = []  # max-heap of (-value, -index)
+        self._high = []  # min-heap of (value, index)
+        self._low_size = 0
+        self._high_size = 0
+        self._removed = set()
+
+    def __len__(self):
+        return self._low_size + self._high_size
+
+    def _prune(self, heap):
+        while heap and abs(heap[0][1]) in self._removed:
+            self._removed.discard(abs(heappop(heap)[1]))
+
+    def _low_max(self):
+        value, index = self._low[0]
+        return -value, -index
+
+    def _rebalance(self):
+        if self._low_size > self._high_size + 1:
+            value, index = self._low_max()
+            heappop(self._low)
+            heappush(self._high, (value, index))
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune(self._low)
+        elif self._low_size < self._high_size:
+            value, index = heappop(self._high)
+            heappush(self._low, (-value, -index))
+            self._low_size += 1
+            self._high_size -= 1
+            self._prune(self._high)
+
+    def _compact(self):
+        # lazily deleted entries deep inside the heaps would otherwise
+        # accumulate forever
+        if len(self._low) + len(self._high) > 2 * len(self) + 64:
+            self._low = [e for e in self._low if -e[1] not in self._removed]
+            self._high = [e for e in self._high if e[1] not in self._removed]
+            heapify(self._low)
+            heapify(self._high)
+            self._removed.clear()
+
+    def add(self, value, index):
+        if not self._low or (value, index) < self._low_max():
+            heappush(self._low, (-value, -index))
+            self._low_size += 1
+        else:
+            heappush(self._high, (value, index))
+            self._high_size += 1
+        self._rebalance()
+
+    def remove(self, value, index):
+        self._removed.add(index)
+        if (value, index) <= self._low_max():
+            self._low_size -= 1
+            self._prune(self._low)
+        else:
+            self._high_size -= 1
+            self._prune(self._high)
+        self._rebalance()
+        self._compact()
+
+    @property
+    def median(self):
+        if self._low_size > self._high_size:
+            return self._low_max()[0]
+        return (self._low_max()[0] + self._high[0][0]) / 2
+
+
+class QuantileSketch:
+    # DDSketch: values are counted in logarithmically sized buckets, so
+    # every quantile is within relative_accuracy of the true value and
+    # memory depends on the range of values (a few hundred buckets for
+    # 1µs to 10s) rather than their number. Unlike most sketches it
+    # also supports removal, which sliding windows need.
+    ZERO_KEY = -32768  # values below min_value, sorts first
+
+    def __init__(self, relative_accuracy=0.01, min_value=0.001):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.min_value = min_value
+        self.count = 0
+        self._log_gamma = log(self.gamma)
+        self._counts = {}
+        self._keys = []  # sorted
+
+    def _key(self, value):
+        if value < self.min_value:
+            return self.ZERO_KEY
+        return ceil(log(value) / self._log_gamma)
+
+    def _add_key(self, key, count):
+        self.count += count
+        total = self._counts.get(key, 0) + count
+        if total:
+            if key not in self._counts:
+                self._keys.insert(bisect_left(self._keys, key), key)
+            self._counts[key] = total
+        else:
+            del self._counts[key]
+            del self._keys[bisect_left(self._keys, key)]
+
+    def add(self, value):
+        self._add_key(self._key(value), 1)
+
+    def remove(self, value):
+        self._add_key(self._key(value), -1)
+
+    def export(self):
+        # compact (keys, counts) arrays for merge()
+        return array('h', self._keys), array('I', (self._counts[key] for key in self._keys))
+
+    def merge(self, keys, counts, sign=1):
+        # add (or with sign=-1, remove) an exported sketch
+        for key, count in zip(keys, counts):
+            self._add_key(key, sign * count)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = int(q * (self.count - 1))
+        seen = 0
+        for key in self._keys:
+            seen += self._counts[key]
+            if seen > rank:
+                if key == self.ZERO_KEY:
+                    return 0.0
+                # midpoint of the bucket (in relative terms)
+                return 2 * self.gamma ** key / (self.gamma + 1)
+
+
+class Jitter:
+    # Interarrival jitter as defined in RFC 3550 (section 6.4.1): a
+    # running average of the difference in transit time of successive
+    # packets, which for pings is the difference in RTT. Lost pings
+    # are skipped.
+    def __init__(self):
+        self.value = None
+        self._last = None
+
+    def add(self, rtt):
+        if rtt != rtt:
+            return
+        if self._last is not None:
+            if self.value is None:
+                self.value = 0.0
+            self.value += (abs(rtt - self._last) - self.value) / 16
+        self._last = rtt
+
+
+# What OutageIndex.summary() returns. Durations are in seconds, since
+# is the epoch time the current streak of up or down pings began.
+Outages = namedtuple('Outages', (
+    'count',
+    'recent',
+    'longest',
+    'downtime',
+    'bursts',
+    'down',
+    'streak',
+    'since',
+))
+
+
+class OutageIndex:
+    # Up/down transitions, kept up to date as pings are recorded. Like
+    # PingRecorder.is_alive(), the target is down once loss_tolerance
+    # pings in a row (or all of them so far) were lost, as of the first
+    # of those, and back up with the next reply. Ends of finished
+    # outages are kept in order so counting the ones in a timeframe is
+    # a bisection, everything else is a running total. Runs of lost
+    # pings too short to be an outage count as loss bursts.
+    def __init__(self, loss_tolerance=1):
+        self.loss_tolerance = max(loss_tolerance, 1)
+        self._ends = RingBuffer(OUTAGE_HISTORY)
+        self.count = 0
+        self.longest = 0.0
+        self.downtime = 0.0
+        self.bursts = 0
+        self.down = False
+        self.streak = 0
+        self.since = None
+        self._seen = 0
+        # (monotonic, epoch) time of the first ping of the current run
+        # of lost ones
+        self._lost = 0
+        self._lost_since = None
+
+    def add(self, rtt, timestamp, sent_time):
+        # timestamp is monotonic like WindowStats', sent_time epoch
+        self._seen += 1
+        if self.since is None:
+            self.since = sent_time
+        self.streak += 1
+        if rtt != rtt:
+            if not self._lost:
+                self._lost_since = (timestamp, sent_time)
+            self._lost += 1
+            if not self.down and self._lost >= min(self.loss_tolerance, self._seen):
+                self.down = True
+                self.count += 1
+                self.streak = self._lost
+                self.since = self._lost_since[1]
+            return
+        if self.down:
+            duration = timestamp - self._lost_since[0]
+            self.downtime += duration
+            self.longest = max(self.longest, duration)
+            self._ends.append(timestamp)
+            self.down = False
+            self.streak = 1
+            self.since = sent_time
+        elif self._lost:
+            self.bursts += 1
+        self._lost = 0
+
+    def summary(self, now, timeframe):
+        # as of monotonic time now, recent counting outages that ended
+        # within timeframe or are still going on
+        ends = self._ends
+        recent = ends.appended - ends.bisect(now - timeframe) + self.down
+        longest = self.longest
+        if self.down:
+            longest = max(longest, now - self._lost_since[0])
+        return Outages(
+            self.count,
+            recent,
+            longest,
+            self.downtime,
+            self.bursts,
+            self.down,
+            self.streak,
+            self.since,
+        )
+
+
+def format_duration(seconds):
+    h, remainder = divmod(int(seconds), 3600)
+    m, s = divmod(remainder, 60)
+    if h:
+        return f"{h}h {m}m {s}s"
+    if m:
+        return f"{m}m {s}s"
+    return f"{seconds:.1f}s"
+
+
+def format_outages(outages, label):
+    # lines for reports once there was a ping, label describes the
+    # timeframe of outages.recent
+    finished = outages.count - outages.down
+    lines = [
+        f"OUTAGES {outages.count} ({outages.recent} in {label})  "
+        f"BURSTS {outages.bursts}"
+    ]
+    if outages.count:
+        lines.append(
+            f"LONGEST {format_duration(outages.longest)}" +
+            (f"  MTTR {format_duration(outages.downtime / finished)}" if finished else "")
+        )
+    lines.append(
+        f"{'DOWN' if outages.down else 'UP'} {outages.streak} pings since "
+        f"{datetime.utcfromtimestamp(outages.since).strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    )
+    return lines
+
+
+class WindowStats:
+    # Running statistics over the samples in a RingBuffer that were sent
+    # within the last `timeframe` seconds, going by a second RingBuffer
+    # of sorted timestamps. Values leaving the window are read back from
+    # the buffer, so add() must be called *before* the value is appended
+    # to the buffers. An exact median needs every sample in the window
+    # in its heaps though, without exact_median it comes from the sketch
+    # like the other percentiles.
+    def __init__(self, buffer, times, timeframe, exact_median=True):
+        self.buffer = buffer
+        self.times = times
+        self.timeframe = timeframe
+        self.exact_median = exact_median
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.lost = 0
+        # whether the window reaches back all of timeframe, i.e. samples
+        # have left it for being too old rather than for lack of space
+        self.covered = False
+        # sum of RTTs in ns, integers don't drift when subtracting
+        self._sum = 0
+        self._start = self.buffer.appended
+        self._min = deque()
+        self._max = deque()
+        self._median = SlidingMedian() if self.exact_median else None
+        self._sketch = QuantileSketch()
+
+    def expire(self, now):
+        # drop samples sent more than timeframe before now
+        cutoff = now - self.timeframe
+        while self.count and self.times.at(self._start) <= cutoff:
+            self._evict()
+            self.covered = True
+
+    def add(self, value, timestamp):
+        index = self.buffer.appended
+        self.expire(timestamp)
+        if self.count >= self.buffer.capacity:
+            # about to be overwritten in the buffer
+            self._evict()
+            self.covered = False
+        self.count += 1
+        if value != value:  # NaN
+            self.lost += 1
+            return
+        self._sum += round(value * 1000000)
+        while self._min and self._min[-1][0] >= value:
+            self._min.pop()
+        self._min.append((value, index))
+        while self._max and self._max[-1][0] <= value:
+            self._max.pop()
+        self._max.append((value, index))
+        if self._median is not None:
+            self._median.add(value, index)
+        self._sketch.add(value)
+
+    def _evict(self):
+        index = self._start
+        value = self.buffer.at(index)
+        self._start += 1
+        self.count -= 1
+        if value != value:
+            self.lost -= 1
+            return
+        self._sum -= round(value * 1000000)
+        if self._min[0][1] == index:
+            self._min.popleft()
+        if self._max[0][1] == index:
+            self._max.popleft()
+        if self._median is not None:
+            self._median.remove(value, index)
+        self._sketch.remove(value)
+
+    @property
+    def packet_loss(self):
+        if not self.count:
+            return 1.0
+        return self.lost / self.count
+
+    @property
+    def rtt_stats(self):
+        # mean, median, min, max and then PERCENTILES[1:] (approximated
+        # to within 1%, as is the median without exact_median)
+        received = self.count - self.lost
+        if not received:
+            return None
+        return (
+            self._sum / received / 1000000,
+            self._sketch.quantile(0.5) if self._median is None else self._median.median,
+            self._min[0][0],
+            self._max[0][0],
+        ) + tuple(self._sketch.quantile(p / 100) for p in PERCENTILES[1:])
+
+
+class Rollup:
+    # Aggregates samples into consecutive buckets of `width` seconds and
+    # keeps the last `capacity` completed ones. Stretches without any
+    # samples become empty buckets, so bucket positions map to time.
+    # Samples come in by send time, but only once the ping is done: a
+    # bucket is only completed for lack of samples once `delay` seconds
+    # have passed since its end, by then all of its pings are in.
+    def __init__(self, width, capacity, delay=0):
+        self.width = width
+        self.capacity = capacity
+        self.delay = delay
+        self.counts = RingBuffer(capacity, 'I', 0)
+        self.lost = RingBuffer(capacity, 'I', 0)
+        self.sums = RingBuffer(capacity, 'q', 0)  # ns
+        self.mins = RingBuffer(capacity)
+        self.maxs = RingBuffer(capacity)
+        self._sketches = [None] * capacity
+        # RolledWindows to update when a bucket is completed
+        self.windows = []
+        self._bucket = None
+        self._clear()
+
+    def _clear(self):
+        self._count = 0
+        self._lost = 0
+        self._sum = 0
+        self._min = nan
+        self._max = nan
+        self._sketch = QuantileSketch()
+
+    @property
+    def current(self):
+        # (count, lost, sum, min, max, sketch) of the bucket in progress
+        return self._count, self._lost, self._sum, self._min, self._max, self._sketch
+
+    def sketch(self, position):
+        # exported sketch of the completed bucket at absolute position
+        self.counts.at(position)  # raises IndexError like the others
+        return self._sketches[position % self.capacity]
+
+    def advance(self, timestamp):
+        # complete all buckets before the one timestamp falls into
+        bucket = int(timestamp // self.width)
+        if self._bucket is None:
+            self._bucket = bucket
+        elif bucket > self._bucket:
+            # windows can't be longer than capacity, so more empty
+            # buckets than that wouldn't change anything
+            for i in range(min(bucket - self._bucket, self.capacity + 1)):
+                self._complete()
+            self._bucket = bucket
+
+    def add(self, timestamp, value):
+        self.advance(timestamp)
+        if int(timestamp // self.width) < self._bucket:
+            # Its bucket was completed (by a ping that took longer than
+            # delay to come in) and windows have already counted it,
+            # don't pass the sample off as a newer one
+            return
+        self._count += 1
+        if value != value:
+            self._lost += 1
+            return
+        self._sum += round(value * 1000000)
+        if not self._min <= value:  # also true for NaN
+            self._min = value
+        if not self._max >= value:
+            self._max = value
+        self._sketch.add(value)
+
+    def _complete(self):
+        sketch = self._sketch.export()
+        # windows need to see the bucket before it's in the buffers
+        for window in self.windows:
+            window.add_bucket(self._count, self._lost, self._sum, self._min, self._max, sketch)
+        self._sketches[self.counts.appended % self.capacity] = sketch
+        self.counts.append(self._count)
+        self.lost.append(self._lost)
+        self.sums.append(self._sum)
+        self.mins.append(self._min)
+        self.maxs.append(self._max)
+        self._clear()
+
+
+class RolledWindow:
+    # Like WindowStats, but over the newest `size` completed buckets of
+    # a Rollup, so it only moves once per bucket width. Median and
+    # percentiles come from the merged bucket sketches.
+    def __init__(self, rollup, size):
+        self.rollup = rollup
+        self.size = min(size, rollup.capacity)
+        rollup.windows.append(self)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.lost = 0
+        self._buckets = 0
+        self._sum = 0
+        self._start = self.rollup.counts.appended
+        self._min = deque()
+        self._max = deque()
+        self._sketch = QuantileSketch()
+
+    def add_bucket(self, count, lost, total, minimum, maximum, sketch):
+        index = self.rollup.counts.appended
+        if self._buckets >= self.size:
+            self._evict()
+        self._buckets += 1
+        self.count += count
+        self.lost += lost
+        if count == lost:
+            return
+        self._sum += total
+        while self._min and self._min[-1][0] >= minimum:
+            self._min.pop()
+        self._min.append((minimum, index))
+        while self._max and self._max[-1][0] <= maximum:
+            self._max.pop()
+        self._max.append((maximum, index))
+        self._sketch.merge(*sketch)
+
+    def _evict(self):
+        rollup = self.rollup
+        index = self._start
+        count = rollup.counts.at(index)
+        lost = rollup.lost.at(index)
+        self._start += 1
+        self._buckets -= 1
+        self.count -= count
+        self.lost -= lost
+        if count == lost:
+            return
+        self._sum -= rollup.sums.at(index)
+        if self._min[0][1] == index:
+            self._min.popleft()
+        if self._max[0][1] == index:
+            self._max.popleft()
+        self._sketch.merge(*rollup.sketch(index), sign=-1)
+
+    @property
+    def covered(self):
+        return self._buckets >= self.size
+
+    def expire(self, now):
+        # complete buckets even if no samples came in to do it
+        self.rollup.advance(now - self.rollup.delay)
+
+    def _totals(self):
+        # until the window is covered, the bucket in progress is
+        # included so it shows everything recorded so far
+        minimum = self._min[0][0] if self._min else nan
+        maximum = self._max[0][0] if self._max else nan
+        if self.covered:
+            return self.count, self.lost, self._sum, minimum, maximum, self._sketch
+        count, lost, total, current_min, current_max, current_sketch = self.rollup.current
+        sketch = QuantileSketch()
+        sketch.merge(*self._sketch.export())
+        sketch.merge(*current_sketch.export())
+        return (
+            self.count + count,
+            self.lost + lost,
+            self._sum + total,
+            min(minimum, current_min, key=lambda v: v if v == v else float('inf')),
+            max(maximum, current_max, key=lambda v: v if v == v else float('-inf')),
+            sketch,
+        )
+
+    @property
+    def packet_loss(self):
+        count, lost = self._totals()[:2]
+        if not count:
+            return 1.0
+        return lost / count
+
+    @property
+    def rtt_stats(self):
+        # like WindowStats.rtt_stats, but the median is approximated too
+        count, lost, total, minimum, maximum, sketch = self._totals()
+        received = count - lost
+        if not received:
+            return None
+        return (
+            total / received / 1000000,
+            sketch.quantile(0.5),
+            minimum,
+            maximum,
+        ) + tuple(sketch.quantile(p / 100) for p in PERCENTILES[1:])
+
+
+def format_stats_table(rows):
+    # rows are (label, packet loss, rtt stats as returned by
+    # PingRecorder.rtt_stats() or None)
+    lines = [
+        "TIME  " +
+        "AVG".rjust(9) +
+        "MED".rjust(9) +
+        "MIN".rjust(9) +
+        "MAX".rjust(9) +
+        "P/L".rjust(7) +
+        "".join(f"P{p:g}".rjust(9) for p in PERCENTILES[1:])
+    ]
+    for label, pl, stats in rows:
+        if stats:
+            lines.append(
+                f"{label.rjust(4)}  "
+                f"{stats[0]:9.2f}"
+                f"{stats[1]:9.2f}"
+                f"{stats[2]:9.2f}"
+                f"{stats[3]:9.2f}"
+                f"{pl * 100:6.1f}%" +
+                "".join(f"{value:9.2f}" for value in stats[4:])
+            )
+        else:
+            lines.append(
+                f"{label.rjust(4)}  "
+                f"{' ':<9}"
+                f"{' ':<9}"
+                f"{' ':<9}"
+                f"{' ':<9}"
+                f"{pl * 100:6.1f}%"
+            )
+    return "\n".join(lines)
@@ -0,0 +1,118 @@
+from icmplib import is_ipv6_address
+
+from .engines import ProbeScheduler
+from .icmp import PingRecorder
+
+# columns of the size by stats interval matrix
+SWEEP_INTERVALS = (10, 60, 60 * 10, 60 * 60)
+# raw history kept per size, see path.HOP_HISTORY
+SWEEP_HISTORY = 60 * 60
+# IP and ICMP headers on top of the payload
+HEADER_SIZES = {4: 20 + 8, 6: 40 + 8}
+
+
+def parse_sizes(value):
+    # "56,1400,1472" for argparse
+    try:
+        sizes = sorted({int(size) for size in value.split(",") if size.strip()})
+    except ValueError:
+        sizes = []
+    if not sizes or sizes[0] < 0 or sizes[-1] > 65507:
+        raise ValueError(f"expected comma separated payload sizes, got {value!r}")
+    return sizes
+
+
+class Sweep:
+    # A PingRecorder for each of several payload sizes to the target of
+    # ping_recorder. They share a scheduler that interleaves their
+    # probes over the interval, so each size is probed every interval
+    # and large packets being dropped shows up as loss for those sizes
+    # only. With dont_fragment, sizes over the path MTU fail instead of
+    # being fragmented, which brackets the path MTU.
+    def __init__(self, ping_recorder, sizes, dont_fragment=False):
+        self.ping_recorder = ping_recorder
+        self.dont_fragment = dont_fragment
+        self.scheduler = ProbeScheduler(privileged=ping_recorder.privileged)
+        self.sizes = [
+            PingRecorder(
+                ping_recorder.target,
+                interval=ping_recorder.interval,
+                payload_size=size,
+                timeout=ping_recorder.timeout,
+                history=SWEEP_HISTORY,
+                privileged=ping_recorder.privileged,
+                scheduler=self.scheduler,
+                resolver=ping_recorder._resolver,
+                # shared with the target, so --max-rate caps all sizes
+                rate_limit=ping_recorder.rate_limit,
+                dont_fragment=dont_fragment,
+            )
+            for size in sizes
+        ]
+
+    def start(self):
+        for size in self.sizes:
+            size.start()
+        self.scheduler.start()
+
+    def stop(self):
+        for size in self.sizes:
+            size.stop()
+        self.scheduler.stop()
+
+    def reset(self):
+        for size in self.sizes:
+            size.reset()
+
+    def path_mtu(self):
+        # (largest packet size that got replies lately, smallest larger
+        # one that didn't), either may be None. Only means something
+        # with dont_fragment, otherwise large packets are fragmented.
+        address = self.ping_recorder.address
+        header = HEADER_SIZES[6 if address and is_ipv6_address(address) else 4]
+        passed = failed = None
+        for size in self.sizes:
+            packet_loss = size.packet_loss(SWEEP_INTERVALS[0])
+            if packet_loss < 1:
+                passed, failed = size.payload_size + header, None
+            elif failed is None and size.counters.probes + size.counters.errors:
+                failed = size.payload_size + header
+        return passed, failed
+
+    def table(self, timeframe):
+        # lines of text: packet loss for each size (rows) and stats
+        # interval (columns), then the average RTT over timeframe
+        labels = dict(PingRecorder.STATS_INTERVALS)
+        lines = [
+            "SIZE" +
+            "".join(f"{labels[column]} P/L".rjust(10) for column in SWEEP_INTERVALS) +
+            f"{labels.get(timeframe, '')} AVG".rjust(11) + "  LAST"
+        ]
+        for size in self.sizes:
+            line = f"{size.payload_size:4d}" + "".join(
+                f"{size.packet_loss(column) * 100:9.1f}%" for column in SWEEP_INTERVALS
+            )
+            rtt_stats = size.rtt_stats(timeframe)
+            line += " " * 11 if not rtt_stats else f"{rtt_stats[0]:9.2f}ms"
+            if size.last_rtt is not None:
+                line += f"  {size.last_rtt:.2f}ms"
+            elif size.error:
+                line += f"  {size.error}"
+            lines.append(line.rstrip())
+        if not self.dont_fragment:
+            return lines
+        passed, failed = self.path_mtu()
+        if passed is not None and failed == passed + 1:
+            lines.append(f"PMTU {passed} B")
+        elif passed is not None and failed is not None:
+            lines.append(f"PMTU {passed}-{failed - 1} B")
+        elif passed is not None:
+            lines.append(f"PMTU >= {passed} B")
+        elif failed is not None:
+            lines.append(f"PMTU < {failed} B")
+        return lines
+
+    def report(self):
+        for size in self.sizes:
+            size.flush()
+        return "SIZES\n" + "\n".join(self.table(SWEEP_INTERVALS[-1]))
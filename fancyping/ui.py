@@ -1,9 +1,17 @@
-from copy import deepcopy
+from collections import deque
+from copy import copy
 import curses
-from datetime import datetime
-from time import sleep
+import os
+import selectors
+import signal
+import sys
+from time import monotonic, perf_counter_ns
 from types import SimpleNamespace
 
+from .icmp import PingRecorder
+from .profiling import PROFILE
+from .stats import format_duration
+
 COLOR_FULL_BLACK = 1
 COLOR_FULL_RED = 2
 COLOR_FULL_BLUE = 3
@@ -12,6 +20,9 @@ COLOR_DEFAULT = 5
 COLOR_RED = 6
 COLOR_GREEN = 7
 COLOR_BLACK = 8
+COLOR_TILE_UP = 9
+COLOR_TILE_DOWN = 10
+COLOR_TILE_UNKNOWN = 11
 
 HISTOGRAM_CHARS = [
     "▁",
@@ -24,19 +35,36 @@ HISTOGRAM_CHARS = [
     "█",
 ]
 
-INITIAL_STATE = SimpleNamespace(
-    alive=None,
-    box_height=0,
-    box_origin_x=0,
-    box_origin_y=0,
-    box_width=0,
-    histogram_columns=[],
-    histogram_y=[],
-    lines=[],
-    max_line_length=0,
-    screen_size=(0, 0),
-    stats_interval_index=2,
-)
+GRID_TILE_HEIGHT = 5
+# columns between the box and the tables next to it
+PANEL_GAP = 4
+
+
+def initial_state():
+    return SimpleNamespace(
+        alive=None,
+        box_height=0,
+        box_origin_x=0,
+        box_origin_y=0,
+        box_width=0,
+        # PingRecorder.end the histogram is up to date with
+        end=0,
+        # PingRecorder.generation the histogram was built from
+        generation=None,
+        # newest first, shared between successive states
+        histogram_columns=deque(),
+        # columns added since the histogram was last drawn
+        histogram_new=0,
+        histogram_y=[],
+        lines=[],
+        max_line_length=0,
+        # tables right of the box (--path, --sweep) and their width
+        # including the gap to the box
+        panel_lines=[],
+        panel_width=0,
+        screen_size=(0, 0),
+        stats_interval_index=2,
+    )
 
 
 def init_colors():
@@ -49,6 +77,9 @@ def init_colors():
     curses.init_pair(COLOR_RED, curses.COLOR_RED, -1)
     curses.init_pair(COLOR_GREEN, curses.COLOR_GREEN, -1)
     curses.init_pair(COLOR_BLACK, curses.COLOR_BLACK, -1)
+    curses.init_pair(COLOR_TILE_UP, curses.COLOR_BLACK, curses.COLOR_GREEN)
+    curses.init_pair(COLOR_TILE_DOWN, curses.COLOR_WHITE, curses.COLOR_RED)
+    curses.init_pair(COLOR_TILE_UNKNOWN, curses.COLOR_BLACK, curses.COLOR_BLUE)
     try:
         curses.curs_set(False)
     except curses.error:
@@ -56,8 +87,8 @@ def init_colors():
         pass
 
 
-def time_since(prior_time):
-    tsec = (datetime.utcnow() - prior_time).total_seconds()
+def time_since(prior_time, now):
+    tsec = (now - prior_time).total_seconds()
     h, remainder = divmod(tsec, 3600)
     m, s = divmod(remainder, 60)
     result = f"{int(s)}s ago"
@@ -81,18 +112,26 @@ def draw_text(win, state):
 def draw_full_color(win, state):
     if state.alive is None:
         return
-    color = COLOR_FULL_GREEN if state.alive else COLOR_FULL_RED
+    color = curses.color_pair(COLOR_FULL_GREEN if state.alive else COLOR_FULL_RED)
     y, x = state.box_origin_y, state.box_origin_x
     full_height, full_width = win.getmaxyx()
+    # fill a row (or the parts left and right of the box and the
+    # tables next to it) at a time
+    box_left = max(0, x - 2)
+    box_right = x + state.box_width + 2 + state.panel_width
+    box_bottom = y + max(state.box_height, len(state.panel_lines))
     for i in range(full_height - 1):
-        for j in range(full_width - 1):
-            if state.histogram_y and i == min(state.histogram_y) - 1:
-                continue
-            if not (
-                i >= y - 1 and i <= y + state.box_height and
-                j >= x - 2 and j <= x + state.box_width + 1
-            ) and i not in state.histogram_y:
-                win.addstr(i, j, " ", curses.color_pair(color))
+        if i in state.histogram_y or (
+            state.histogram_y and i == min(state.histogram_y) - 1
+        ):
+            continue
+        if i >= y - 1 and i <= box_bottom:
+            if box_left:
+                win.addstr(i, 0, " " * box_left, color)
+            if box_right < full_width - 1:
+                win.addstr(i, box_right, " " * (full_width - 1 - box_right), color)
+        else:
+            win.addstr(i, 0, " " * (full_width - 1), color)
 
 
 def tick_box(win, state, anim):
@@ -119,6 +158,17 @@ def tick_box(win, state, anim):
             yield number_of_ticks
 
 
+def draw_box(win, state):
+    color = COLOR_GREEN if state.alive else COLOR_RED
+    for tick in ticks(
+        state.box_origin_y,
+        state.box_origin_x,
+        state.box_height,
+        state.box_width,
+    ):
+        win.addstr(*tick, curses.color_pair(color))
+
+
 def ticks(y, x, box_height, box_width):
     for i in range(1, box_width - 1):
         yield y, x + i, "▄"
@@ -130,8 +180,89 @@ def ticks(y, x, box_height, box_width):
         yield y + box_height - 2 - i, x + 1, "█"
 
 
-def run_ui(ping_recorder, options):
-    curses.wrapper(main, ping_recorder, options)
+class Wakeups:
+    # Blocks the UI until there is keyboard input, a terminal resize, a
+    # recorder update or a timeout, instead of polling.
+    def __init__(self, ping_recorders):
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sys.stdin, selectors.EVENT_READ)
+        # recorders in the grid share one, see cmdline.multi_recorders()
+        for updated in {id(r.updated): r.updated for r in ping_recorders}.values():
+            self.selector.register(updated, selectors.EVENT_READ)
+
+    def __enter__(self):
+        # route SIGWINCH through a pipe so it interrupts select()
+        self._resize_r, self._resize_w = os.pipe()
+        os.set_blocking(self._resize_r, False)
+        os.set_blocking(self._resize_w, False)
+        self.selector.register(self._resize_r, selectors.EVENT_READ)
+        self._previous_wakeup_fd = signal.set_wakeup_fd(self._resize_w)
+        self._previous_handler = signal.signal(signal.SIGWINCH, lambda signum, frame: None)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        signal.signal(signal.SIGWINCH, self._previous_handler)
+        signal.set_wakeup_fd(self._previous_wakeup_fd)
+        self.selector.close()
+        os.close(self._resize_r)
+        os.close(self._resize_w)
+
+    def wait(self, timeout):
+        for key, events in self.selector.select(timeout):
+            if key.fileobj == self._resize_r:
+                try:
+                    while os.read(self._resize_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                # we took SIGWINCH away from curses, tell it ourselves
+                columns, lines = os.get_terminal_size(sys.__stdout__.fileno())
+                curses.resizeterm(lines, columns)
+
+
+def panel_text(panels, timeframe):
+    # the tables of all panels, one after the other
+    lines = []
+    for panel in panels:
+        if lines:
+            lines.append("")
+        lines.extend(panel.table(timeframe))
+    return lines
+
+
+def draw_panels(win, state):
+    # cut off at the edges of the screen, the box comes first
+    x = state.box_origin_x + state.box_width + PANEL_GAP
+    max_y, max_x = state.screen_size
+    max_y -= len(state.histogram_y) + 1
+    width = min(state.panel_width - PANEL_GAP, max_x - 1 - x)
+    if width <= 0:
+        return
+    for i, line in enumerate(state.panel_lines[:max_y - state.box_origin_y]):
+        win.addstr(
+            state.box_origin_y + i, x,
+            line[:width].ljust(width),
+            curses.color_pair(COLOR_DEFAULT),
+        )
+
+
+def draw_overlay(win):
+    # PROFILE in the top left corner, on top of everything else
+    max_y, max_x = win.getmaxyx()
+    lines = PROFILE.lines()
+    width = min(max(len(line) for line in lines) + 2, max_x - 1)
+    for y, line in enumerate(lines[:max_y - 1]):
+        win.addstr(y, 0, f" {line}".ljust(width)[:width], curses.color_pair(COLOR_DEFAULT))
+
+
+def run_ui(ping_recorder, options, panels=()):
+    with Wakeups([ping_recorder]) as wakeups:
+        curses.wrapper(main, ping_recorder, options, wakeups, panels)
+
+
+def run_grid_ui(ping_recorders, options):
+    with Wakeups(ping_recorders) as wakeups:
+        curses.wrapper(grid_main, ping_recorders, options, wakeups)
 
 
 def box_text(ping_recorder, state):
@@ -159,42 +290,70 @@ def box_text(ping_recorder, state):
             f"MED {rtt_stats[1]:9.2f}ms",
             f"MIN {rtt_stats[2]:9.2f}ms",
             f"MAX {rtt_stats[3]:9.2f}ms",
+            f"P90 {rtt_stats[4]:9.2f}ms",
+            f"P99 {rtt_stats[5]:9.2f}ms",
+            f"P99.9{rtt_stats[6]:8.2f}ms",
         ])
+    if ping_recorder.jitter is not None:
+        lines.append(f"JIT {ping_recorder.jitter:9.2f}ms")
     lines.append(f"P/L {ping_recorder.packet_loss(stats_interval) * 100:10.1f}%")
+    outages = ping_recorder.outages
+    if outages is not None and outages.count:
+        label = dict(ping_recorder.STATS_INTERVALS)[ping_recorder.OUTAGE_TIMEFRAME]
+        lines.extend([
+            f"OUT/{label} {outages.recent:{10 - len(label)}d}",
+            f"LONG {format_duration(outages.longest):>10}",
+        ])
 
     if state.alive and ping_recorder.last_pl:
         lines.extend([
             "",
             "LAST P/L",
-            time_since(ping_recorder.last_pl),
+            time_since(ping_recorder.last_pl, ping_recorder.now()),
         ])
     elif not state.alive and ping_recorder.last_resp:
         lines.extend([
             "",
             "LAST UP",
-            time_since(ping_recorder.last_resp),
+            time_since(ping_recorder.last_resp, ping_recorder.now()),
         ])
     return lines
 
 
-def draw_histogram(win, state):
-    for i, column in enumerate(state.histogram_columns):
-        if i >= state.screen_size[1] - 2:
-            return
-        if column is None:
-            for y in state.histogram_y:
-                win.addstr(
-                    y, state.screen_size[1] - 2 - i,
-                    "╳",
-                    curses.color_pair(COLOR_RED),
-                )
-        else:
-            for y, char in zip(state.histogram_y, column[1:]):
-                win.addstr(
-                    y, state.screen_size[1] - 2 - i,
-                    char,
-                    curses.color_pair(COLOR_GREEN),
-                )
+def histogram_cell(column, row):
+    if column is None:
+        return "╳", COLOR_RED
+    return column[row + 1], COLOR_GREEN
+
+
+def draw_histogram(win, state, full):
+    width = state.screen_size[1] - 2
+    visible = min(len(state.histogram_columns), width)
+    if full or state.histogram_new >= visible:
+        # one addstr per run of equally colored cells in each row
+        for row, y in enumerate(state.histogram_y):
+            x = width - visible + 1
+            run, run_color = "", None
+            for i in range(visible - 1, -1, -1):
+                char, color = histogram_cell(state.histogram_columns[i], row)
+                if color != run_color and run:
+                    win.addstr(y, x, run, curses.color_pair(run_color))
+                    x += len(run)
+                    run = ""
+                run += char
+                run_color = color
+            if run:
+                win.addstr(y, x, run, curses.color_pair(run_color))
+    else:
+        # scroll existing columns to the left (the first column on the
+        # screen is never used) and add the new ones
+        for i in range(state.histogram_new - 1, -1, -1):
+            for row, y in enumerate(state.histogram_y):
+                char, color = histogram_cell(state.histogram_columns[i], row)
+                win.move(y, 1)
+                win.delch()
+                win.addstr(y, width, char, curses.color_pair(color))
+    state.histogram_new = 0
 
 
 def histogram_column(rtt, number_of_lines, upper):
@@ -217,17 +376,24 @@ def histogram_column(rtt, number_of_lines, upper):
     return result
 
 
-def main(stdscr, ping_recorder, options):
+def main(stdscr, ping_recorder, options, wakeups, panels=()):
+    # panels are shown next to the box, see panel_text()
     stdscr.clear()
     stdscr.nodelay(True)
     init_colors()
 
     curses_error = False
-    previous_state = deepcopy(INITIAL_STATE)
+    # redraw everything on the next frame, not just what changed
+    full_redraw = True
+    previous_state = initial_state()
     ticker = None
+    next_frame = 0
+    # toggled with P, survives resets
+    overlay = False
 
     while not ping_recorder.stopped.is_set():
-        state = deepcopy(previous_state)
+        woken = perf_counter_ns()
+        state = copy(previous_state)
         state.screen_size = stdscr.getmaxyx()
         try:
             key = stdscr.getkey()
@@ -236,33 +402,60 @@ def main(stdscr, ping_recorder, options):
         else:
             if key in ("q", "Q"):
                 break
+            elif key in ("p", "P"):
+                overlay = not overlay
+                full_redraw = True
             elif key in ("r", "R"):
-                ping_recorder.report_write_full()
+                ping_recorder.report_write_full(options.report_format)
             elif key in ("x", "X"):
                 ping_recorder.reset()
-                previous_state = deepcopy(INITIAL_STATE)
+                for panel in panels:
+                    panel.reset()
+                previous_state = initial_state()
                 continue
             elif key == "+" and state.stats_interval_index < len(ping_recorder.STATS_INTERVALS) - 1:
                 state.stats_interval_index += 1
             elif key == "-" and state.stats_interval_index > 0:
                 state.stats_interval_index -= 1
+            elif key in ("<", ",", "KEY_LEFT", ">", ".", "KEY_RIGHT") and hasattr(ping_recorder, "seek"):
+                # step through a replayed log by the current stats interval
+                step = ping_recorder.STATS_INTERVALS[state.stats_interval_index][0]
+                ping_recorder.seek(step if key in (">", ".", "KEY_RIGHT") else -step)
 
-        if ping_recorder.updated.is_set():
+        updated = ping_recorder.updated.is_set()
+        if updated:
             ping_recorder.updated.clear()
             state.alive = ping_recorder.is_alive(options.loss_tolerance)
+            end = ping_recorder.end
+            if ping_recorder.generation != state.generation:
+                # reset or seeked, rebuild the histogram from scratch
+                state.generation = ping_recorder.generation
+                state.histogram_columns = deque(
+                    histogram_column(rtt, options.histogram_lines, options.histogram_upper)
+                    for rtt in ping_recorder.recent_rtts(state.screen_size[1])
+                ) if options.histogram_lines > 0 else deque()
+                state.histogram_new = 0
+                full_redraw = True
+            elif options.histogram_lines > 0:
+                # one column for each ping recorded since, oldest first
+                new = min(end - state.end, state.screen_size[1])
+                for rtt in reversed(ping_recorder.recent_rtts(new) if new > 0 else []):
+                    state.histogram_columns.appendleft(
+                        histogram_column(rtt, options.histogram_lines, options.histogram_upper),
+                    )
+                    state.histogram_new += 1
+                while len(state.histogram_columns) > state.screen_size[1]:
+                    state.histogram_columns.pop()
+            state.end = end
+        if updated or state.stats_interval_index != previous_state.stats_interval_index:
             state.lines = box_text(ping_recorder, state)
             state.max_line_length = max([len(line) for line in state.lines])
-            if options.histogram_lines > 0 and state.alive is not None:
-                state.histogram_columns.insert(
-                    0,
-                    histogram_column(
-                        ping_recorder.last_rtt,
-                        options.histogram_lines,
-                        options.histogram_upper,
-                    ),
+            if panels:
+                state.panel_lines = panel_text(
+                    panels,
+                    ping_recorder.STATS_INTERVALS[state.stats_interval_index][0],
                 )
-                if len(state.histogram_columns) > state.screen_size[1]:
-                    state.histogram_columns.pop()
+                state.panel_width = max(len(line) for line in state.panel_lines) + PANEL_GAP
 
         if state.alive != previous_state.alive:
             if previous_state.alive is not None:
@@ -274,22 +467,32 @@ def main(stdscr, ping_recorder, options):
 
         try:
             if (
+                full_redraw or
                 len(state.lines) != len(previous_state.lines) or
                 state.max_line_length != previous_state.max_line_length or
+                len(state.panel_lines) != len(previous_state.panel_lines) or
+                state.panel_width != previous_state.panel_width or
                 state.alive != previous_state.alive or
                 state.screen_size != previous_state.screen_size
             ):
+                full_redraw = True
                 stdscr.clear()
                 state.box_height = len(state.lines) + 4
                 state.box_width = state.max_line_length + 8
                 max_y, max_x = state.screen_size
                 histogram_lines = min(options.histogram_lines, max_y - state.box_height - 1)
                 state.box_origin_y = int((max_y - histogram_lines - state.box_height) / 2)
-                state.box_origin_x = int((max_x - state.box_width) / 2)
+                state.box_origin_x = max(0, int((max_x - state.box_width - state.panel_width) / 2))
                 state.histogram_y = list(range(max_y - 1, max_y - 1 - histogram_lines, -1))
 
                 anim = (state.alive and options.anim_up) or (not state.alive and options.anim_down)
-                ticker = None if state.alive is None else tick_box(stdscr, state, anim)
+                ticker = None
+                if state.alive is not None:
+                    if anim:
+                        ticker = tick_box(stdscr, state, anim)
+                        next_frame = monotonic()
+                    else:
+                        draw_box(stdscr, state)
 
                 if (
                     (state.alive is True and options.color_up) or
@@ -297,16 +500,25 @@ def main(stdscr, ping_recorder, options):
                 ):
                     draw_full_color(stdscr, state)
 
-            if state.lines != previous_state.lines:
+            if full_redraw or state.lines != previous_state.lines:
                 draw_text(stdscr, state)
 
-            if state.histogram_columns != previous_state.histogram_columns:
-                draw_histogram(stdscr, state)
+            if full_redraw or state.panel_lines != previous_state.panel_lines:
+                draw_panels(stdscr, state)
+
+            if full_redraw or state.histogram_new:
+                draw_histogram(stdscr, state, full_redraw)
 
+            # only advance the animation when it's due, not every time
+            # we're woken up by an update
+            timeout = None
             if ticker:
-                sleep_amount = options.interval / next(ticker)
-            else:
-                sleep_amount = 0.1
+                now = monotonic()
+                if now >= next_frame:
+                    next_frame = now + max(options.interval / next(ticker), 1 / 60)
+                timeout = next_frame - now
+            if overlay:
+                draw_overlay(stdscr)
             stdscr.refresh()
         except curses.error:
             # stuff may have failed because of intermittent window
@@ -315,7 +527,119 @@ def main(stdscr, ping_recorder, options):
                 raise
             else:
                 curses_error = True
+                full_redraw = True
+                timeout = 0.1
         else:
             curses_error = False
-        previous_state = deepcopy(state)
-        sleep(max(sleep_amount, 0.01666))  # cap at 1/60
+            full_redraw = False
+        previous_state = state
+        PROFILE.frame.add((perf_counter_ns() - woken) / 1000)
+        wakeups.wait(timeout)
+
+
+def tile_text(ping_recorder, alive, stats_interval):
+    if alive and ping_recorder.last_rtt is not None:
+        rtt_text = f"{ping_recorder.last_rtt:.2f}ms"
+    else:
+        rtt_text = ping_recorder.error or ""
+    return [
+        ping_recorder.target,
+        rtt_text,
+        f"P/L {ping_recorder.packet_loss(stats_interval) * 100:.1f}%",
+    ]
+
+
+def draw_grid(win, ping_recorders, alive, stats_interval, stats_interval_desc):
+    max_y, max_x = win.getmaxyx()
+    tile_width = max(max(len(r.target) for r in ping_recorders) + 2, 16)
+    columns = max(1, (max_x - 1) // (tile_width + 1))
+    win.erase()
+    win.addstr(0, 0, f"- {stats_interval_desc} +"[:max_x - 1])
+    for i, ping_recorder in enumerate(ping_recorders):
+        y = 1 + (i // columns) * (GRID_TILE_HEIGHT + 1)
+        x = (i % columns) * (tile_width + 1)
+        if y + GRID_TILE_HEIGHT >= max_y:
+            hidden = len(ping_recorders) - i
+            win.addstr(max_y - 1, 0, f"{hidden} more targets not shown"[:max_x - 1])
+            return
+        if alive[i] is None:
+            color = COLOR_TILE_UNKNOWN
+        else:
+            color = COLOR_TILE_UP if alive[i] else COLOR_TILE_DOWN
+        lines = tile_text(ping_recorder, alive[i], stats_interval)
+        for j in range(GRID_TILE_HEIGHT):
+            line = lines[j - 1] if 0 < j <= len(lines) else ""
+            win.addstr(
+                y + j, x,
+                line[:tile_width].center(tile_width),
+                curses.color_pair(color),
+            )
+
+
+def grid_main(stdscr, ping_recorders, options, wakeups):
+    stdscr.clear()
+    stdscr.nodelay(True)
+    init_colors()
+
+    stats_interval_index = 2
+    previous_alive = [None] * len(ping_recorders)
+    redraw = True
+    overlay = False
+
+    while not all(r.stopped.is_set() for r in ping_recorders):
+        woken = perf_counter_ns()
+        try:
+            key = stdscr.getkey()
+        except curses.error:
+            pass
+        else:
+            redraw = True
+            if key in ("q", "Q"):
+                break
+            elif key in ("p", "P"):
+                overlay = not overlay
+            elif key in ("r", "R"):
+                for ping_recorder in ping_recorders:
+                    ping_recorder.report_write_full(options.report_format)
+            elif key in ("x", "X"):
+                for ping_recorder in ping_recorders:
+                    ping_recorder.reset()
+            elif key == "+" and stats_interval_index < len(PingRecorder.STATS_INTERVALS) - 1:
+                stats_interval_index += 1
+            elif key == "-" and stats_interval_index > 0:
+                stats_interval_index -= 1
+
+        for ping_recorder in ping_recorders:
+            if ping_recorder.updated.is_set():
+                ping_recorder.updated.clear()
+                redraw = True
+
+        if redraw:
+            alive = [r.is_alive(options.loss_tolerance) for r in ping_recorders]
+            if any(
+                a is not None and p is not None and a != p
+                for a, p in zip(alive, previous_alive)
+            ):
+                curses.beep()
+            if None not in alive:
+                if options.quit_up and all(alive):
+                    break
+                elif options.quit_down and not any(alive):
+                    break
+            previous_alive = alive
+            try:
+                draw_grid(
+                    stdscr,
+                    ping_recorders,
+                    alive,
+                    *PingRecorder.STATS_INTERVALS[stats_interval_index],
+                )
+                if overlay:
+                    draw_overlay(stdscr)
+                stdscr.refresh()
+            except curses.error:
+                # window too small or being resized, try again later
+                pass
+            redraw = False
+            PROFILE.frame.add((perf_counter_ns() - woken) / 1000)
+        wakeups.wait(None)
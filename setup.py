@@ -9,7 +9,7 @@ setup(
     author_email="torsten@rehn.email",
     url="https://github.com/trehn/fancyping",
     license="GPLv3",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "tests"]),
     entry_points={
         'console_scripts': [
             "fancyping=fancyping.cmdline:main",
@@ -34,4 +34,8 @@ setup(
     install_requires=[
         "icmplib",
     ],
+    extras_require={
+        # vectorized --replay and fancyping.analyze
+        'analyze': ["numpy"],
+    },
 )
@@ -0,0 +1,110 @@
+from socket import SOCK_DGRAM, socket
+from time import monotonic_ns, time
+
+
+class FakeRecorder:
+    # What probe backends see of a PingRecorder, keeping everything they
+    # report back.
+    def __init__(self, timeout=1.0, ttl=None, port=None, payload_size=56, dont_fragment=False):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.port = port
+        self.payload_size = payload_size
+        self.dont_fragment = dont_fragment
+        self.sent = 0
+        # probe -> (rtt or None for lost, responder)
+        self.replies = {}
+        self.errors = []
+        self.late = []
+        self.duplicates = 0
+
+    def _probe_sent(self):
+        self.sent += 1
+        return self.sent - 1, (monotonic_ns(), time())
+
+    def _handle_reply(self, probe, sent, rtt, responder=None):
+        assert probe not in self.replies, f"probe {probe} reported twice"
+        self.replies[probe] = (rtt, responder)
+
+    def _handle_error(self, exc, probe=None):
+        self.errors.append((str(exc), probe))
+
+    def _handle_late(self, rtt):
+        self.late.append(rtt)
+
+    def _handle_duplicate(self):
+        self.duplicates += 1
+
+
+class FakeEngine:
+    # what backends use of an AsyncEngine
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.in_flight = 0
+
+
+class FakeHandle:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    # The parts of an asyncio loop backends use. Time stands still until
+    # advance() runs the timers that are due by then.
+    def __init__(self):
+        self.time = 0.0
+        self.timers = []
+        self.readers = {}
+        self.writers = {}
+
+    def call_later(self, delay, callback, *args):
+        handle = FakeHandle(self.time + delay, callback, args)
+        self.timers.append(handle)
+        return handle
+
+    def advance(self, seconds):
+        self.time += seconds
+        due = sorted(
+            (handle for handle in self.timers if handle.when <= self.time),
+            key=lambda handle: handle.when,
+        )
+        self.timers = [handle for handle in self.timers if handle.when > self.time]
+        for handle in due:
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+
+class FakeICMPSocket:
+    # Stands in for icmplib's ICMPv4Socket and ICMPv6Socket, keeping the
+    # requests sent instead of sending them. Replies are handed to
+    # ICMPBackend._reply() directly, the UDP socket is only there for
+    # socket options.
+    def __init__(self, privileged=True):
+        self.privileged = privileged
+        self.sock = socket(type=SOCK_DGRAM)
+        self.blocking = True
+        self.requests = []
+
+    def send(self, request):
+        self.requests.append(request)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,126 @@
+from datetime import datetime
+from math import isnan, nan
+from os.path import join
+from random import Random
+from statistics import mean
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from fancyping.analyze import LossBurst, ProbeLogFile
+from fancyping.record import STATUS_REPLY, STATUS_TIMEOUT, ProbeLog
+from fancyping.replay import LogReplay
+from fancyping.stats import percentile
+
+START = 1700000000.0
+
+
+class ProbeLogFileTest(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = join(directory.name, "log")
+        # one ping a second, lost in runs of 1 to 5
+        rng = Random(8)
+        self.rtts = []
+        while len(self.rtts) < 2000:
+            if rng.random() < 0.05:
+                self.rtts.extend([nan] * rng.randint(1, 5))
+            else:
+                self.rtts.append(rng.lognormvariate(3, 0.5))
+        log = ProbeLog(self.path, "example.com")
+        for i, rtt in enumerate(self.rtts):
+            log.append(START + i, rtt, i, STATUS_TIMEOUT if isnan(rtt) else STATUS_REPLY)
+        log.close()
+        log._thread.join()
+
+    def open(self, vectorized):
+        log = ProbeLogFile(self.path)
+        self.addCleanup(log.close)
+        if not vectorized:
+            # as if numpy wasn't installed
+            log.records = None
+        return log
+
+    def test_index(self):
+        for vectorized in (True, False):
+            log = self.open(vectorized)
+            self.assertEqual((log.target, log.count), ("example.com", len(self.rtts)))
+            self.assertEqual((log.first_time, log.last_time), (START, START + len(self.rtts) - 1))
+            self.assertEqual(log.index(START + 10), 10)
+            self.assertEqual(log.index(START + 10, 'right'), 11)
+            self.assertEqual(log.index(START + 10.5), 11)
+            self.assertEqual(log.index(START - 1), 0)
+            self.assertEqual(log.index(START + 1e6), len(self.rtts))
+
+    def test_stats(self):
+        for vectorized in (True, False):
+            log = self.open(vectorized)
+            for start, end in ((None, None), (START + 99, START + 699), (START + 1500, None)):
+                i = 0 if start is None else int(start - START) + 1
+                j = len(self.rtts) if end is None else int(end - START) + 1
+                received = sorted(rtt for rtt in self.rtts[i:j] if not isnan(rtt))
+                stats = log.stats(start, end)
+                self.assertEqual((stats.count, stats.lost), (j - i, j - i - len(received)))
+                self.assertAlmostEqual(stats.mean, mean(received))
+                self.assertEqual((stats.min, stats.max), (received[0], received[-1]))
+                for p, value in stats.percentiles.items():
+                    if vectorized:
+                        self.assertAlmostEqual(value, percentile(received, p))
+                    else:
+                        # approximated like QuantileSketch does, to the
+                        # nearest rank
+                        exact = received[int(p / 100 * (len(received) - 1))]
+                        self.assertLessEqual(abs(value - exact) / exact, 0.01)
+            self.assertEqual(log.stats(START - 10, START - 5).count, 0)
+
+    def bursts(self, i=0, j=None):
+        # runs of lost pings among records i to j, cut off at either end
+        bursts = []
+        for k in range(i, len(self.rtts) if j is None else j):
+            if not isnan(self.rtts[k]):
+                continue
+            if bursts and bursts[-1][1] == k - 1:
+                bursts[-1][1] = k
+            else:
+                bursts.append([k, k])
+        return [LossBurst(START + first, START + last, last - first + 1) for first, last in bursts]
+
+    def test_loss_bursts(self):
+        for vectorized in (True, False):
+            log = self.open(vectorized)
+            self.assertEqual(log.loss_bursts(), self.bursts())
+            self.assertEqual(
+                log.loss_bursts(min_length=3),
+                [burst for burst in self.bursts() if burst.length >= 3],
+            )
+            # records after START + 500 up to and including START + 999
+            self.assertEqual(log.loss_bursts(START + 500, START + 999), self.bursts(501, 1000))
+
+    def test_replay(self):
+        replay = LogReplay(self.path)
+        self.addCleanup(replay.log.close)
+        # starts at the end of the log
+        self.assertEqual(replay.end, len(self.rtts))
+        self.assertEqual(replay.now(), datetime.utcfromtimestamp(START + len(self.rtts) - 1))
+        replay.seek(-(len(self.rtts) - 100))
+        self.assertEqual(replay.end, 100)
+        newest = [None if isnan(rtt) else rtt for rtt in reversed(self.rtts[90:100])]
+        self.assertEqual(replay.recent_rtts(10), newest)
+        self.assertEqual(replay.last_rtt, newest[0])
+        lost = [i for i, rtt in enumerate(self.rtts[:100]) if isnan(rtt)]
+        self.assertEqual(replay.last_pl, datetime.utcfromtimestamp(START + lost[-1]))
+        self.assertEqual(replay.packet_loss(60), sum(map(isnan, self.rtts[40:100])) / 60)
+        self.assertEqual(replay.rtt_stats(60)[2], min(rtt for rtt in self.rtts[40:100] if not isnan(rtt)))
+        # seeking stops at either end
+        replay.seek(-1e6)
+        self.assertEqual(replay.end, 1)
+        replay.seek(1e6)
+        self.assertEqual(replay.end, len(self.rtts))
+        # stats for every interval the log covers
+        report = replay.report_stats()
+        for timeframe, label in replay.STATS_INTERVALS:
+            if timeframe < len(self.rtts):
+                self.assertIn(label, report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import asyncio
+from select import select
+from socket import SOCK_DGRAM, socket
+from struct import pack, unpack_from
+from time import monotonic, monotonic_ns, sleep, time
+from types import SimpleNamespace
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from icmplib import ICMPReply
+
+from fancyping.backends import ICMPBackend, TCPBackend, UDPBackend
+from fancyping.icmp import PingRecorder
+from .fakes import FakeEngine, FakeICMPSocket, FakeLoop, FakeRecorder
+
+TARGET = "192.0.2.1"
+# ICMPv4 types
+ECHO_REPLY = 0
+TIME_EXCEEDED = 11
+
+
+def closed_port(type=None):
+    # a port on localhost nobody listens on, for now
+    sock = socket() if type is None else socket(type=type)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def stalled_port(test):
+    # A port on localhost that never finishes a handshake: the listener's
+    # backlog is full and nobody accepts, so SYNs are dropped.
+    listener = socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    held = socket()
+    held.connect(("127.0.0.1", port))
+    test.addCleanup(listener.close)
+    test.addCleanup(held.close)
+    return port
+
+
+class ICMPBackendTest(TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.backend = self.make_backend()
+
+    def make_backend(self, backend_class=ICMPBackend):
+        with patch("fancyping.backends.ICMPv4Socket", FakeICMPSocket):
+            backend = backend_class(SimpleNamespace(loop=self.loop, privileged=False), 4)
+        self.addCleanup(backend.sock.close)
+        return backend
+
+    def send(self, engine, backend=None):
+        backend = backend or self.backend
+        backend.send(engine, TARGET)
+        return backend.sock.requests[-1]
+
+    def reply(self, request, source, type, backend=None):
+        (backend or self.backend)._reply(
+            ICMPReply(source, 4, request.id, request.sequence, type, 0, 64, time()),
+            monotonic_ns(),
+        )
+
+    def test_hops_by_ttl(self):
+        hops = [FakeEngine(FakeRecorder(ttl=ttl)) for ttl in range(1, 5)]
+        requests = [self.send(hop) for hop in hops]
+        self.assertEqual([request.ttl for request in requests], [1, 2, 3, 4])
+        # out of order, hop 2 stays silent
+        self.reply(requests[3], TARGET, ECHO_REPLY)
+        self.reply(requests[2], "10.0.1.1", TIME_EXCEEDED)
+        self.reply(requests[0], "10.0.0.1", TIME_EXCEEDED)
+        self.loop.advance(1.5)
+        responders = [hop.recorder.replies[0][1] for hop in hops]
+        self.assertEqual(responders, ["10.0.0.1", None, "10.0.1.1", TARGET])
+        self.assertIsNone(hops[1].recorder.replies[0][0])
+        for hop in hops[:1] + hops[2:]:
+            self.assertGreaterEqual(hop.recorder.replies[0][0], 0)
+        self.assertEqual([hop.in_flight for hop in hops], [0] * 4)
+        self.assertEqual(self.backend.pending, {})
+
+    def test_time_exceeded_without_ttl_is_loss(self):
+        engine = FakeEngine(FakeRecorder())
+        self.reply(self.send(engine), "10.0.0.1", TIME_EXCEEDED)
+        self.assertEqual(engine.recorder.replies, {0: (None, None)})
+
+
+    def test_late_and_duplicate(self):
+        engine = FakeEngine(FakeRecorder())
+        request = self.send(engine)
+        self.loop.advance(1.5)
+        self.assertEqual(engine.recorder.replies, {0: (None, None)})
+        self.reply(request, TARGET, ECHO_REPLY)
+        self.reply(request, TARGET, ECHO_REPLY)
+        self.assertEqual(len(engine.recorder.late), 1)
+        self.assertEqual(engine.recorder.duplicates, 1)
+
+    def test_close_reports_pending(self):
+        engine = FakeEngine(FakeRecorder())
+        self.send(engine)
+        self.send(engine)
+        self.backend.close()
+        self.assertEqual(engine.recorder.replies, {0: (None, None), 1: (None, None)})
+        self.assertEqual(engine.in_flight, 0)
+
+    def test_sequences_in_flight_are_skipped(self):
+        class FewSequences(ICMPBackend):
+            SEQUENCES = 4
+
+        backend = self.make_backend(FewSequences)
+        engine = FakeEngine(FakeRecorder())
+        requests = [self.send(engine, backend) for i in range(4)]
+        self.assertEqual([request.sequence for request in requests], [0, 1, 2, 3])
+        # all in use
+        backend.send(engine, TARGET)
+        self.assertEqual(len(engine.recorder.errors), 1)
+        self.reply(requests[1], TARGET, ECHO_REPLY, backend)
+        self.assertEqual(self.send(engine, backend).sequence, 1)
+        self.loop.advance(1.5)
+        self.assertEqual(sorted(engine.recorder.replies), [0, 1, 2, 3, 4])
+
+
+class AsyncBackendTest(TestCase):
+    # on a real event loop and real sockets on localhost
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_until(self, condition, timeout=2.0):
+        deadline = monotonic() + timeout
+        while not condition() and monotonic() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+class TCPBackendTest(AsyncBackendTest):
+    def setUp(self):
+        super().setUp()
+        self.backend = TCPBackend(SimpleNamespace(loop=self.loop), 4)
+        self.addCleanup(self.backend.close)
+
+    def probe(self, port, timeout=1.0):
+        engine = FakeEngine(FakeRecorder(timeout=timeout, port=port))
+        self.backend.send(engine, "127.0.0.1")
+        self.run_until(lambda: engine.recorder.replies)
+        self.assertEqual(engine.in_flight, 0)
+        return engine.recorder.replies
+
+    def test_refused_is_reply(self):
+        replies = self.probe(closed_port())
+        self.assertGreaterEqual(replies[0][0], 0)
+
+    def test_accepted_is_reply(self):
+        listener = socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        replies = self.probe(listener.getsockname()[1])
+        self.assertGreaterEqual(replies[0][0], 0)
+
+    def test_timeout_is_loss(self):
+        started = monotonic()
+        replies = self.probe(stalled_port(self), timeout=0.2)
+        self.assertEqual(replies, {0: (None, None)})
+        self.assertGreaterEqual(monotonic() - started, 0.2)
+
+
+class UDPBackendTest(AsyncBackendTest):
+    def setUp(self):
+        super().setUp()
+        self.backend = UDPBackend(SimpleNamespace(loop=self.loop), 4)
+        self.addCleanup(self.backend.close)
+
+    def test_echo_matching(self):
+        server = socket(type=SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        self.addCleanup(server.close)
+        engine = FakeEngine(FakeRecorder(timeout=0.3, port=server.getsockname()[1]))
+        for i in range(3):
+            self.backend.send(engine, "127.0.0.1")
+        datagrams = []
+        while len(datagrams) < 3 and select([server], [], [], 1)[0]:
+            datagrams.append(server.recvfrom(65535))
+        self.assertEqual(len(datagrams), 3)
+        # only the second probe comes back, after a stray and a runt
+        payload, client = datagrams[1]
+        sequence = unpack_from("!I", payload)[0]
+        server.sendto(pack("!I", sequence + 100), client)
+        server.sendto(b"\0", client)
+        server.sendto(payload, client)
+        self.run_until(lambda: len(engine.recorder.replies) == 3)
+        replies = engine.recorder.replies
+        self.assertIsNone(replies[0][0])
+        self.assertGreaterEqual(replies[1][0], 0)
+        self.assertIsNone(replies[2][0])
+        self.assertEqual(engine.in_flight, 0)
+        self.assertEqual(engine.recorder.errors, [])
+
+    def test_port_unreachable_is_reply(self):
+        engine = FakeEngine(FakeRecorder(port=closed_port(SOCK_DGRAM)))
+        self.backend.send(engine, "127.0.0.1")
+        self.run_until(lambda: engine.recorder.replies)
+        self.assertGreaterEqual(engine.recorder.replies[0][0], 0)
+
+
+class ReorderTest(TestCase):
+    def test_missing_probe_is_given_up_on(self):
+        recorder = PingRecorder("192.0.2.1", timeout=0.1)
+        recorder.REORDER_GRACE = 0
+        sent = [recorder._probe_sent() for i in range(3)]
+        # nothing ever reports back on the first one
+        for probe, sent_at in sent[1:]:
+            recorder._handle_reply(probe, sent_at, 1.0)
+        recorder.flush()
+        self.assertEqual(recorder.snapshot.end, 0)
+        deadline = monotonic() + 3
+        while recorder.snapshot.end < 2 and monotonic() < deadline:
+            sleep(0.1)
+        self.assertEqual(recorder.snapshot.end, 2)
+        self.assertEqual(recorder.snapshot.counters.errors, 1)
+        # too late now
+        recorder._handle_reply(*sent[0], 1.0)
+        recorder.flush()
+        self.assertEqual(recorder.snapshot.end, 2)
+        recorder.stop()
+
+
+if __name__ == '__main__':
+    main()
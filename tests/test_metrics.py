@@ -0,0 +1,102 @@
+import re
+from unittest import TestCase, main
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from fancyping.icmp import PingRecorder
+from fancyping.metrics import CONTENT_TYPE, RTT_BUCKETS, MetricsExporter
+
+SAMPLE = re.compile(r'^([a-z_]+)\{target="((?:[^"\\]|\\.)*)"((?:,[a-z]+="[^"]*")*)\} (\S+)$')
+
+
+class MetricsExporterTest(TestCase):
+    def setUp(self):
+        self.recorder = PingRecorder('odd "name"\\', count=0)
+        self.addCleanup(self.recorder.stop)
+        for rtt in (0.3, 7.0, None, 7.5, 3000.0):
+            probe, sent = self.recorder._probe_sent()
+            self.recorder._handle_reply(probe, sent, rtt)
+        self.recorder._handle_late(40.0)
+        self.recorder.flush()
+        # port 0 picks a free one
+        self.exporter = MetricsExporter([self.recorder], ("127.0.0.1", 0))
+        self.exporter.start()
+        self.addCleanup(self.exporter.stop)
+        self.url = f"http://127.0.0.1:{self.exporter.server.server_address[1]}"
+
+    def scrape(self):
+        with urlopen(self.url + "/metrics") as response:
+            self.assertEqual(response.headers["Content-Type"], CONTENT_TYPE)
+            return response.read().decode('utf-8')
+
+    def test_format(self):
+        text = self.scrape()
+        self.assertTrue(text.endswith("\n"))
+        types = {}
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                continue
+            if line.startswith("# TYPE "):
+                name, metric_type = line.split()[2:]
+                self.assertNotIn(name, types)
+                types[name] = metric_type
+                continue
+            match = SAMPLE.match(line)
+            self.assertIsNotNone(match, line)
+            name = match.group(1)
+            self.assertEqual(match.group(2), 'odd \\"name\\"\\\\')
+            float(match.group(4))
+            # every sample belongs to the metric declared last
+            family = list(types)[-1]
+            self.assertTrue(name == family or name.startswith(family + "_"), line)
+        self.assertEqual(types["fancyping_rtt_seconds"], "histogram")
+        self.assertEqual(types["fancyping_late_rtt_seconds"], "summary")
+        self.assertEqual(types["fancyping_probes_total"], "counter")
+
+    def samples(self):
+        samples = {}
+        for line in self.scrape().splitlines():
+            match = SAMPLE.match(line)
+            if match:
+                samples[match.group(1) + match.group(3)] = float(match.group(4))
+        return samples
+
+    def test_counters(self):
+        samples = self.samples()
+        self.assertEqual(samples["fancyping_probes_total"], 5)
+        self.assertEqual(samples["fancyping_probes_lost_total"], 1)
+        self.assertEqual(samples["fancyping_probe_errors_total"], 0)
+        self.assertEqual(samples["fancyping_late_rtt_seconds_count"], 1)
+        self.assertAlmostEqual(samples["fancyping_late_rtt_seconds_sum"], 0.04)
+        self.assertEqual(samples["fancyping_rtt_seconds_count"], 4)
+        self.assertAlmostEqual(samples["fancyping_rtt_seconds_sum"], 3.0148)
+        self.assertEqual(samples["fancyping_up"], 1)
+
+    def test_bucket_labels(self):
+        samples = self.samples()
+        buckets = [
+            (name, value) for name, value in samples.items()
+            if name.startswith("fancyping_rtt_seconds_bucket")
+        ]
+        self.assertEqual(
+            [name.split('le="')[1].rstrip('"') for name, value in buckets],
+            [f"{bound / 1000:g}" for bound in RTT_BUCKETS] + ["+Inf"],
+        )
+        counts = dict((name.split('le="')[1].rstrip('"'), value) for name, value in buckets)
+        # cumulative
+        self.assertEqual(counts["0.0005"], 1)
+        self.assertEqual(counts["0.005"], 1)
+        self.assertEqual(counts["0.01"], 3)
+        self.assertEqual(counts["2.5"], 3)
+        self.assertEqual(counts["5"], 4)
+        self.assertEqual(counts["+Inf"], 4)
+
+    def test_not_found(self):
+        with self.assertRaises(HTTPError) as raised:
+            urlopen(self.url + "/")
+        self.assertEqual(raised.exception.code, 404)
+        raised.exception.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+from math import isnan
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+
+from fancyping.analyze import ProbeLogFile
+from fancyping.icmp import PingRecorder
+from fancyping.metrics import render_metrics
+from fancyping.record import (
+    HEADER, RECORD, STATUS_REPLY, STATUS_TIMEOUT, LogFormatError, ProbeLog,
+)
+
+
+def close(log):
+    # and wait for the final write
+    log.close()
+    log._thread.join()
+
+
+class ProbeLogTest(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = join(directory.name, "log")
+
+    def test_round_trip(self):
+        recorder = PingRecorder("192.0.2.1", record=self.path)
+        for rtt in (1.5, None, 2.5, None, None, 3.5):
+            probe, sent = recorder._probe_sent()
+            recorder._handle_reply(probe, sent, rtt)
+        recorder.stop()
+        recorder._log._thread.join()
+        with ProbeLogFile(self.path) as log:
+            self.assertEqual(log.target, "192.0.2.1")
+            self.assertEqual(log.count, 6)
+            rtts = list(log.rtts(0, log.count))
+            self.assertEqual([isnan(rtt) for rtt in rtts], [False, True, False, True, True, False])
+            self.assertEqual([rtts[0], rtts[2], rtts[5]], [1.5, 2.5, 3.5])
+            times = [log.time(i) for i in range(log.count)]
+            self.assertEqual(times, sorted(times))
+        with open(self.path, 'rb') as f:
+            f.seek(HEADER.size)
+            records = list(RECORD.iter_unpack(f.read()))
+        self.assertEqual([record[2] for record in records], list(range(6)))
+        self.assertEqual(
+            [record[3] for record in records],
+            [STATUS_REPLY, STATUS_TIMEOUT, STATUS_REPLY, STATUS_TIMEOUT, STATUS_TIMEOUT, STATUS_REPLY],
+        )
+
+    def test_append(self):
+        log = ProbeLog(self.path, "192.0.2.1")
+        for i in range(3):
+            log.append(1000.0 + i, float(i), i, STATUS_REPLY)
+        close(log)
+        # a partial record left by a crash is cut off
+        with open(self.path, 'ab') as f:
+            f.write(RECORD.pack(1003.0, 3.0, 3, STATUS_REPLY)[:10])
+        log = ProbeLog(self.path, "ignored")
+        log.append(1004.0, 4.0, 4, STATUS_REPLY)
+        close(log)
+        with ProbeLogFile(self.path) as log:
+            self.assertEqual(log.target, "192.0.2.1")
+            self.assertEqual([log.time(i) for i in range(log.count)], [1000.0, 1001.0, 1002.0, 1004.0])
+
+    def test_not_a_log(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"\0" * (HEADER.size + RECORD.size))
+        with self.assertRaises(LogFormatError):
+            ProbeLog(self.path, "192.0.2.1")
+        with self.assertRaises(LogFormatError):
+            ProbeLogFile(self.path)
+
+    def test_dropped_is_reported(self):
+        recorder = PingRecorder("192.0.2.1", record=self.path)
+        # as if the disk couldn't keep up
+        recorder._log.max_buffer = 0
+        for rtt in (1.0, None, 2.0):
+            probe, sent = recorder._probe_sent()
+            recorder._handle_reply(probe, sent, rtt)
+        self.assertIn("NOT RECORDED 3 (disk too slow)", recorder.report_stats())
+        self.assertIn(
+            'fancyping_log_records_dropped_total{target="192.0.2.1"} 3\n',
+            render_metrics([recorder]),
+        )
+        recorder.stop()
+        recorder._log._thread.join()
+        with ProbeLogFile(self.path) as log:
+            self.assertEqual(log.count, 0)
+
+
+if __name__ == '__main__':
+    main()
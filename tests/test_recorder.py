@@ -0,0 +1,63 @@
+from threading import Event, Thread
+from time import sleep
+from unittest import TestCase, main
+
+from fancyping.icmp import PingRecorder
+from fancyping.ringbuffer import RingBuffer
+
+CAPACITY = 16
+
+
+class ReadTest(TestCase):
+    # PingRecorder._read() while the writer thread appends a row to
+    # several buffers, one after the other
+    def setUp(self):
+        self.recorder = PingRecorder("192.0.2.1")
+        self.addCleanup(self.recorder.stop)
+        self.buffers = [RingBuffer(CAPACITY) for i in range(3)]
+
+    def append_row(self, buffers=None):
+        for buffer in buffers or self.buffers:
+            buffer.append(buffer.appended)
+
+    def check(self, start, copies):
+        for copy in copies:
+            self.assertEqual(list(copy), list(range(start, start + len(copy))))
+
+    def test_row_being_written(self):
+        for i in range(CAPACITY * 2):
+            self.append_row()
+        # the writer is halfway through the next row, which already
+        # overwrote the oldest position in the first buffer
+        self.append_row(self.buffers[:1])
+        end = self.buffers[-1].appended
+        start, copies = self.recorder._read(self.buffers, 0, end)
+        self.assertEqual(start, end - CAPACITY + 1)
+        self.check(start, copies)
+
+    def test_while_wrapping(self):
+        stop = Event()
+
+        def write():
+            # letting the reader in between buffers
+            while not stop.is_set():
+                for buffer in self.buffers:
+                    buffer.append(buffer.appended)
+                    sleep(0)
+
+        writer = Thread(target=write)
+        writer.start()
+        try:
+            for i in range(5000):
+                end = self.buffers[-1].appended
+                start, copies = self.recorder._read(self.buffers, end - CAPACITY, end)
+                self.check(start, copies)
+                sleep(0)
+        finally:
+            stop.set()
+            writer.join()
+        self.assertGreater(self.buffers[0].appended, CAPACITY * 10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from tempfile import NamedTemporaryFile
+from time import sleep
+from unittest import TestCase, main
+from unittest.mock import patch
+
+from icmplib import NameLookupError
+
+from fancyping.icmp import PingRecorder
+from fancyping.resolver import read_hosts
+from .test_backends import closed_port, stalled_port
+
+
+class ResolverTest(TestCase):
+    def record(self, target, **kwargs):
+        recorder = PingRecorder(target, interval=0.1, timeout=0.2, protocol="tcp", **kwargs)
+        recorder.start()
+        sleep(0.6)
+        recorder.stop()
+        recorder.flush()
+        return recorder
+
+    def test_failure_is_not_loss(self):
+        with patch("fancyping.resolver.resolve", side_effect=NameLookupError("nope.invalid")):
+            recorder = self.record("nope.invalid", port=closed_port())
+        counters = recorder.snapshot.counters
+        self.assertEqual(counters.resolve_errors, 1)
+        self.assertEqual((counters.probes, counters.lost, counters.errors), (0, 0, 0))
+        self.assertIn("nope.invalid", recorder.error)
+
+    def test_loss_is_not_failure(self):
+        with patch("fancyping.resolver.resolve", side_effect=AssertionError("asked DNS")):
+            recorder = self.record(
+                "stalled.test",
+                port=stalled_port(self),
+                hosts={"stalled.test": ["127.0.0.1"]},
+            )
+        counters = recorder.snapshot.counters
+        self.assertEqual(counters.resolve_errors, 0)
+        self.assertGreater(counters.lost, 0)
+        self.assertEqual(counters.lost, counters.probes)
+        self.assertEqual(recorder.address, "127.0.0.1")
+
+    def test_read_hosts(self):
+        with NamedTemporaryFile('w') as f:
+            f.write("# comment\n127.0.0.1 localhost Example.test\n::1 localhost  # v6\n")
+            f.flush()
+            hosts = read_hosts(f.name)
+        self.assertEqual(hosts, {
+            "localhost": ["127.0.0.1", "::1"],
+            "example.test": ["127.0.0.1"],
+        })
+
+
+if __name__ == '__main__':
+    main()
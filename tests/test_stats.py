@@ -0,0 +1,440 @@
+from math import isnan, nan
+from random import Random
+from statistics import mean, median
+from time import monotonic, time
+from unittest import TestCase, main
+
+from fancyping.icmp import PingRecorder
+from fancyping.ringbuffer import RingBuffer
+from fancyping.stats import (
+    OUTAGE_HISTORY, Jitter, OutageIndex, QuantileSketch, RolledWindow, Rollup,
+    SlidingMedian, WindowStats,
+)
+
+
+def sent_at(timestamp):
+    # what PingRecorder._probe_sent() returns for a ping sent at
+    # monotonic timestamp
+    return int(timestamp * 1000000000), time() - (monotonic() - timestamp)
+
+
+class SlidingMedianTest(TestCase):
+    def test_sliding_window(self):
+        rng = Random(3)
+        for size in (1, 2, 3, 10, 101):
+            sliding = SlidingMedian()
+            # few distinct values, so equal ones leave the window too
+            values = [rng.choice((1.0, 2.0, 2.5, 7.0, 30.0)) for _ in range(2000)]
+            for index, value in enumerate(values):
+                sliding.add(value, index)
+                if index >= size:
+                    sliding.remove(values[index - size], index - size)
+                window = values[max(index - size + 1, 0):index + 1]
+                self.assertEqual(len(sliding), len(window))
+                self.assertEqual(sliding.median, median(window))
+
+    def test_shrink_and_grow(self):
+        # windows change size with the rate pings come in at
+        rng = Random(4)
+        sliding = SlidingMedian()
+        values = []
+        start = 0
+        for index in range(5000):
+            values.append(rng.lognormvariate(3, 1))
+            sliding.add(values[-1], index)
+            target = rng.choice((1, 5, 50, 200))
+            while index + 1 - start > target:
+                sliding.remove(values[start], start)
+                start += 1
+            self.assertEqual(sliding.median, median(values[start:]))
+        # lazily deleted entries were compacted along the way
+        self.assertLess(len(sliding._low) + len(sliding._high), 2 * len(sliding) + 65)
+
+
+class WindowStatsTest(TestCase):
+    def check(self, exact_median):
+        rng = Random(5)
+        capacity = 300
+        results = RingBuffer(capacity)
+        times = RingBuffer(capacity)
+        windows = [
+            WindowStats(results, times, timeframe, exact_median)
+            for timeframe in (1, 10, 60, 1000)
+        ]
+        samples = []
+        timestamp = 0.0
+        for _ in range(3000):
+            # bursts and gaps, so windows both fill up and run dry
+            timestamp += rng.choice((0.01, 0.1, 1, 5, 30))
+            value = nan if rng.random() < 0.1 else rng.lognormvariate(3, 1)
+            for window in windows:
+                window.add(value, timestamp)
+            results.append(value)
+            times.append(timestamp)
+            samples.append((timestamp, value))
+            for window in windows:
+                values = [
+                    value for sent, value in samples[-capacity:]
+                    if sent > timestamp - window.timeframe
+                ]
+                received = [value for value in values if not isnan(value)]
+                self.assertEqual(window.count, len(values))
+                self.assertEqual(window.lost, len(values) - len(received))
+                self.assertEqual(window.packet_loss, (len(values) - len(received)) / len(values))
+                if not received:
+                    self.assertIsNone(window.rtt_stats)
+                    continue
+                stats = window.rtt_stats
+                self.assertAlmostEqual(stats[0], mean(received), places=5)
+                self.assertEqual(stats[2:4], (min(received), max(received)))
+                if exact_median:
+                    self.assertEqual(stats[1], median(received))
+                else:
+                    # the sketch picks the lower middle value
+                    low = sorted(received)[(len(received) - 1) // 2]
+                    self.assertLessEqual(abs(stats[1] - low) / low, 0.01)
+
+    def test_exact_median(self):
+        self.check(exact_median=True)
+
+    def test_sketch_median(self):
+        self.check(exact_median=False)
+
+    def test_expire(self):
+        results = RingBuffer(10)
+        times = RingBuffer(10)
+        window = WindowStats(results, times, 10)
+        for timestamp, value in ((1, 5.0), (2, nan), (3, 1.0)):
+            window.add(value, timestamp)
+            results.append(value)
+            times.append(timestamp)
+        self.assertFalse(window.covered)
+        window.expire(12)
+        self.assertTrue(window.covered)
+        self.assertEqual((window.count, window.lost), (1, 0))
+        self.assertEqual(window.rtt_stats[:4], (1.0, 1.0, 1.0, 1.0))
+        window.expire(13)
+        self.assertEqual(window.count, 0)
+        self.assertEqual(window.packet_loss, 1.0)
+        self.assertIsNone(window.rtt_stats)
+
+
+class QuantileSketchTest(TestCase):
+    def check(self, sketch, values, accuracy):
+        values = sorted(values)
+        self.assertEqual(sketch.count, len(values))
+        for q in (0, 0.01, 0.25, 0.5, 0.9, 0.99, 0.999, 1):
+            # the sketch ranks like the lower of two middle values
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), exact * accuracy, q)
+
+    def test_relative_error_after_removals(self):
+        rng = Random(6)
+        for accuracy in (0.01, 0.05):
+            sketch = QuantileSketch(accuracy)
+            values = [rng.lognormvariate(3, 2) for _ in range(20000)]
+            for value in values:
+                sketch.add(value)
+            self.check(sketch, values, accuracy)
+            # remove the bulk of them, most of all the fast ones, so
+            # the quantiles move a long way
+            rng.shuffle(values)
+            kept = []
+            for value in values:
+                if rng.random() < (0.95 if value < 20 else 0.5):
+                    sketch.remove(value)
+                else:
+                    kept.append(value)
+            self.check(sketch, kept, accuracy)
+            for value in kept:
+                sketch.remove(value)
+            self.assertIsNone(sketch.quantile(0.5))
+            self.assertEqual((sketch._keys, sketch._counts), ([], {}))
+
+    def test_merge(self):
+        rng = Random(7)
+        sketch = QuantileSketch()
+        first = [rng.uniform(1, 100) for _ in range(1000)]
+        second = [rng.uniform(50, 5000) for _ in range(1000)]
+        other = QuantileSketch()
+        for value in first:
+            other.add(value)
+        sketch.merge(*other.export())
+        other = QuantileSketch()
+        for value in second:
+            other.add(value)
+        sketch.merge(*other.export())
+        self.check(sketch, first + second, 0.01)
+        sketch.merge(*other.export(), sign=-1)
+        self.check(sketch, first, 0.01)
+
+    def test_below_min_value(self):
+        sketch = QuantileSketch(min_value=0.001)
+        for value in (0.0, 0.0005, 1.0):
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertAlmostEqual(sketch.quantile(1), 1.0, delta=0.01)
+
+
+class JitterTest(TestCase):
+    def test_rfc3550(self):
+        # J(i) = J(i-1) + (|D(i-1,i)| - J(i-1))/16, with D the
+        # difference in RTT of successive replies
+        jitter = Jitter()
+        expected = [None, 0.125, 0.1796875, 0.1796875, 0.418457031250]
+        for rtt, value in zip((10.0, 12.0, 11.0, nan, 15.0), expected):
+            jitter.add(rtt)
+            self.assertEqual(jitter.value, value)
+        # J = 0.41845703125 + (|15 - 15| - J)/16
+        jitter.add(15.0)
+        self.assertEqual(jitter.value, 0.392303466796875)
+
+    def test_converges(self):
+        # alternating RTTs 2ms apart converge on a jitter of 2ms
+        jitter = Jitter()
+        for i in range(500):
+            jitter.add(10.0 + 2 * (i % 2))
+        self.assertAlmostEqual(jitter.value, 2.0)
+
+    def test_lost_only(self):
+        jitter = Jitter()
+        jitter.add(nan)
+        jitter.add(5.0)
+        jitter.add(nan)
+        self.assertIsNone(jitter.value)
+
+
+EPOCH = 1700000000
+
+
+def record(outages, results):
+    # (monotonic timestamp, rtt) pairs, sent at EPOCH + timestamp
+    for timestamp, rtt in results:
+        outages.add(rtt, timestamp, EPOCH + timestamp)
+
+
+class OutageIndexTest(TestCase):
+    def test_open_and_close(self):
+        outages = OutageIndex(loss_tolerance=3)
+        record(outages, [(0, 1.0), (1, nan), (2, nan)])
+        # too short for an outage
+        self.assertFalse(outages.down)
+        self.assertEqual(outages.count, 0)
+        record(outages, [(3, nan)])
+        # down as of the first lost ping
+        self.assertTrue(outages.down)
+        self.assertEqual((outages.count, outages.streak, outages.since), (1, 3, EPOCH + 1))
+        summary = outages.summary(10, 60)
+        self.assertEqual((summary.recent, summary.longest, summary.downtime), (1, 9, 0.0))
+        record(outages, [(12, 2.0)])
+        self.assertFalse(outages.down)
+        self.assertEqual((outages.streak, outages.since), (1, EPOCH + 12))
+        self.assertEqual((outages.longest, outages.downtime, outages.bursts), (11, 11, 0))
+        record(outages, [(13, 1.0)])
+        self.assertEqual(outages.streak, 2)
+
+    def test_bursts(self):
+        outages = OutageIndex(loss_tolerance=3)
+        record(outages, [(0, 1.0), (1, nan), (2, 1.0), (3, nan), (4, nan), (5, 1.0), (6, nan)])
+        self.assertEqual((outages.count, outages.bursts), (0, 2))
+        # a run of lost pings only counts once it ended
+        record(outages, [(7, nan), (8, nan), (9, 1.0)])
+        self.assertEqual((outages.count, outages.bursts), (1, 2))
+
+    def test_loss_tolerance(self):
+        for tolerance, count in ((0, 3), (1, 3), (2, 2), (3, 1), (4, 0)):
+            outages = OutageIndex(tolerance)
+            record(outages, [(0, 1.0)])
+            for start in (1, 10, 20):
+                length = 1 + start // 10
+                record(outages, [(start + i, nan) for i in range(length)] + [(start + length, 1.0)])
+            self.assertEqual(outages.count, count, tolerance)
+            self.assertEqual(outages.count + outages.bursts, 3)
+
+    def test_down_from_the_start(self):
+        # like is_alive(), all pings so far lost is down even if fewer
+        # than loss_tolerance
+        outages = OutageIndex(loss_tolerance=5)
+        record(outages, [(0, nan)])
+        self.assertTrue(outages.down)
+        self.assertEqual((outages.streak, outages.since), (1, EPOCH))
+        record(outages, [(1, nan), (2, 1.0)])
+        self.assertEqual((outages.count, outages.longest), (1, 2))
+
+    def test_summary(self):
+        outages = OutageIndex()
+        # outages ending at 10, 20, ..., 100, lasting 1s, 2s, ...
+        for i in range(1, 11):
+            record(outages, [(i * 10 - i, nan), (i * 10, 1.0)])
+        summary = outages.summary(100, 35)
+        self.assertEqual((summary.count, summary.recent), (10, 4))
+        self.assertEqual((summary.longest, summary.downtime), (10, 55))
+        self.assertEqual(outages.summary(100, 1000).recent, 10)
+        self.assertEqual(outages.summary(200, 35).recent, 0)
+        # an ongoing outage counts as recent and towards longest
+        record(outages, [(150, nan)])
+        summary = outages.summary(200, 35)
+        self.assertEqual((summary.count, summary.recent, summary.longest), (11, 1, 50))
+        self.assertTrue(summary.down)
+        self.assertEqual(summary.since, EPOCH + 150)
+
+    def test_history(self):
+        # only the last OUTAGE_HISTORY ends are kept for recent
+        outages = OutageIndex()
+        for i in range(OUTAGE_HISTORY + 10):
+            record(outages, [(2 * i, nan), (2 * i + 1, 1.0)])
+        self.assertEqual(outages.count, OUTAGE_HISTORY + 10)
+        self.assertEqual(outages.summary(2 * OUTAGE_HISTORY + 20, 10).recent, 5)
+        self.assertEqual(outages.summary(2 * OUTAGE_HISTORY + 20, 1e9).recent, OUTAGE_HISTORY)
+
+
+class RollupTest(TestCase):
+    def test_late_sample_within_delay(self):
+        rollup = Rollup(10, 6, delay=5)
+        window = RolledWindow(rollup, 3)
+        rollup.add(1, 1.0)
+        # the bucket ended, but its last ping is still in flight
+        window.expire(12)
+        rollup.add(9, 2.0)
+        rollup.add(11, 3.0)
+        window.expire(16)
+        self.assertEqual(list(rollup.counts.at(i) for i in range(rollup.counts.appended)), [2])
+        self.assertEqual(window.count, 2)
+        self.assertEqual((rollup.mins.at(0), rollup.maxs.at(0)), (1.0, 2.0))
+        self.assertEqual(rollup.current[0], 1)
+
+    def test_sample_after_delay_is_dropped(self):
+        rollup = Rollup(10, 6, delay=5)
+        window = RolledWindow(rollup, 3)
+        rollup.add(1, 1.0)
+        window.expire(16)
+        rollup.add(9, 2.0)
+        self.assertEqual(window.count, 1)
+        self.assertEqual(rollup.current[0], 0)
+
+
+def pings(rng, count, interval=1.0, timeout=2.0, loss=0.05):
+    # (sent, done, rtt) of pings sent every interval, done when the
+    # reply came in or they timed out, rtt NaN for lost ones
+    result = []
+    for i in range(count):
+        sent = i * interval + rng.uniform(0, interval / 10)
+        if rng.random() < loss:
+            result.append((sent, sent + timeout, nan))
+        else:
+            rtt = rng.lognormvariate(3, 1) / 1000 * timeout
+            result.append((sent, sent + min(rtt, timeout), rtt * 1000))
+    return result
+
+
+def feed(rollup, window, pings, publish_every=1.0):
+    # Like PingRecorder: results in send order, each only once it and
+    # all earlier ones are done, and windows expired at every publish in
+    # between. Pings near bucket ends are done after the bucket ended.
+    pending = sorted(pings, key=lambda ping: ping[0])
+    now = 0.0
+    end = max(done for sent, done, rtt in pings)
+    while pending:
+        now += publish_every
+        while pending and pending[0][1] <= now:
+            sent, done, rtt = pending.pop(0)
+            rollup.add(sent, rtt)
+        window.expire(now)
+    window.expire(end + rollup.delay + rollup.width)
+
+
+class RolledWindowTest(TestCase):
+    def check_against_raw(self, window, pings):
+        rollup = window.rollup
+        # the completed buckets in the window
+        last = rollup._bucket
+        first = last - window.size
+        values = [rtt for sent, done, rtt in pings if first <= sent // rollup.width < last]
+        received = [rtt for rtt in values if not isnan(rtt)]
+        self.assertEqual(window.count, len(values))
+        self.assertEqual(window.lost, len(values) - len(received))
+        stats = window.rtt_stats
+        self.assertAlmostEqual(stats[0], mean(received), places=5)
+        self.assertEqual(stats[2:4], (min(received), max(received)))
+        # within the sketch's relative accuracy, plus a bit for picking
+        # the lower of two middle values
+        self.assertLess(abs(stats[1] - median(received)) / median(received), 0.03)
+
+    def test_matches_raw_samples(self):
+        rng = Random(1)
+        for timeout in (0.5, 2.0, 5.0):
+            rollup = Rollup(10, 100, delay=2 * timeout + 5)
+            window = RolledWindow(rollup, 60)
+            data = pings(rng, 1000, timeout=timeout)
+            feed(rollup, window, data)
+            self.assertTrue(window.covered)
+            self.check_against_raw(window, data)
+
+    def test_eviction_and_merge(self):
+        # more buckets than the rollup keeps, so the window evicts and
+        # unmerges old bucket sketches all along
+        rng = Random(2)
+        rollup = Rollup(10, 8, delay=9)
+        window = RolledWindow(rollup, 6)
+        data = pings(rng, 2000)
+        feed(rollup, window, data)
+        self.assertGreater(rollup.counts.appended, len(rollup.counts))
+        self.check_against_raw(window, data)
+
+    def test_coverage(self):
+        rollup = Rollup(10, 10)
+        window = RolledWindow(rollup, 3)
+        rollup.add(5, 1.0)
+        rollup.add(15, 2.0)
+        window.expire(25)
+        self.assertFalse(window.covered)
+        # the bucket in progress counts until the window is covered
+        rollup.add(26, 3.0)
+        self.assertEqual(window.rtt_stats[2:4], (1.0, 3.0))
+        self.assertEqual(window.packet_loss, 0.0)
+        window.expire(35)
+        self.assertTrue(window.covered)
+        self.assertEqual(window.count, 3)
+        window.expire(45)
+        self.assertEqual(window.count, 2)
+        self.assertEqual(window.rtt_stats[2:4], (2.0, 3.0))
+
+    def test_tiers(self):
+        # raw samples while they fit in history, else the coarsest
+        # rollup with enough buckets
+        def tiers(**kwargs):
+            recorder = PingRecorder("192.0.2.1", history=60 * 60, **kwargs)
+            recorder.stop()
+            return {
+                timeframe: None if isinstance(window, WindowStats) else window.rollup.width
+                for timeframe, window in recorder._windows.items()
+            }
+        self.assertEqual(tiers(), {
+            10: None, 30: None, 60: None, 120: None, 300: None,
+            600: None, 900: None, 1800: None, 3600: None,
+            3 * 3600: 60, 6 * 3600: 60, 12 * 3600: 60, 24 * 3600: 60,
+            7 * 24 * 3600: 3600, 30 * 24 * 3600: 3600,
+        })
+        self.assertEqual(tiers(interval=0.1)[600], 10)
+        self.assertEqual(tiers(interval=0.1)[1800], 10)
+
+
+class RecorderRollupTest(TestCase):
+    def test_probe_completed_after_its_bucket_closed(self):
+        # history too short for 10m, so it is rolled up
+        recorder = PingRecorder("192.0.2.1", timeout=5, history=60)
+        self.assertIsInstance(recorder._windows[600], RolledWindow)
+        now = monotonic()
+        # sent in the previous 10s bucket, before publishing moved on
+        probe, sent = recorder._probe_sent()
+        recorder.packet_loss(600)
+        recorder.flush()
+        recorder._handle_reply(probe, sent_at(now // 10 * 10 - 2), 20.0)
+        recorder.flush()
+        self.assertEqual(recorder.packet_loss(600), 0.0)
+        self.assertEqual(recorder.rtt_stats(600)[0], 20.0)
+        recorder.stop()
+
+
+if __name__ == '__main__':
+    main()